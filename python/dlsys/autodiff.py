@@ -1,12 +1,18 @@
 """A library to take autodiff and execute a computation graph """
 from __future__ import absolute_import
+import copy
 import functools
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 import tvm
 
 from . import tvm_op
 from . import dependency_engine
+from . import memory_planner
+from . import kernel_cache
 
 import dependencyengine # <-- Cython module.
 
@@ -69,6 +75,16 @@ def Variable(name):
 
 class Op(object):
     """Op represents operations performed on nodes."""
+    # Elementwise ops set this, their compiled kernel reads and writes the
+    # same index only, so the output may reuse the buffer of an input.
+    inplace = False
+    # Elementwise ops that fuse_elementwise may merge into one kernel name
+    # their step of tvm_op.make_fused_elementwise here.
+    fused_kind = None
+    # Ops whose output depends on the input shapes only set the value filling
+    # it. The executor fills such nodes once per plan instead of every run.
+    constant_value = None
+
     def __call__(self):
         """Create a new node and associate the op object with the node.
 
@@ -92,6 +108,28 @@ class Op(object):
         """
         raise NotImplementedError
 
+    def kernel_args(self, node, input_vals, output_val):
+        """Arguments compute passes to compiled_func, so that a bound run can
+        call the kernel directly, see Executor.bind. None if compute does more
+        than that.
+        """
+        return None
+
+    def numpy_compute(self, node, input_vals):
+        """Reference NumPy implementation of compute, used while the compiled
+        function is not ready yet.
+
+        Parameters
+        ----------
+        node: node that performs the compute.
+        input_vals: values of input nodes as np.ndarray.
+
+        Returns
+        -------
+        An np.ndarray with the output value.
+        """
+        raise NotImplementedError
+
     def gradient(self, node, output_grad):
         """Given output gradient, compute partial gradient to each input node.
 
@@ -125,7 +163,24 @@ class Op(object):
         """
         raise NotImplementedError
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def infer_dtype(self, node, input_dtypes):
+        """Given dtypes of input nodes, the dtype node is stored in. Kernels
+        take arguments of one dtype, so by default that of the first input.
+        """
+        return input_dtypes[0]
+
+    def num_aux_outputs(self, node):
+        """Number of outputs of node besides its value, see AuxOutputOp."""
+        return 0
+
+    def updated_inputs(self, node):
+        """Indices of the inputs node overwrites in place, e.g. the parameter
+        and optimizer state of an update. The value of node is the buffer of
+        the first of them, and numpy_compute returns their new values."""
+        return ()
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """Compile the tvm function to native code for given input shapes.
 
         Parameters
@@ -134,6 +189,8 @@ class Op(object):
         input_shapes: shapes of input nodes.
         tgt: target device where computation is done, e.g. "llvm", "cuda", "arm"
         tgt_host: target host where driver code is generated, e.g. "llvm"
+        dtype: dtype of node, see infer_dtype. Kernels read and write it and
+            compute in tvm_op.accum_dtype(dtype).
 
         Returns
         -------
@@ -143,6 +200,9 @@ class Op(object):
 
 
 class AddOp(Op):
+    inplace = True
+    fused_kind = "add"
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
@@ -154,6 +214,12 @@ class AddOp(Op):
         assert input_vals[0].shape == input_vals[1].shape
         compiled_func(input_vals[0], input_vals[1], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return input_vals[0] + input_vals[1]
+
     def gradient(self, node, output_grad):
         return [output_grad, output_grad]
 
@@ -161,12 +227,16 @@ class AddOp(Op):
         """Need to handle input_vals[0].shape != input_vals[1].shape"""
         return broadcast_rule(input_shapes[0], input_shapes[1])
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         return tvm_op.make_elemwise_add(
-            input_shapes[0], tgt, tgt_host, "elem_add")
+            input_shapes[0], tgt, tgt_host, "elem_add", dtype=dtype)
 
 
 class AddByConstOp(Op):
+    inplace = True
+    fused_kind = "add_const"
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
@@ -178,6 +248,12 @@ class AddByConstOp(Op):
         assert len(input_vals) == 1
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return input_vals[0] + node.const_attr
+
     def gradient(self, node, output_grad):
         return [output_grad]
 
@@ -185,12 +261,17 @@ class AddByConstOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_elemwise_add_by_const(
-            input_shapes[0], tgt, tgt_host, "elem_add_by_const")
+            input_shapes[0], node.const_attr, tgt, tgt_host,
+            "elem_add_by_const", dtype=dtype)
 
 class MulOp(Op):
+    inplace = True
+    fused_kind = "mul"
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
@@ -202,6 +283,12 @@ class MulOp(Op):
         assert input_vals[0].shape == input_vals[1].shape
         compiled_func(input_vals[0], input_vals[1], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return input_vals[0] * input_vals[1]
+
     def gradient(self, node, output_grad):
         return [node.inputs[1] * output_grad, node.inputs[0] * output_grad]
 
@@ -211,12 +298,16 @@ class MulOp(Op):
         assert input_shapes[0] == input_shapes[1]
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_elemwise_mul(
-            input_shapes[0], tgt, tgt_host, "elemwise_mul")
+            input_shapes[0], tgt, tgt_host, "elemwise_mul", dtype=dtype)
 
 class MulByConstOp(Op):
+    inplace = True
+    fused_kind = "mul_const"
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
@@ -228,6 +319,12 @@ class MulByConstOp(Op):
         assert len(input_vals) == 1
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return input_vals[0] * node.const_attr
+
     def gradient(self, node, output_grad):
         return [node.const_attr * output_grad]
 
@@ -235,11 +332,12 @@ class MulByConstOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_elemwise_mul_by_const(
             input_shapes[0], node.const_attr, tgt, tgt_host,
-            "elemwise_mul_by_const")
+            "elemwise_mul_by_const", dtype=dtype)
 
 class MatMulOp(Op):
     def __call__(self, node_A, node_B, trans_A=False, trans_B=False):
@@ -254,6 +352,17 @@ class MatMulOp(Op):
     def compute(self, node, input_vals, output_val, compiled_func):
         compiled_func(input_vals[0], input_vals[1], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        lhs, rhs = input_vals
+        if node.matmul_attr_trans_A:
+            lhs = lhs.T
+        if node.matmul_attr_trans_B:
+            rhs = rhs.T
+        return np.dot(lhs, rhs)
+
     def gradient(self, node, output_grad):
         if ((node.matmul_attr_trans_A is False) and
                 (node.matmul_attr_trans_B is False)):
@@ -309,12 +418,13 @@ class MatMulOp(Op):
             assert input_shapes[0][0] == input_shapes[1][1]
             return (input_shapes[0][1], input_shapes[1][0])
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_matrix_mul(
             input_shapes[0], node.matmul_attr_trans_A,
             input_shapes[1], node.matmul_attr_trans_B,
-            tgt, tgt_host,"matrix_mul")
+            tgt, tgt_host,"matrix_mul", dtype=dtype)
 
 
 class PlaceholderOp(Op):
@@ -332,10 +442,13 @@ class PlaceholderOp(Op):
     def infer_shape(self, node, input_shapes):
         assert False, "placeholder %s shape provided by feed_shape" % node.name
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         return None
 
 class ZerosLikeOp(Op):
+    constant_value = 0.0
+
     def __call__(self, node_A):
         """Creates a node that represents np.zeros(node_A.shape)."""
         new_node = Op.__call__(self)
@@ -348,6 +461,9 @@ class ZerosLikeOp(Op):
         output_val.copyfrom(
             np.zeros(input_vals[0].shape, dtype = input_vals[0].dtype))
 
+    def numpy_compute(self, node, input_vals):
+        return np.zeros(input_vals[0].shape, dtype=input_vals[0].dtype)
+
     def gradient(self, node, output_grad):
         return [zeroslike_op(node.inputs[0])]
 
@@ -356,11 +472,14 @@ class ZerosLikeOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         return None
 
 
 class OnesLikeOp(Op):
+    constant_value = 1.0
+
     def __call__(self, node_A):
         """Creates a node that represents np.ones(node_A.shape)."""
         new_node = Op.__call__(self)
@@ -373,6 +492,9 @@ class OnesLikeOp(Op):
         output_val.copyfrom(
             np.ones(input_vals[0].shape, dtype = input_vals[0].dtype))
 
+    def numpy_compute(self, node, input_vals):
+        return np.ones(input_vals[0].shape, dtype=input_vals[0].dtype)
+
     def gradient(self, node, output_grad):
         return [zeroslike_op(node.inputs[0])]
 
@@ -381,11 +503,15 @@ class OnesLikeOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         return None
 
 
 class ReduceSumAxisZeroOp(Op):
+    # only ends a group of fused_elementwise, see FusedReduceSumAxisZeroOp
+    fused_kind = "reduce_sum_axis_zero"
+
     def __call__(self, node_A):
         """Creates a node that represents np.sum(node_A, axis=0).
         Only support common-case axis=0 reduction for simplicity of gradient.
@@ -399,6 +525,12 @@ class ReduceSumAxisZeroOp(Op):
         assert len(input_vals) == 1
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return np.sum(input_vals[0], axis=0)
+
     def gradient(self, node, output_grad):
         return [broadcastto_op(output_grad, node.inputs[0])]
 
@@ -412,12 +544,16 @@ class ReduceSumAxisZeroOp(Op):
             return (1,)
         return input_shapes[0][1:]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         return tvm_op.make_reduce_sum_axis_zero(
-            input_shapes[0], tgt, tgt_host, "reduce_sum_axis_zero")
+            input_shapes[0], tgt, tgt_host, "reduce_sum_axis_zero",
+            dtype=dtype)
 
 
 class BroadcastToOp(Op):
+    fused_kind = "broadcast_to"
+
     def __call__(self, node_A, node_B):
         """Creates a node that represents np.broadcast_to(node_A, node_B.shape).
         Only support axis=0. e.g. (3,4)->(2,3,4) to make gradient simple.
@@ -431,6 +567,12 @@ class BroadcastToOp(Op):
         assert(len(input_vals)==2)
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return np.broadcast_to(input_vals[0], input_vals[1].shape)
+
     def gradient(self, node, output_grad):
         grad_A = reducesumaxiszero_op(output_grad)
         grad_B = zeroslike_op(node.inputs[1])
@@ -440,10 +582,49 @@ class BroadcastToOp(Op):
         """TODO: Your code here"""
         return input_shapes[1]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_broadcast_to(
-            input_shapes[0], input_shapes[1], tgt, tgt_host, "broadcast_to")
+            input_shapes[0], input_shapes[1], tgt, tgt_host, "broadcast_to",
+            dtype=dtype)
+
+class BiasAddOp(Op):
+    inplace = True
+    fused_kind = "bias_add"
+
+    def __call__(self, node_A, node_B):
+        """Creates a node that represents
+        node_A + np.broadcast_to(node_B, node_A.shape). Unlike an add of a
+        BroadcastToOp node, the broadcast bias is never stored.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A, node_B]
+        new_node.name = "BiasAdd(%s,%s)" % (node_A.name, node_B.name)
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 2
+        compiled_func(input_vals[0], input_vals[1], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return input_vals[0] + input_vals[1]
+
+    def gradient(self, node, output_grad):
+        return [output_grad, reducesumaxiszero_op(output_grad)]
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[0]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_bias_add(
+            input_shapes[0], input_shapes[1], tgt, tgt_host, "bias_add",
+            dtype=dtype)
+
 
 def softmax_func(y):
     """Numerically stable softmax."""
@@ -466,8 +647,19 @@ class SoftmaxCrossEntropyOp(Op):
         y_ = input_vals[1]
         compiled_func(y, y_, output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        y, y_ = input_vals
+        probs = softmax_func(y)
+        return [np.mean(-np.sum(y_ * np.log(probs), axis=1), keepdims=True),
+                probs]
+
     def gradient(self, node, output_grad):
-        grad_A_temp = softmax_op(node.inputs[0]) + -1 * node.inputs[1]
+        # the softmax computed by the forward kernel
+        probs = aux_output_op(node, 1)
+        grad_A_temp = probs + -1 * node.inputs[1]
         grad_A = grad_A_temp * broadcastto_op(output_grad, grad_A_temp)
         grad_B = zeroslike_op(node.inputs[1])
         return [grad_A, grad_B]
@@ -476,10 +668,19 @@ class SoftmaxCrossEntropyOp(Op):
         """TODO: Your code here"""
         return (1,)
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def num_aux_outputs(self, node):
+        # the softmax probabilities
+        return 1
+
+    def infer_aux_shape(self, node, index, input_shapes):
+        return input_shapes[0]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_matrix_softmax_cross_entropy(
-            input_shapes[0], tgt, tgt_host, "matrix_softmax_cross_entropy")
+            input_shapes[0], tgt, tgt_host, "matrix_softmax_cross_entropy",
+            with_probs=True, dtype=dtype)
 
 class SoftmaxOp(Op):
     def __call__(self, node_A):
@@ -492,6 +693,12 @@ class SoftmaxOp(Op):
         assert len(input_vals) == 1
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return softmax_func(input_vals[0])
+
     def gradient(self, node, output_grad):
         # Do not directly use SoftmaxOp, use SoftmaxCrossEntropyOp instead.
         # Not allowing taking 2nd derivative of SoftmaxCrossEntropyOp.
@@ -501,13 +708,17 @@ class SoftmaxOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_matrix_softmax(
-            input_shapes[0], tgt, tgt_host, "matrix_softmax")
+            input_shapes[0], tgt, tgt_host, "matrix_softmax", dtype=dtype)
 
 
 class ReluOp(Op):
+    inplace = True
+    fused_kind = "relu"
+
     def __call__(self, node_A):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A]
@@ -517,6 +728,12 @@ class ReluOp(Op):
     def compute(self, node, input_vals, output_val, compiled_func):
         compiled_func(input_vals[0], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return np.maximum(input_vals[0], 0)
+
     def gradient(self, node, output_grad):
         return [relu_gradient_op(node.inputs[0], output_grad)]
 
@@ -524,12 +741,17 @@ class ReluOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
-        return tvm_op.make_relu(input_shapes[0], tgt, tgt_host, "relu")
+        return tvm_op.make_relu(
+            input_shapes[0], tgt, tgt_host, "relu", dtype=dtype)
 
 
 class ReluGradientOp(Op):
+    inplace = True
+    fused_kind = "relu_gradient"
+
     def __call__(self, node_A, node_B):
         """node_B is output_grad"""
         new_node = Op.__call__(self)
@@ -540,6 +762,12 @@ class ReluGradientOp(Op):
     def compute(self, node, input_vals, output_val, compiled_func):
         compiled_func(input_vals[0], input_vals[1], output_val)
 
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return (input_vals[0] > 0) * input_vals[1]
+
     def gradient(self, node, output_grad):
         raise NotImplementedError
 
@@ -547,10 +775,606 @@ class ReluGradientOp(Op):
         """TODO: Your code here"""
         return input_shapes[0]
 
-    def compiled_func(self, node, input_shapes, tgt, tgt_host):
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
         """TODO: Your code here"""
         return tvm_op.make_relu_gradient(
-            input_shapes[0], tgt, tgt_host, "relu_gradient")
+            input_shapes[0], tgt, tgt_host, "relu_gradient", dtype=dtype)
+
+
+def conv2d_func(x, f, stride, padding):
+    """NumPy conv2d of NCHW images x with MCRS filters f, see Conv2dOp."""
+    N, C, H, W = x.shape
+    M, _, R, S = f.shape
+    OH = tvm_op.conv2d_output_size(H, R, stride, padding)
+    OW = tvm_op.conv2d_output_size(W, S, stride, padding)
+    x = np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)),
+               "constant")
+    out = np.zeros((N, M, OH, OW), dtype=x.dtype)
+    for r in range(R):
+        for s in range(S):
+            patch = x[:, :, r:r + stride * OH:stride, s:s + stride * OW:stride]
+            out += np.einsum("nchw,mc->nmhw", patch, f[:, :, r, s])
+    return out
+
+
+def conv2d_gradient_funcs(x, f, grad, stride, padding):
+    """NumPy gradients of conv2d_func with respect to x and f, given the
+    gradient grad of its output."""
+    N, C, H, W = x.shape
+    M, _, R, S = f.shape
+    _, _, OH, OW = grad.shape
+    x = np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)),
+               "constant")
+    grad_x = np.zeros_like(x)
+    grad_f = np.zeros_like(f)
+    for r in range(R):
+        for s in range(S):
+            window = (slice(None), slice(None),
+                      slice(r, r + stride * OH, stride),
+                      slice(s, s + stride * OW, stride))
+            grad_x[window] += np.einsum("nmhw,mc->nchw", grad, f[:, :, r, s])
+            grad_f[:, :, r, s] = np.einsum("nmhw,nchw->mc", grad, x[window])
+    return grad_x[:, :, padding:padding + H, padding:padding + W], grad_f
+
+
+class Conv2dOp(Op):
+    def __call__(self, node_X, node_F, stride=1, padding=0):
+        """Creates a node that represents the convolution (cross-correlation,
+        as in most frameworks) of images node_X of shape (N, C, H, W) with
+        filters node_F of shape (M, C, R, S). H and W are zero padded by
+        padding on both sides.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_X, node_F]
+        new_node.conv2d_attr_stride = stride
+        new_node.conv2d_attr_padding = padding
+        new_node.name = "Conv2d(%s,%s)" % (node_X.name, node_F.name)
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 2
+        compiled_func(input_vals[0], input_vals[1], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return conv2d_func(input_vals[0], input_vals[1],
+                           node.conv2d_attr_stride, node.conv2d_attr_padding)
+
+    def gradient(self, node, output_grad):
+        return [conv2d_gradient_input_op(node, output_grad),
+                conv2d_gradient_filter_op(node, output_grad)]
+
+    def infer_shape(self, node, input_shapes):
+        N, C, H, W = input_shapes[0]
+        M, C_F, R, S = input_shapes[1]
+        assert C == C_F
+        stride = node.conv2d_attr_stride
+        padding = node.conv2d_attr_padding
+        return (N, M, tvm_op.conv2d_output_size(H, R, stride, padding),
+                tvm_op.conv2d_output_size(W, S, stride, padding))
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_conv2d(
+            input_shapes[0], input_shapes[1], tgt, tgt_host, "conv2d",
+            stride=node.conv2d_attr_stride,
+            padding=node.conv2d_attr_padding, dtype=dtype)
+
+
+class Conv2dGradientInputOp(Op):
+    def __call__(self, node_conv, output_grad):
+        """Creates a node that represents the gradient of the Conv2dOp
+        node_conv with respect to its images, given output_grad."""
+        node_X, node_F = node_conv.inputs
+        new_node = Op.__call__(self)
+        # node_X for its shape only
+        new_node.inputs = [output_grad, node_F, node_X]
+        new_node.conv2d_attr_stride = node_conv.conv2d_attr_stride
+        new_node.conv2d_attr_padding = node_conv.conv2d_attr_padding
+        new_node.name = "Conv2dGradientInput(%s)" % node_X.name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 3
+        compiled_func(input_vals[0], input_vals[1], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        grad, f, x = input_vals
+        return conv2d_gradient_funcs(x, f, grad, node.conv2d_attr_stride,
+                                     node.conv2d_attr_padding)[0]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[2]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_conv2d_gradient_input(
+            input_shapes[0], input_shapes[1], input_shapes[2], tgt, tgt_host,
+            "conv2d_gradient_input", stride=node.conv2d_attr_stride,
+            padding=node.conv2d_attr_padding, dtype=dtype)
+
+
+class Conv2dGradientFilterOp(Op):
+    def __call__(self, node_conv, output_grad):
+        """Creates a node that represents the gradient of the Conv2dOp
+        node_conv with respect to its filters, given output_grad."""
+        node_X, node_F = node_conv.inputs
+        new_node = Op.__call__(self)
+        # node_F for its shape only
+        new_node.inputs = [node_X, output_grad, node_F]
+        new_node.conv2d_attr_stride = node_conv.conv2d_attr_stride
+        new_node.conv2d_attr_padding = node_conv.conv2d_attr_padding
+        new_node.name = "Conv2dGradientFilter(%s)" % node_F.name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 3
+        compiled_func(input_vals[0], input_vals[1], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        x, grad, f = input_vals
+        return conv2d_gradient_funcs(x, f, grad, node.conv2d_attr_stride,
+                                     node.conv2d_attr_padding)[1]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[2]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_conv2d_gradient_filter(
+            input_shapes[0], input_shapes[1], input_shapes[2], tgt, tgt_host,
+            "conv2d_gradient_filter", stride=node.conv2d_attr_stride,
+            padding=node.conv2d_attr_padding, dtype=dtype)
+
+
+class DenseOp(Op):
+    def __call__(self, node_X, node_W, node_B, trans_A=False, trans_B=False,
+                 relu=False):
+        """Creates a node computing matmul(X, W) + broadcastto(B), followed
+        by relu if relu is True, with one kernel."""
+        new_node = Op.__call__(self)
+        new_node.matmul_attr_trans_A = trans_A
+        new_node.matmul_attr_trans_B = trans_B
+        new_node.dense_attr_relu = relu
+        new_node.inputs = [node_X, node_W, node_B]
+        new_node.name = "Dense(%s,%s,%s,%s)" % (
+            node_X.name, node_W.name, node_B.name, str(relu))
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 3
+        compiled_func(input_vals[0], input_vals[1], input_vals[2], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], input_vals[2], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        z = matmul_op.numpy_compute(node, input_vals[:2]) + input_vals[2]
+        if node.dense_attr_relu:
+            z = np.maximum(z, 0)
+        return z
+
+    def gradient(self, node, output_grad):
+        # fusion runs after gradients() built the graph
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        shape = matmul_op.infer_shape(node, input_shapes[:2])
+        assert broadcast_rule(input_shapes[2], shape) == shape
+        return shape
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_dense(
+            input_shapes[0], node.matmul_attr_trans_A,
+            input_shapes[1], node.matmul_attr_trans_B,
+            input_shapes[2], node.dense_attr_relu, tgt, tgt_host, "dense",
+            dtype=dtype)
+
+
+class MultiMatMulOp(Op):
+    def __call__(self, node_shared, other_nodes, shared_left=True,
+                 trans_A=False, trans_B=False):
+        """Creates a node computing matmul(node_shared, other) for every node
+        in other_nodes, or matmul(other, node_shared) if not shared_left,
+        with one kernel reading node_shared once. The first product is the
+        value of the node, the others are its aux outputs.
+        """
+        new_node = Op.__call__(self)
+        new_node.matmul_attr_trans_A = trans_A
+        new_node.matmul_attr_trans_B = trans_B
+        new_node.multi_attr_shared_left = shared_left
+        new_node.inputs = [node_shared] + list(other_nodes)
+        new_node.name = "MultiMatMul(%s,%s)" % (
+            node_shared.name, ",".join(n.name for n in other_nodes))
+        return new_node
+
+    def operands(self, node, inputs):
+        """Pairs of (lhs, rhs) of every product, taken from inputs."""
+        if node.multi_attr_shared_left:
+            return [(inputs[0], other) for other in inputs[1:]]
+        return [(other, inputs[0]) for other in inputs[1:]]
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == len(node.inputs)
+        compiled_func(*(list(input_vals) + [output_val]))
+
+    def kernel_args(self, node, input_vals, output_val):
+        return list(input_vals) + [output_val]
+
+    def numpy_compute(self, node, input_vals):
+        # the value of every output
+        return [matmul_op.numpy_compute(node, list(pair))
+                for pair in self.operands(node, input_vals)]
+
+    def gradient(self, node, output_grad):
+        # fusion runs after gradients() built the graph
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        shapes = [matmul_op.infer_shape(node, list(pair))
+                  for pair in self.operands(node, input_shapes)]
+        assert all(shape == shapes[0] for shape in shapes)
+        return shapes[0]
+
+    def num_aux_outputs(self, node):
+        return len(node.inputs) - 2
+
+    def infer_aux_shape(self, node, index, input_shapes):
+        return self.infer_shape(node, input_shapes)
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_multi_matmul(
+            input_shapes[0], input_shapes[1], len(node.inputs) - 1,
+            node.multi_attr_shared_left, node.matmul_attr_trans_A,
+            node.matmul_attr_trans_B, tgt, tgt_host, "multi_matmul",
+            dtype=dtype)
+
+
+class AuxOutputOp(Op):
+    def __call__(self, node_A, index):
+        """Creates a node holding output number index of node_A, for ops with
+        more than one output. The kernel of node_A writes it, so it is never
+        computed itself.
+
+        Ops with aux outputs implement num_aux_outputs and
+        infer_aux_shape(node, index, input_shapes), their numpy_compute
+        returns the values of all outputs and their kernel takes the buffers
+        of the aux outputs after its own.
+        """
+        new_node = Op.__call__(self)
+        # the inputs of node_A are needed to infer the shape
+        new_node.inputs = [node_A] + list(node_A.inputs)
+        new_node.aux_index = index
+        new_node.name = "%s[%d]" % (node_A.name, index)
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert False, "aux output %s is written by %s" % (
+            node.name, node.inputs[0].name)
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        producer = node.inputs[0]
+        return producer.op.infer_aux_shape(
+            producer, node.aux_index, input_shapes[1:])
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return None
+
+
+class FusedElementwiseOp(Op):
+    inplace = True
+
+    def __call__(self, fused_nodes, inputs):
+        """Creates a node computing the elementwise nodes fused_nodes, given
+        in topo order, with one kernel. The last of them is the result, and
+        inputs are the nodes outside fused_nodes that they read.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = list(inputs)
+        new_node.fused_nodes = list(fused_nodes)
+        # every fused node reads values by index into inputs + fused_nodes
+        values = new_node.inputs + new_node.fused_nodes
+        new_node.fused_refs = [
+            tuple(values.index(n) for n in fused.inputs)
+            for fused in new_node.fused_nodes]
+        new_node.name = "Fused(%s)" % new_node.fused_nodes[-1].name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == len(node.inputs)
+        compiled_func(*(list(input_vals) + [output_val]))
+
+    def kernel_args(self, node, input_vals, output_val):
+        return list(input_vals) + [output_val]
+
+    def numpy_compute(self, node, input_vals):
+        values = list(input_vals)
+        for fused, refs in zip(node.fused_nodes, node.fused_refs):
+            values.append(fused.op.numpy_compute(
+                fused, [values[r] for r in refs]))
+        return values[-1]
+
+    def gradient(self, node, output_grad):
+        # fusion runs after gradients() built the graph
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        shapes = list(input_shapes)
+        for fused, refs in zip(node.fused_nodes, node.fused_refs):
+            shapes.append(fused.op.infer_shape(
+                fused, [shapes[r] for r in refs]))
+        return shapes[-1]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        program = tuple(
+            (fused.op.fused_kind, refs, fused.const_attr)
+            for fused, refs in zip(node.fused_nodes, node.fused_refs))
+        return tvm_op.make_fused_elementwise(
+            input_shapes, program, tgt, tgt_host, "fused_elementwise",
+            dtype=dtype)
+
+class FusedReduceSumAxisZeroOp(FusedElementwiseOp):
+    # reads every row of its inputs before writing
+    inplace = False
+
+    def __call__(self, fused_nodes, inputs):
+        """Like FusedElementwiseOp, with the last of fused_nodes a
+        ReduceSumAxisZeroOp summing the others, e.g. the bias gradient of a
+        dense layer, as they are computed.
+        """
+        assert isinstance(fused_nodes[-1].op, ReduceSumAxisZeroOp)
+        return FusedElementwiseOp.__call__(self, fused_nodes, inputs)
+
+
+class OptimizerStateOp(Op):
+    def __call__(self, node_A, state_name, shape=None, dtype=None):
+        """Creates a node holding optimizer state state_name of the parameter
+        node_A, e.g. its velocity. The executor keeps its buffer from one run
+        to the next, starting from zeros.
+
+        shape and dtype default to those of node_A.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A]
+        new_node.state_name = state_name
+        new_node.state_shape = shape
+        new_node.state_dtype = dtype
+        new_node.name = "%s(%s)" % (state_name, node_A.name)
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert False, "state %s is kept by the executor" % node.name
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        if node.state_shape is not None:
+            return node.state_shape
+        return input_shapes[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        if node.state_dtype is not None:
+            return node.state_dtype
+        return input_dtypes[0]
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return None
+
+
+class SGDUpdateOp(Op):
+    def __call__(self, node_A, node_grad, learning_rate):
+        """Creates a node that updates the parameter node_A in place,
+        node_A -= learning_rate * node_grad, once every node reading node_A
+        has run. Its value is the updated node_A.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A, node_grad]
+        new_node.update_attr_lr = learning_rate
+        new_node.name = "SGDUpdate(%s)" % node_A.name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 2
+        compiled_func(input_vals[0], input_vals[1], output_val)
+
+    def kernel_args(self, node, input_vals, output_val):
+        return [input_vals[0], input_vals[1], output_val]
+
+    def numpy_compute(self, node, input_vals):
+        return [input_vals[0] - node.update_attr_lr * input_vals[1]]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        assert input_shapes[0] == input_shapes[1]
+        return input_shapes[0]
+
+    def updated_inputs(self, node):
+        return (0,)
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_sgd_update(
+            input_shapes[0], node.update_attr_lr, tgt, tgt_host, "sgd_update",
+            dtype=dtype)
+
+
+class MultiSGDUpdateOp(Op):
+    def __call__(self, params, grads, learning_rate):
+        """Creates a node that updates every node of params in place with
+        one kernel, like an SGDUpdateOp per parameter. Its value is the
+        first updated parameter.
+        """
+        assert len(params) == len(grads)
+        new_node = Op.__call__(self)
+        new_node.inputs = list(params) + list(grads)
+        new_node.update_attr_lr = learning_rate
+        new_node.name = "MultiSGDUpdate(%s)" % ",".join(
+            n.name for n in params)
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        compiled_func(*self.kernel_args(node, input_vals, output_val))
+
+    def kernel_args(self, node, input_vals, output_val):
+        num = len(input_vals) // 2
+        return list(input_vals) + list(input_vals[:num])
+
+    def numpy_compute(self, node, input_vals):
+        num = len(input_vals) // 2
+        return [param - node.update_attr_lr * grad
+                for param, grad in zip(input_vals[:num], input_vals[num:])]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        num = len(input_shapes) // 2
+        assert list(input_shapes[:num]) == list(input_shapes[num:])
+        return input_shapes[0]
+
+    def updated_inputs(self, node):
+        return tuple(range(len(node.inputs) // 2))
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        return tvm_op.make_multi_sgd_update(
+            input_shapes[:len(input_shapes) // 2], node.update_attr_lr,
+            tgt, tgt_host, "multi_sgd_update", dtype=dtype)
+
+
+class MomentumUpdateOp(Op):
+    def __call__(self, node_A, node_grad, learning_rate, momentum=0.9):
+        """Creates a node that updates the parameter node_A in place with
+        momentum SGD:
+            velocity = momentum * velocity + node_grad
+            node_A -= learning_rate * velocity
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A, node_grad,
+                           optimizer_state_op(node_A, "velocity")]
+        new_node.update_attr_lr = learning_rate
+        new_node.update_attr_momentum = momentum
+        new_node.name = "MomentumUpdate(%s)" % node_A.name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 3
+        compiled_func(*self.kernel_args(node, input_vals, output_val))
+
+    def kernel_args(self, node, input_vals, output_val):
+        param, grad, velocity = input_vals
+        return [param, grad, velocity, node.update_attr_lr,
+                node.update_attr_momentum, output_val, velocity]
+
+    def numpy_compute(self, node, input_vals):
+        param, grad, velocity = input_vals
+        velocity = node.update_attr_momentum * velocity + grad
+        return [param - node.update_attr_lr * velocity, velocity]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        assert input_shapes[0] == input_shapes[1]
+        return input_shapes[0]
+
+    def updated_inputs(self, node):
+        return (0, 2)
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        # hyperparameters are kernel arguments
+        return tvm_op.make_momentum_update(
+            input_shapes[0], tgt, tgt_host, "momentum_update", dtype=dtype)
+
+
+class AdamUpdateOp(Op):
+    def __call__(self, node_A, node_grad, learning_rate, beta1=0.9,
+                 beta2=0.999, epsilon=1e-8):
+        """Creates a node that updates the parameter node_A in place with
+        Adam, keeping both moments and the bias corrections of the step as
+        optimizer state.
+        """
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A, node_grad,
+                           optimizer_state_op(node_A, "m"),
+                           optimizer_state_op(node_A, "v"),
+                           # advanced by the kernel, see make_adam_update
+                           optimizer_state_op(node_A, "corrections", (2,),
+                                              "float32")]
+        new_node.update_attr_lr = learning_rate
+        new_node.update_attr_beta1 = beta1
+        new_node.update_attr_beta2 = beta2
+        new_node.update_attr_epsilon = epsilon
+        new_node.name = "AdamUpdate(%s)" % node_A.name
+        return new_node
+
+    def compute(self, node, input_vals, output_val, compiled_func):
+        assert len(input_vals) == 5
+        compiled_func(*self.kernel_args(node, input_vals, output_val))
+
+    def kernel_args(self, node, input_vals, output_val):
+        param, grad, m, v, corrections = input_vals
+        return [param, grad, m, v, corrections, node.update_attr_lr,
+                node.update_attr_beta1, node.update_attr_beta2,
+                node.update_attr_epsilon, output_val, m, v, corrections]
+
+    def numpy_compute(self, node, input_vals):
+        param, grad, m, v, corrections = input_vals
+        beta1 = node.update_attr_beta1
+        beta2 = node.update_attr_beta2
+        betas = np.array([beta1, beta2], dtype=corrections.dtype)
+        corrections = 1 - betas + betas * corrections
+        m = beta1 * m + (1 - beta1) * grad
+        v = beta2 * v + (1 - beta2) * grad * grad
+        step_size = node.update_attr_lr * np.sqrt(corrections[1]) / \
+            corrections[0]
+        param = param - step_size * m / (
+            np.sqrt(v) + node.update_attr_epsilon)
+        return [param, m, v, corrections]
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        assert input_shapes[0] == input_shapes[1]
+        return input_shapes[0]
+
+    def updated_inputs(self, node):
+        return (0, 2, 3, 4)
+
+    def compiled_func(self, node, input_shapes, tgt, tgt_host,
+                      dtype="float32"):
+        # hyperparameters are kernel arguments
+        return tvm_op.make_adam_update(
+            input_shapes[0], tgt, tgt_host, "adam_update", dtype=dtype)
+
 
 # Create global singletons of operators.
 add_op = AddOp()
@@ -567,21 +1391,142 @@ softmaxcrossentropy_op = SoftmaxCrossEntropyOp()
 softmax_op = SoftmaxOp()
 relu_op = ReluOp()
 relu_gradient_op = ReluGradientOp()
+conv2d_op = Conv2dOp()
+conv2d_gradient_input_op = Conv2dGradientInputOp()
+conv2d_gradient_filter_op = Conv2dGradientFilterOp()
+dense_op = DenseOp()
+multi_matmul_op = MultiMatMulOp()
+aux_output_op = AuxOutputOp()
+fused_elementwise_op = FusedElementwiseOp()
+fused_reduce_sum_axis_zero_op = FusedReduceSumAxisZeroOp()
+bias_add_op = BiasAddOp()
+optimizer_state_op = OptimizerStateOp()
+sgd_update_op = SGDUpdateOp()
+multi_sgd_update_op = MultiSGDUpdateOp()
+momentum_update_op = MomentumUpdateOp()
+adam_update_op = AdamUpdateOp()
+
+
+class SymbolicDim(object):
+    """A dimension only known at run time, e.g. the batch size.
+
+    Shape inference passes it through ops like any other dimension. It only
+    compares equal to itself, so shape checks between a symbolic and a fixed
+    dimension fail.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+batch_dim = SymbolicDim("n")
+
+
+def infer_shapes(topo_order, feed_shapes):
+    """Returns a dict from node to shape, given shapes of feed_dict nodes."""
+    node_to_shape_map = dict(feed_shapes)
+    for node in topo_order:
+        # already have the shape info needed
+        if node in node_to_shape_map:
+            continue
+        input_shapes = [node_to_shape_map[n] for n in node.inputs]
+        node_to_shape_map[node] = node.op.infer_shape(node, input_shapes)
+    return node_to_shape_map
+
+
+def infer_dtypes(topo_order, feed_dtypes):
+    """Returns a dict from node to dtype, given dtypes of feed_dict nodes."""
+    node_to_dtype_map = dict(feed_dtypes)
+    for node in topo_order:
+        if node in node_to_dtype_map:
+            continue
+        input_dtypes = [node_to_dtype_map[n] for n in node.inputs]
+        node_to_dtype_map[node] = node.op.infer_dtype(node, input_dtypes)
+    return node_to_dtype_map
+
+
+class BoundRun(object):
+    """A run of an Executor with every kernel and buffer resolved, see
+    Executor.bind."""
+    def __init__(self, steps, outputs):
+        self.steps = steps
+        self.outputs = outputs
+
+    def __call__(self):
+        for func, args in self.steps:
+            func(*args)
+        return self.outputs
 
 
 class Executor(object):
     """Executor computes values for given set of nodes in computation graph."""
-    def __init__(self, eval_node_list, ctx=None):
+    # Executor state belonging to one plan
+    plan_attributes = ("feed_shapes", "output_nodes", "topo_order",
+        "node_to_aux", "node_to_shape_map", "node_to_dtype_map",
+        "node_to_arr_map",
+        "node_to_storage", "storage_nbytes", "node_to_compiled_func",
+        "compile_thread", "compile_cancelled", "fetch_orders")
+
+    def __init__(self, eval_node_list, ctx=None, memory_reuse=True,
+                 best_fit=False, inplace=True, compile_workers=1,
+                 lazy_compile=False, max_plans=8, plan_memory_budget=None,
+                 batch_nodes=(), fuse=True, simplify=True, dtype="float32"):
         """
         Parameters
         ----------
         eval_node_list: list of nodes whose values need to be computed.
         ctx: runtime DLContext, default is None which means np.ndarray on cpu
+        memory_reuse: share storage between nodes whose lifetimes don't
+            overlap, instead of allocating one tvm.nd.array per node.
+        best_fit: let nodes of different shapes share storage, each storage
+            is sized for its biggest user and the others use views into it.
+        inplace: with memory_reuse, let elementwise ops write into the buffer
+            of an input that is not read afterwards. Feed_dict values are
+            never overwritten.
+        compile_workers: number of processes compiling kernels in parallel.
+            Parallel compile is opt-in: the default 1 compiles serially in
+            this process, which is cheapest for small graphs and tests. Pass
+            e.g. os.cpu_count() to cut the time to the first step of big
+            graphs, the pool spawns one worker per core.
+        lazy_compile: don't wait for kernels to compile. They are built by a
+            background thread in topo order, and until a node's kernel is
+            ready run() evaluates the node with op.numpy_compute.
+        max_plans: number of plans (shapes, buffers and kernels for one set of
+            feed shapes) kept around, so alternating between e.g. training
+            and validation batches doesn't re-plan or recompile.
+        plan_memory_budget: bytes of node buffers the kept plans may hold
+            together, the least recently used plans are dropped beyond it.
+            The plan in use is always kept. Default is no limit.
+        batch_nodes: feed_dict nodes whose first dimension is the batch size.
+            Kernels are then compiled for a symbolic batch size, so one set
+            of kernels serves every batch size.
+        fuse: compute dense layers, groups of elementwise ops and matmuls
+            sharing an operand with one kernel each, and add biases without
+            broadcasting them first, see fuse_dense, fuse_bias_add,
+            fuse_elementwise and fuse_sibling_matmuls.
+        simplify: remove redundant nodes from the graph first, see
+            simplify_graph.
+        dtype: dtype of the feed_dict values and of the nodes computed from
+            them, see Op.infer_dtype. "float16" halves the memory and
+            bandwidth of activations and weights, kernels still compute in
+            float32 (see tvm_op.accum_dtype).
+        graph_nodes: nodes computing eval_node_list after graph rewrites
+            that don't depend on shapes
+        output_nodes: graph_nodes after rewrites for the current feed shapes
+        node_to_aux: dict from node to the aux output nodes its kernel writes
+        fetch_orders: dict from fetched eval_node_list indices to the part of
+            topo_order computing them
         topo_order: list of nodes in topological order
         node_to_shape_map: dict from node to shape of the node
+        node_to_dtype_map: dict from node to dtype of the node
         node_to_arr_map: dict from node to tvm.nd.array allocated for node
+        node_to_storage: dict from node to id of the storage backing it
         node_to_compiled_func: dict from node to compiled func for node
         feed_shapes: shapes of feed_dict from last run(...)
+        plans: OrderedDict from feed shapes to saved plans, in LRU order
+        optimizer_states: dict from OptimizerStateOp node to its
+            tvm.nd.array, shared by all plans
         """
         self.eval_node_list = eval_node_list
         self.ctx = ctx
@@ -590,51 +1535,86 @@ class Executor(object):
             self.tgt_host="llvm"
         else:
             assert False, "non-CPU context not yet supported"
-        self.topo_order = find_topo_sort(self.eval_node_list)
+        self.memory_reuse = memory_reuse
+        self.best_fit = best_fit
+        self.inplace = inplace
+        self.compile_workers = compile_workers
+        self.lazy_compile = lazy_compile
+        self.compile_thread = None
+        self.compile_cancelled = None
+        self.fuse = fuse
+        self.graph_nodes = merge_aux_outputs(eval_node_list)
+        if simplify:
+            self.graph_nodes = simplify_graph(self.graph_nodes)
+        if fuse:
+            self.graph_nodes = fuse_elementwise(
+                fuse_bias_add(fuse_dense(self.graph_nodes)))
+        self.output_nodes = self.graph_nodes
+        self.topo_order, self.node_to_aux = find_aux_outputs(
+            schedule_updates(find_topo_sort(self.output_nodes)))
+        self.fetch_orders = {}
         self.node_to_shape_map = None
+        self.node_to_dtype_map = None
+        self.dtype = dtype
         self.node_to_arr_map = None
+        self.node_to_storage = None
+        self.storage_nbytes = 0
         self.node_to_compiled_func = None
         self.feed_shapes = None
+        self.max_plans = max_plans
+        self.plan_memory_budget = plan_memory_budget
+        self.plans = OrderedDict()
+        self.optimizer_states = {}
+        self.batch_nodes = set(batch_nodes)
         self.engine = dependencyengine.DependencyQueue()
+        # resource tags of the dependency engine, one per feed_dict node
+        # and one per storage, since nodes sharing storage must be ordered
+        self.resource_tags = {}
 
     def infer_shape(self, feed_shapes):
         """Given shapes of feed_dict nodes, infer shape for all nodes in graph.
 
         Implementation note:
-        Iteratively calls node.op.infer_shape to infer shapes.
-        Node shapes stored in self.node_to_shape_map.
+        Iteratively calls node.op.infer_shape to infer shapes, and
+        node.op.infer_dtype to infer dtypes from self.dtype of the feed_dict
+        nodes. Node shapes stored in self.node_to_shape_map, dtypes in
+        self.node_to_dtype_map.
 
         Parameters
         ----------
         feed_shapes: node->shapes mapping for feed_dict nodes.
         """
-
-        # initialize
-        self.node_to_shape_map = {}
-
-        # start with the feed_shapes
-        for node in feed_shapes:
-            self.node_to_shape_map[node] = feed_shapes[node]
-
-        for node in self.topo_order:
-            # already have the shape info needed
-            if node in self.node_to_shape_map:
-                continue
-
-            # get the shapes of the inputs
-            inputs = node.inputs
-            input_shapes = []
-            for input in inputs:
-                input_shapes += [self.node_to_shape_map[input]]
-
-            # now infer the node's shape
-            self.node_to_shape_map[node] = node.op.infer_shape(node, input_shapes)
+        self.node_to_shape_map = infer_shapes(self.topo_order, feed_shapes)
+        self.node_to_dtype_map = infer_dtypes(self.topo_order, dict(
+            (node, self.dtype) for node in feed_shapes))
+
+    def kernel_shapes(self, feed_shapes):
+        """Shapes kernels are compiled for: self.node_to_shape_map, or with
+        batch_nodes the same shapes with the batch size as a tvm.var."""
+        if len(self.batch_nodes) == 0:
+            return self.node_to_shape_map
+        symbolic_feed_shapes = {}
+        for node, shape in feed_shapes.items():
+            if node in self.batch_nodes:
+                shape = (batch_dim,) + tuple(shape[1:])
+            symbolic_feed_shapes[node] = shape
+        batch_size = tvm.var("n")
+        return dict(
+            (node, tuple(batch_size if d is batch_dim else d for d in shape))
+            for node, shape in infer_shapes(
+                self.topo_order, symbolic_feed_shapes).items())
 
     def memory_plan(self, feed_shapes):
         """Allocates tvm.nd.array for every node except feed_dict nodes.
 
         Implementation note:
-        Easy Option: Alloc a tvm.nd.array per node that persists across run()
+        With memory_reuse, a liveness analysis over topo_order lets nodes
+        whose lifetimes don't overlap share one tvm.nd.array, so peak memory
+        is bounded by the live set instead of the sum of all intermediates.
+        Nodes in eval_node_list are kept alive for the whole run. Constant
+        nodes (see Op.constant_value) get storage of their own and are filled
+        here, once per plan. Optimizer state outlives plans, and nodes
+        updating their inputs in place need no storage.
 
         Use self.node_to_arr_map to store node->tvm.nd.array mapping
         to allow mapping to persist across multiple executor.run().
@@ -643,19 +1623,83 @@ class Executor(object):
         ----------
         feed_shapes: node->shapes mapping for feed_dict nodes.
         """
+        # views into bigger storages need NDArray._create_view
+        best_fit = self.best_fit and \
+            hasattr(tvm.ndarray.NDArray, "_create_view")
 
-        # initialize
-        self.node_to_arr_map = {}
-
-        for node in self.node_to_shape_map:
+        node_to_size = {}
+        node_to_key = {}
+        constant_nodes = []
+        for node in self.topo_order:
             # no need to allocate memory for nodes in feed shape
             if node in feed_shapes:
                 continue
-            # use the inferred shape
+            if node.op.constant_value is not None or \
+                    isinstance(node.op, OptimizerStateOp):
+                # must survive across runs, never shared
+                constant_nodes.append(node)
+                continue
+            if len(node.op.updated_inputs(node)) > 0:
+                continue
             shape = self.node_to_shape_map[node]
-            # allocate empty memory
-            self.node_to_arr_map[node] = tvm.ndarray.empty(
-                shape, dtype='float32', ctx=self.ctx)
+            dtype = self.node_to_dtype_map[node]
+            node_to_size[node] = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            # without views only nodes of the same shape can share
+            node_to_key[node] = dtype if best_fit else (shape, dtype)
+
+        inplace_nodes = []
+        if self.inplace:
+            # the same shape check keeps broadcasting adds out
+            inplace_nodes = [node for node in node_to_size
+                if node.op.inplace and any(
+                    self.node_to_shape_map[n] == self.node_to_shape_map[node]
+                    for n in node.inputs)]
+
+        if self.memory_reuse:
+            plan = memory_planner.plan_storage(
+                self.topo_order, node_to_size, node_to_key,
+                keep_nodes=self.output_nodes, best_fit=best_fit,
+                inplace_nodes=inplace_nodes, aux_outputs=self.node_to_aux)
+            self.node_to_storage = plan.node_to_storage
+            storage_sizes = plan.storage_sizes
+        else:
+            self.node_to_storage = dict(
+                (node, i) for i, node in enumerate(node_to_size))
+            storage_sizes = [node_to_size[node] for node in node_to_size]
+
+        # allocate empty memory, then hand out the storage to its nodes
+        storages = [None] * len(storage_sizes)
+        for node, sid in self.node_to_storage.items():
+            # storages are shared by nodes of one dtype
+            dtype = self.node_to_dtype_map[node]
+            if storages[sid] is None:
+                if best_fit:
+                    storages[sid] = tvm.ndarray.empty(
+                        (storage_sizes[sid] // np.dtype(dtype).itemsize,),
+                        dtype=dtype, ctx=self.ctx)
+                else:
+                    storages[sid] = tvm.ndarray.empty(
+                        self.node_to_shape_map[node], dtype=dtype,
+                        ctx=self.ctx)
+        self.storage_nbytes = sum(storage_sizes)
+
+        self.node_to_arr_map = {}
+        for node, sid in self.node_to_storage.items():
+            self.node_to_arr_map[node] = storage_view(
+                storages[sid], self.node_to_shape_map[node])
+        for node in constant_nodes:
+            shape = self.node_to_shape_map[node]
+            dtype = self.node_to_dtype_map[node]
+            if isinstance(node.op, OptimizerStateOp):
+                if node not in self.optimizer_states:
+                    self.optimizer_states[node] = tvm.nd.array(
+                        np.zeros(shape, dtype=dtype), ctx=self.ctx)
+                self.node_to_arr_map[node] = self.optimizer_states[node]
+                continue
+            self.node_to_arr_map[node] = tvm.nd.array(np.full(
+                shape, node.op.constant_value, dtype=dtype), ctx=self.ctx)
+            self.storage_nbytes += \
+                int(np.prod(shape)) * np.dtype(dtype).itemsize
 
 
     def compile_funcs(self, feed_shapes):
@@ -664,6 +1708,10 @@ class Executor(object):
         Must be called after infer_shape(...) since op compilation requires
         knowledge of tensor shapes.
 
+        Implementation note:
+        Kernels are requested from every node first and built afterwards,
+        so identical kernels are built once and the rest in parallel.
+
         Parameters
         ----------
         feed_shapes: node->shapes mapping for feed_dict nodes.
@@ -671,45 +1719,164 @@ class Executor(object):
         # initialize
         self.node_to_compiled_func = {}
 
-        for node in self.node_to_shape_map:
-            # no need to get complied fucntions for nodes in feed shape
-            if node in feed_shapes:
-                continue
+        node_to_shape_map = self.kernel_shapes(feed_shapes)
+        if self.lazy_compile:
+            self.start_background_compile(feed_shapes, node_to_shape_map)
+            return
 
-            # use the inferred shape
-            shape = self.node_to_shape_map[node]
+        with kernel_cache.deferred():
+            for node in node_to_shape_map:
+                # no need to get complied fucntions for nodes in feed shape
+                if node in feed_shapes:
+                    continue
 
-            # get the shapes of the inputs
-            inputs = node.inputs
-            input_shapes = []
-            for input in inputs:
-                input_shapes += [self.node_to_shape_map[input]]
+                # get the shapes of the inputs
+                inputs = node.inputs
+                input_shapes = []
+                for input in inputs:
+                    input_shapes += [node_to_shape_map[input]]
+
+                # get the complied function, or a request to build it
+                self.node_to_compiled_func[node] = node.op.compiled_func(
+                    node, input_shapes, self.tgt, self.tgt_host,
+                    dtype=self.node_to_dtype_map[node])
+
+        pending = [(node, func)
+            for node, func in self.node_to_compiled_func.items()
+            if isinstance(func, kernel_cache.KernelRequest)]
+        funcs = kernel_cache.build_requests(
+            [request for _, request in pending], self.compile_workers)
+        for (node, _), func in zip(pending, funcs):
+            self.node_to_compiled_func[node] = func
+
+    def start_background_compile(self, feed_shapes, node_to_shape_map):
+        """Compiles kernels on a background thread in topo order, adding them
+        to self.node_to_compiled_func as they become ready."""
+        cancelled = threading.Event()
+        node_to_compiled_func = self.node_to_compiled_func
+        node_to_dtype_map = self.node_to_dtype_map
+        topo_order = self.topo_order
+
+        def compile_in_topo_order():
+            for node in topo_order:
+                if cancelled.is_set():
+                    return
+                if node in feed_shapes:
+                    continue
+                input_shapes = [node_to_shape_map[n] for n in node.inputs]
+                node_to_compiled_func[node] = node.op.compiled_func(
+                    node, input_shapes, self.tgt, self.tgt_host,
+                    dtype=node_to_dtype_map[node])
+
+        self.compile_cancelled = cancelled
+        self.compile_thread = threading.Thread(target=compile_in_topo_order)
+        self.compile_thread.daemon = True
+        self.compile_thread.start()
 
-            # get the complied function
-            self.node_to_compiled_func[node] = node.op.compiled_func(
-                node, input_shapes, self.tgt, self.tgt_host)
+    def wait_for_kernels(self):
+        """Blocks until background compilation is done."""
+        if self.compile_thread is not None:
+            self.compile_thread.join()
 
-    def run(self, feed_dict, convert_to_numpy_ret_vals=False):
+    def prepare_plan(self, feed_shapes):
+        """Makes the plan for feed_shapes the current one.
+
+        Implementation note:
+        The state set up by infer_shape, memory_plan and compile_funcs is
+        saved in self.plans, so coming back to earlier feed shapes swaps the
+        saved state back in instead of planning and compiling again.
+
+        Parameters
+        ----------
+        feed_shapes: node->shapes mapping for feed_dict nodes.
+        """
+        key = frozenset(feed_shapes.items())
+        if self.feed_shapes is not None and \
+                key == frozenset(self.feed_shapes.items()):
+            return
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.plans.move_to_end(key)
+            for name, value in plan.items():
+                setattr(self, name, value)
+            return
+
+        if self.fuse:
+            # rewrites depending on shapes
+            self.output_nodes = fuse_sibling_matmuls(
+                self.graph_nodes, infer_shapes(
+                    find_topo_sort(self.graph_nodes), feed_shapes))
+            self.topo_order = schedule_updates(
+                find_topo_sort(self.output_nodes))
+        self.topo_order, self.node_to_aux = find_aux_outputs(self.topo_order)
+        self.fetch_orders = {}
+        self.infer_shape(feed_shapes)
+        self.feed_shapes = feed_shapes
+        self.memory_plan(feed_shapes)
+        self.compile_funcs(feed_shapes)
+        self.plans[key] = dict(
+            (name, getattr(self, name)) for name in self.plan_attributes)
+        self.evict_plans()
+
+    def evict_plans(self):
+        """Drops least recently used plans beyond max_plans or
+        plan_memory_budget, never the current plan."""
+        def over_budget():
+            if len(self.plans) > self.max_plans:
+                return True
+            return self.plan_memory_budget is not None and sum(
+                plan["storage_nbytes"] for plan in self.plans.values()
+            ) > self.plan_memory_budget
+
+        while len(self.plans) > 1 and over_budget():
+            _, plan = self.plans.popitem(last=False)
+            if plan["compile_cancelled"] is not None:
+                # its remaining kernels are no longer needed
+                plan["compile_cancelled"].set()
+
+    def fetch_order(self, fetches):
+        """Returns the nodes of topo_order needed for fetches, a list of nodes
+        of eval_node_list, and the output nodes computing them.
+
+        Implementation note:
+        The nodes keep their order in topo_order, so the storage plan of the
+        whole graph stays valid for them.
+        """
+        if fetches is None:
+            return self.topo_order, self.output_nodes
+        indices = tuple(self.eval_node_list.index(n) for n in fetches)
+        outputs = [self.output_nodes[i] for i in indices]
+        if indices not in self.fetch_orders:
+            needed = set(find_topo_sort(outputs))
+            self.fetch_orders[indices] = [
+                n for n in self.topo_order if n in needed]
+        return self.fetch_orders[indices], outputs
+
+    def run(self, feed_dict, convert_to_numpy_ret_vals=False, trace=None,
+            fetches=None):
         """
         Parameters
         ----------
         feed_dict: a dictionary of node->np.ndarray supplied by user.
         convert_to_numpy_ret_vals: whether to convert ret vals to np.array.
+        trace: optional scheduler_sim.Trace, every node computed is recorded
+            as a push reading its inputs and mutating itself, together with
+            its measured run time.
+        fetches: nodes of eval_node_list to compute, default is all of them.
+            Only the nodes they depend on are computed, e.g. a forward pass
+            when fetching the prediction of a training graph.
 
         Returns
         -------
-        A list of values for nodes in eval_node_list. tvm.nd.array or np.ndarray.
+        A list of values for nodes in fetches. tvm.nd.array or np.ndarray.
         """
-        def are_feed_shapes_equal(sa, sb):
-            if (not isinstance(sa, dict)) or (not isinstance(sb, dict)):
-                return False
-            unmatched_item = set(sa.items()) ^ set(sb.items())
-            return len(unmatched_item) == 0
-
         node_to_val_map = {}
         for node, value in feed_dict.items():
             assert isinstance(value, tvm.ndarray.NDArray),\
                 "feed_dict value type not supported"
+            assert value.dtype == self.dtype, \
+                "feed_dict value of %s is %s, not %s" % (
+                    node.name, value.dtype, self.dtype)
             node_to_val_map[node] = value
 
         # collect shapes for all placeholders
@@ -717,44 +1884,144 @@ class Executor(object):
         for node in node_to_val_map:
             feed_shapes[node] = node_to_val_map[node].shape
 
-        # infer shape if feed_shapes changed since last run
+        # switch plans if feed_shapes changed since last run
         # e.g. call run() on test data after trainng
-        if (not are_feed_shapes_equal(feed_shapes, self.feed_shapes)):
-            self.infer_shape(feed_shapes)
-            self.feed_shapes = feed_shapes
-            self.memory_plan(feed_shapes)
-            self.compile_funcs(feed_shapes)
+        self.prepare_plan(feed_shapes)
+        topo_order, output_nodes = self.fetch_order(fetches)
+
+        if trace is not None:
+            node_to_index = dict(
+                (n, i) for i, n in enumerate(topo_order))
+            trace_tag = lambda n: "%s@%d" % (n.name, node_to_index[n])
 
         # Traverse graph in topo order and compute values for all nodes.
-        for node in self.topo_order:
+        for node in topo_order:
             if node in node_to_val_map:
                 # Skip placeholder nodes. Values already provided by feed_dict.
                 continue
+            if is_precomputed(node):
+                node_to_val_map[node] = self.node_to_arr_map[node]
+                continue
             input_vals = [node_to_val_map[n] for n in node.inputs]
-            node_val = self.node_to_arr_map[node]
+            node_val = self.output_buffer(node, node_to_val_map)
+            aux_nodes = self.node_to_aux.get(node, [])
+            updated = [node.inputs[i] for i in node.op.updated_inputs(node)]
+            if trace is not None:
+                start_time = time.time()
             # node_val is modified in-place
-            node.op.compute(
-                node, input_vals, node_val, self.node_to_compiled_func[node])
+            if node in self.node_to_compiled_func:
+                func = self.node_to_compiled_func[node]
+                if len(aux_nodes) > 0:
+                    func = bind_aux_outputs(
+                        func, [self.node_to_arr_map[n] for n in aux_nodes])
+                node.op.compute(node, input_vals, node_val, func)
+            else:
+                # kernel still compiling in the background
+                numpy_vals = node.op.numpy_compute(
+                    node, [val.asnumpy() for val in input_vals])
+                if len(updated) > 0:
+                    copy_updates(node, input_vals, numpy_vals)
+                else:
+                    if len(aux_nodes) == 0:
+                        numpy_vals = [numpy_vals]
+                    for n, numpy_val in zip([node] + aux_nodes, numpy_vals):
+                        out = self.node_to_arr_map[n]
+                        out.copyfrom(np.asarray(
+                            numpy_val, dtype=out.dtype).reshape(out.shape))
+            if trace is not None:
+                trace.add(node.name, [trace_tag(n) for n in node.inputs],
+                    [trace_tag(n) for n in [node] + aux_nodes + updated],
+                    time.time() - start_time)
             node_to_val_map[node] = node_val
         # Collect node values.
         if convert_to_numpy_ret_vals:
-            return [node_to_val_map[n].asnumpy() for n in self.eval_node_list]
-        return [node_to_val_map[n] for n in self.eval_node_list]
+            return [node_to_val_map[n].asnumpy() for n in output_nodes]
+        return [node_to_val_map[n] for n in output_nodes]
+
+    def output_buffer(self, node, node_to_val_map):
+        """The buffer node writes its value to.
 
-    def run_with_dependency_engine(self, feed_dict, convert_to_numpy_ret_vals=False):
+        Implementation note:
+        Nodes updating inputs in place write to the buffer of an input, which
+        is a feed_dict value or optimizer state, so it is known before any
+        node has run.
         """
-        Like run(), but with the dependency engine.
+        updated = node.op.updated_inputs(node)
+        if len(updated) > 0:
+            return node_to_val_map[node.inputs[updated[0]]]
+        return self.node_to_arr_map[node]
+
+    def bind(self, feed_dict, fetches=None):
+        """Lowers the graph to a flat list of kernel calls on fixed buffers.
+
+        Implementation note:
+        The plan, kernels and argument buffers are resolved once here, so
+        calling the returned BoundRun only loops over (kernel, arguments)
+        pairs. It reads the arrays of feed_dict, so new inputs are copied into
+        them (e.g. with copyfrom) instead of passed in.
+
+        Parameters
+        ----------
+        feed_dict: a dictionary of node->tvm.nd.array the run reads from.
+        fetches: nodes of eval_node_list to compute, default is all of them.
+
+        Returns
+        -------
+        A BoundRun, calling it returns a list of tvm.nd.array for fetches.
         """
-        def are_feed_shapes_equal(sa, sb):
-            if (not isinstance(sa, dict)) or (not isinstance(sb, dict)):
-                return False
-            unmatched_item = set(sa.items()) ^ set(sb.items())
-            return len(unmatched_item) == 0
+        node_to_val_map = {}
+        for node, value in feed_dict.items():
+            assert isinstance(value, tvm.ndarray.NDArray),\
+                "feed_dict value type not supported"
+            assert value.dtype == self.dtype, \
+                "feed_dict value of %s is %s, not %s" % (
+                    node.name, value.dtype, self.dtype)
+            node_to_val_map[node] = value
+        self.prepare_plan(dict(
+            (node, value.shape) for node, value in node_to_val_map.items()))
+        topo_order, output_nodes = self.fetch_order(fetches)
+        # a bound run calls compiled functions only
+        self.wait_for_kernels()
+
+        steps = []
+        for node in topo_order:
+            if node in node_to_val_map:
+                continue
+            if is_precomputed(node):
+                node_to_val_map[node] = self.node_to_arr_map[node]
+                continue
+            input_vals = [node_to_val_map[n] for n in node.inputs]
+            node_val = self.output_buffer(node, node_to_val_map)
+            node_to_val_map[node] = node_val
+            aux_vals = [self.node_to_arr_map[n]
+                        for n in self.node_to_aux.get(node, [])]
+            func = self.node_to_compiled_func[node]
+            args = node.op.kernel_args(node, input_vals, node_val)
+            if args is not None:
+                steps.append((func, tuple(args) + tuple(aux_vals)))
+            else:
+                if len(aux_vals) > 0:
+                    func = bind_aux_outputs(func, aux_vals)
+                steps.append((functools.partial(
+                    node.op.compute, node, input_vals, node_val, func), ()))
+        return BoundRun(steps, [node_to_val_map[n] for n in output_nodes])
+
+    def run_with_dependency_engine(self, feed_dict,
+                                   convert_to_numpy_ret_vals=False,
+                                   trace=None, fetches=None):
+        """
+        Like run(), but with the dependency engine.
 
+        A trace records every push with the tags of run(), the run time of
+        a push is measured when the engine calls it.
+        """
         node_to_val_map = {}
         for node, value in feed_dict.items():
             assert isinstance(value, tvm.ndarray.NDArray),\
                 "feed_dict value type not supported"
+            assert value.dtype == self.dtype, \
+                "feed_dict value of %s is %s, not %s" % (
+                    node.name, value.dtype, self.dtype)
             node_to_val_map[node] = value
 
         # collect shapes for all placeholders
@@ -762,38 +2029,58 @@ class Executor(object):
         for node in node_to_val_map:
             feed_shapes[node] = node_to_val_map[node].shape
 
-        # infer shape if feed_shapes changed since last run
+        # switch plans if feed_shapes changed since last run
         # e.g. call run() on test data after trainng
-        if (not are_feed_shapes_equal(feed_shapes, self.feed_shapes)):
-            self.infer_shape(feed_shapes)
-            self.feed_shapes = feed_shapes
-            self.memory_plan(feed_shapes)
-            self.compile_funcs(feed_shapes)
+        self.prepare_plan(feed_shapes)
+        topo_order, output_nodes = self.fetch_order(fetches)
+        # engine callbacks call compiled functions only
+        self.wait_for_kernels()
+
+        if trace is not None:
+            node_to_index = dict(
+                (n, i) for i, n in enumerate(topo_order))
+            trace_tag = lambda n: "%s@%d" % (n.name, node_to_index[n])
 
         def get_resource_tag(n):
-            try:
-                return n.__resource_tag__
-            except AttributeError:
-                t = self.engine.new_variable()
-                n.__resource_tag__ = t
-                return t
+            # nodes sharing storage share the tag, so that writing a storage
+            # waits for every read of its previous user
+            if n in self.node_to_storage:
+                key = ("storage", self.node_to_storage[n])
+            else:
+                key = ("node", n)
+            if key not in self.resource_tags:
+                self.resource_tags[key] = self.engine.new_variable()
+            return self.resource_tags[key]
 
         seen_tuples = []
         
         with self.engine.threaded_executor():
             # Traverse graph in topo order and compute values for all nodes.
 
-            for node in self.topo_order:
+            for node in topo_order:
                 if node in node_to_val_map: #  or node in seen_nodes:
                     # Skip placeholder nodes. Values already provided by feed_dict.
                     continue
 
-                node_val = self.node_to_arr_map[node]
+                if is_precomputed(node):
+                    node_to_val_map[node] = self.node_to_arr_map[node]
+                    continue
+                node_val = self.output_buffer(node, node_to_val_map)
+                func = self.node_to_compiled_func[node]
+                aux_nodes = self.node_to_aux.get(node, [])
+                updated = [
+                    node.inputs[i] for i in node.op.updated_inputs(node)]
+                if len(aux_nodes) > 0:
+                    func = bind_aux_outputs(
+                        func, [self.node_to_arr_map[n] for n in aux_nodes])
+                if trace is not None:
+                    func = time_calls(func, trace.add(
+                        node.name, [trace_tag(n) for n in node.inputs],
+                        [trace_tag(n) for n in [node] + aux_nodes + updated]))
 
                 # Include a tuple of things to present to the callback, defined
                 #  in DependencyQueue.pyx.
-                callback_args = (node_to_val_map,
-                    node, node_val, self.node_to_compiled_func[node])
+                callback_args = (node_to_val_map, node, node_val, func)
 
                 # Funny but if we don't keep a reference to this tuple, it will
                 # get GC'd by Python before our C++ callback fires.
@@ -802,13 +2089,14 @@ class Executor(object):
                 self.engine.push(
                     callback_args,
                     [get_resource_tag(n) for n in node.inputs],
-                    [get_resource_tag(node)])
+                    [get_resource_tag(n)
+                     for n in [node] + aux_nodes + updated])
 
         # Collect node values.
         if convert_to_numpy_ret_vals:
-            return [node_to_val_map[n].asnumpy() for n in self.eval_node_list]
+            return [node_to_val_map[n].asnumpy() for n in output_nodes]
 
-        return [node_to_val_map[n] for n in self.eval_node_list]
+        return [node_to_val_map[n] for n in output_nodes]
 
 
 def gradients(output_node, node_list):
@@ -843,6 +2131,428 @@ def gradients(output_node, node_list):
     grad_node_list = [node_to_output_grad[node] for node in node_list]
     return grad_node_list
 
+##################
+# Graph Rewrites #
+##################
+
+
+def rewrite_graph(node_list, replace):
+    """Rebuilds the graph ending in node_list bottom up.
+
+    replace(node, rewrite) returns the node taking the place of node, or
+    None to keep it, where rewrite(n) returns the node taking the place of
+    any other node n. Nodes whose inputs changed are copied, so the original
+    graph is left untouched and feed_dict nodes stay the same.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    new_nodes = {}
+
+    def rewrite(node):
+        if node in new_nodes:
+            return new_nodes[node]
+        new_node = replace(node, rewrite)
+        if new_node is None:
+            new_node = node
+            inputs = [rewrite(n) for n in node.inputs]
+            if any(a is not b for a, b in zip(inputs, node.inputs)):
+                new_node = copy.copy(node)
+                new_node.inputs = inputs
+        new_nodes[node] = new_node
+        return new_node
+
+    return [rewrite(node) for node in node_list]
+
+
+def merge_aux_outputs(node_list):
+    """Replaces AuxOutputOp nodes holding the same output of the same node,
+    e.g. the softmax of a loss from separate gradients() calls, with the
+    first of them. The kernel of a node writes each aux output once.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    first = {}
+
+    def replace(node, rewrite):
+        if not isinstance(node.op, AuxOutputOp):
+            return None
+        key = (rewrite(node.inputs[0]), node.aux_index)
+        if key not in first:
+            first[key] = node
+            return None
+        # already rewritten, its inputs can't contain node
+        return rewrite(first[key])
+
+    return rewrite_graph(node_list, replace)
+
+
+def simplify_graph(node_list):
+    """Cleans up graphs built by gradients() before they are planned.
+
+    Identities like x*1, x+0 and x+zeroslike(y) are removed, products with
+    zeros become zeroslike nodes, adds of oneslike nodes become constant
+    adds, chains of constant adds or multiplies are folded into one node and
+    nodes computing the same op on the same inputs are merged. Nodes no
+    longer needed drop out of the graph.
+
+    Turning x*0 into zeros is not an IEEE identity: if x holds NaN or inf
+    the product would be NaN. The rewrite is intentional, as the zeros
+    come from gradients() and mean "no contribution". Build the executor
+    with simplify=False to keep NaNs propagating.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    merged = {}
+
+    def replace(node, rewrite):
+        if isinstance(node.op, PlaceholderOp):
+            return node
+        new_node = simplify_node(node, [rewrite(n) for n in node.inputs])
+        # e.g. folding constants may leave x+0
+        while new_node is not node:
+            node = new_node
+            new_node = simplify_node(node, node.inputs)
+        key = cse_key(new_node)
+        if key is None:
+            return new_node
+        return merged.setdefault(key, new_node)
+
+    return rewrite_graph(node_list, replace)
+
+
+def simplify_node(node, inputs):
+    """Returns the simplest node computing node from the given inputs."""
+    is_zeros = lambda n: isinstance(n.op, ZerosLikeOp)
+    is_ones = lambda n: isinstance(n.op, OnesLikeOp)
+    op = node.op
+    if isinstance(op, AddByConstOp):
+        if node.const_attr == 0:
+            return inputs[0]
+        if isinstance(inputs[0].op, AddByConstOp):
+            return add_byconst_op(
+                inputs[0].inputs[0], inputs[0].const_attr + node.const_attr)
+    elif isinstance(op, MulByConstOp):
+        if node.const_attr == 1:
+            return inputs[0]
+        if node.const_attr == 0 or is_zeros(inputs[0]):
+            return zeroslike_op(inputs[0])
+        if isinstance(inputs[0].op, MulByConstOp):
+            return mul_byconst_op(
+                inputs[0].inputs[0], inputs[0].const_attr * node.const_attr)
+    elif isinstance(op, AddOp):
+        # both inputs have the same shape, see AddOp.compute
+        if is_zeros(inputs[1]):
+            return inputs[0]
+        if is_zeros(inputs[0]):
+            return inputs[1]
+        if is_ones(inputs[1]):
+            return add_byconst_op(inputs[0], 1.0)
+        if is_ones(inputs[0]):
+            return add_byconst_op(inputs[1], 1.0)
+    elif isinstance(op, MulOp):
+        if is_ones(inputs[1]):
+            return inputs[0]
+        if is_ones(inputs[0]):
+            return inputs[1]
+        if is_zeros(inputs[0]) or is_zeros(inputs[1]):
+            return zeroslike_op(inputs[0])
+    elif isinstance(op, BroadcastToOp):
+        if is_zeros(inputs[0]):
+            return zeroslike_op(inputs[1])
+        if is_ones(inputs[0]):
+            return oneslike_op(inputs[1])
+    elif isinstance(op, ReluGradientOp):
+        if is_zeros(inputs[1]):
+            return zeroslike_op(inputs[0])
+    elif isinstance(op, (ZerosLikeOp, OnesLikeOp)):
+        # only the shape of the input matters
+        if is_zeros(inputs[0]) or is_ones(inputs[0]):
+            inputs = inputs[0].inputs
+
+    if all(a is b for a, b in zip(inputs, node.inputs)):
+        return node
+    new_node = copy.copy(node)
+    new_node.inputs = list(inputs)
+    return new_node
+
+
+def cse_key(node):
+    """Key equal for nodes computing the same value, None if unsure."""
+    if isinstance(node.op, (PlaceholderOp, OptimizerStateOp)):
+        # every variable and optimizer state has its own value
+        return None
+    if len(node.op.updated_inputs(node)) > 0:
+        # merging two updates would apply only one of them
+        return None
+    inputs = tuple(node.inputs)
+    if isinstance(node.op, (AddOp, MulOp)):
+        inputs = tuple(sorted(inputs, key=id))
+    attrs = tuple(sorted((name, value) for name, value in vars(node).items()
+                         if name not in ("inputs", "name")))
+    key = (node.op, inputs, attrs)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def find_consumers(topo_order):
+    """Returns a dict from node to the set of nodes reading it."""
+    consumers = dict((node, set()) for node in topo_order)
+    for node in topo_order:
+        for n in node.inputs:
+            consumers[n].add(node)
+    return consumers
+
+
+def fuse_dense(node_list):
+    """Replaces dense layers, matmul(X, W) + broadcastto(b, ...) optionally
+    followed by relu, with DenseOp nodes.
+
+    The matmul and the broadcast may only be read by the pattern itself, and
+    relu is only folded in when nothing else reads its input, e.g. not when
+    relu_gradient needs the pre-activation.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    topo_order = find_topo_sort(node_list)
+    consumers = find_consumers(topo_order)
+
+    def is_internal(node, readers):
+        return node not in node_list and consumers[node] <= set(readers)
+
+    def match_bias_add(node):
+        """(matmul, bias) if node is matmul + broadcastto(bias, matmul)."""
+        if isinstance(node.op, BiasAddOp):
+            mm = node.inputs[0]
+            if isinstance(mm.op, MatMulOp) and is_internal(mm, [node]):
+                return mm, node.inputs[1]
+            return None
+        if not isinstance(node.op, AddOp):
+            return None
+        for mm, bc in (node.inputs, node.inputs[::-1]):
+            if isinstance(mm.op, MatMulOp) and \
+                    isinstance(bc.op, BroadcastToOp) and \
+                    bc.inputs[1] is mm and \
+                    is_internal(mm, [node, bc]) and is_internal(bc, [node]):
+                return mm, bc.inputs[0]
+        return None
+
+    matches = {}
+    for node in topo_order:
+        if isinstance(node.op, ReluOp):
+            match = match_bias_add(node.inputs[0])
+            if match is not None and is_internal(node.inputs[0], [node]):
+                matches[node] = match + (True,)
+                # the bias add is part of the relu's match
+                matches.pop(node.inputs[0], None)
+                continue
+        match = match_bias_add(node)
+        if match is not None:
+            matches[node] = match + (False,)
+
+    def replace(node, rewrite):
+        if node not in matches:
+            return None
+        mm, bias, relu = matches[node]
+        return dense_op(rewrite(mm.inputs[0]), rewrite(mm.inputs[1]),
+            rewrite(bias), trans_A=mm.matmul_attr_trans_A,
+            trans_B=mm.matmul_attr_trans_B, relu=relu)
+
+    return rewrite_graph(node_list, replace)
+
+
+def fuse_bias_add(node_list):
+    """Replaces x + broadcastto(b, x) with BiasAddOp nodes reading b
+    directly. The broadcast drops out of the graph unless something else
+    reads it.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    def replace(node, rewrite):
+        if not isinstance(node.op, AddOp):
+            return None
+        for x, bc in (node.inputs, node.inputs[::-1]):
+            if isinstance(bc.op, BroadcastToOp) and bc.inputs[1] is x:
+                return bias_add_op(rewrite(x), rewrite(bc.inputs[0]))
+        return None
+
+    return rewrite_graph(node_list, replace)
+
+
+def fuse_sibling_matmuls(node_list, node_to_shape_map):
+    """Computes matmuls sharing an operand, e.g. A B, A C and A D, with one
+    MultiMatMulOp node reading the shared operand once. The products after
+    the first become AuxOutputOp nodes of it.
+
+    Siblings need the same transpose flags, and their other operands the same
+    shape in node_to_shape_map. A matmul whose other operand depends on a
+    sibling stays separate, and so does a group that would depend on another
+    group depending on it.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    topo_order = find_topo_sort(node_list)
+    candidates = OrderedDict()
+    for node in topo_order:
+        if not isinstance(node.op, MatMulOp):
+            continue
+        for shared_left in (True, False):
+            shared, other = node.inputs if shared_left else node.inputs[::-1]
+            key = (shared, shared_left, node.matmul_attr_trans_A,
+                   node.matmul_attr_trans_B, node_to_shape_map[other])
+            candidates.setdefault(key, []).append(node)
+
+    ancestors = {}
+    def depends_on(node, target):
+        if node not in ancestors:
+            ancestors[node] = set(find_topo_sort([node]))
+        return target in ancestors[node]
+
+    def has_cycle():
+        """Whether computing every group of members with one node makes the
+        graph cyclic."""
+        def rep(node):
+            return members[node][1][0] if node in members else node
+
+        def inputs(node):
+            nodes = members[node][1] if node in members else [node]
+            return [rep(n) for m in nodes for n in m.inputs]
+
+        # iterative DFS, 1 while on the stack, 2 when done
+        state = {}
+        for start in topo_order:
+            start = rep(start)
+            if start in state:
+                continue
+            state[start] = 1
+            stack = [(start, iter(inputs(start)))]
+            while stack:
+                node, remaining = stack[-1]
+                for n in remaining:
+                    if state.get(n) == 1:
+                        return True
+                    if n not in state:
+                        state[n] = 1
+                        stack.append((n, iter(inputs(n))))
+                        break
+                else:
+                    state[node] = 2
+                    stack.pop()
+        return False
+
+    # biggest groups first, every matmul joins one group
+    members = {}
+    for key, nodes in sorted(candidates.items(), key=lambda kv: -len(kv[1])):
+        shared_left = key[1]
+        other = lambda n: n.inputs[1] if shared_left else n.inputs[0]
+        group = []
+        for node in nodes:
+            if node in members or any(depends_on(other(node), m) or
+                    depends_on(other(m), node) for m in group):
+                continue
+            group.append(node)
+        if len(group) > 1:
+            for index, node in enumerate(group):
+                members[node] = (key, group, index)
+            # e.g. A B, A relu(D E) and D E, D relu(A B)
+            if has_cycle():
+                for node in group:
+                    del members[node]
+
+    producers = {}
+    def replace(node, rewrite):
+        if node not in members:
+            return None
+        key, group, index = members[node]
+        shared, shared_left = key[0], key[1]
+        if group[0] not in producers:
+            others = [n.inputs[1] if shared_left else n.inputs[0]
+                      for n in group]
+            producers[group[0]] = multi_matmul_op(
+                rewrite(shared), [rewrite(n) for n in others],
+                shared_left=shared_left, trans_A=key[2], trans_B=key[3])
+        producer = producers[group[0]]
+        if index == 0:
+            return producer
+        return aux_output_op(producer, index)
+
+    return rewrite_graph(node_list, replace)
+
+
+def fuse_elementwise(node_list):
+    """Merges groups of elementwise nodes into FusedElementwiseOp nodes, so
+    that a chain like relu(matmul + broadcastto(b)) runs as one kernel after
+    the matmul and its intermediate values are never stored.
+
+    A node joins the group of its consumer if all its consumers are in the
+    group, and nodes in node_list are never merged into a consumer. A
+    ReduceSumAxisZeroOp can only end a group, which then becomes a
+    FusedReduceSumAxisZeroOp node.
+
+    Returns
+    -------
+    The list of nodes taking the place of node_list.
+    """
+    topo_order = find_topo_sort(node_list)
+    consumers = find_consumers(topo_order)
+
+    # walk from the outputs, every group is rooted at its last node
+    roots = {}
+    grouped = set()
+    for root in reversed(topo_order):
+        if root in grouped or root.op.fused_kind is None:
+            continue
+        group = set([root])
+        changed = True
+        while changed:
+            changed = False
+            for node in list(group):
+                for n in node.inputs:
+                    if n in group or n in grouped or n in node_list or \
+                            n.op.fused_kind is None or \
+                            isinstance(n.op, ReduceSumAxisZeroOp):
+                        continue
+                    if consumers[n] <= group:
+                        group.add(n)
+                        changed = True
+        grouped |= group
+        if len(group) > 1:
+            roots[root] = [n for n in topo_order if n in group]
+
+    def replace(node, rewrite):
+        if node not in roots:
+            return None
+        fused_nodes = roots[node]
+        # inputs of the group, in order of first use
+        group_inputs = []
+        for fused in fused_nodes:
+            for n in fused.inputs:
+                if n not in fused_nodes and n not in group_inputs:
+                    group_inputs.append(n)
+        if isinstance(node.op, ReduceSumAxisZeroOp):
+            new_node = fused_reduce_sum_axis_zero_op(fused_nodes, group_inputs)
+        else:
+            new_node = fused_elementwise_op(fused_nodes, group_inputs)
+        new_node.inputs = [rewrite(n) for n in group_inputs]
+        return new_node
+
+    return rewrite_graph(node_list, replace)
+
+
 ##################
 # Helper Methods #
 ##################
@@ -874,6 +2584,120 @@ def topo_sort_dfs(node, visited, topo_order):
     topo_order.append(node)
 
 
+def find_aux_outputs(topo_order):
+    """Returns topo_order with a node for every aux output, and a dict from
+    node to its aux output nodes ordered by index.
+
+    The kernel of a node writes all of its outputs, so aux outputs nobody
+    reads get a node as well, right after their producer.
+    """
+    node_to_aux = {}
+    for node in topo_order:
+        if isinstance(node.op, AuxOutputOp):
+            aux = node_to_aux.setdefault(node.inputs[0], {})
+            assert node.aux_index not in aux, \
+                "duplicate aux output %s, see merge_aux_outputs" % node.name
+            aux[node.aux_index] = node
+
+    new_order = []
+    for node in topo_order:
+        new_order.append(node)
+        num_aux = node.op.num_aux_outputs(node)
+        if num_aux == 0:
+            continue
+        aux = node_to_aux.setdefault(node, {})
+        for index in range(1, num_aux + 1):
+            if index not in aux:
+                aux[index] = aux_output_op(node, index)
+                new_order.append(aux[index])
+    return new_order, dict(
+        (node, [aux[i] for i in sorted(aux)])
+        for node, aux in node_to_aux.items())
+
+
+def schedule_updates(topo_order):
+    """Moves nodes updating their inputs in place (see Op.updated_inputs)
+    right after the last node they have to wait for: their inputs and every
+    node reading the old value of an updated input. Updates then run as soon
+    as e.g. the gradient of their parameter is ready.
+    """
+    updates = [n for n in topo_order if len(n.op.updated_inputs(n)) > 0]
+    if len(updates) == 0:
+        return topo_order
+    update_set = set(updates)
+    readers = {}
+    for node in topo_order:
+        for n in node.inputs:
+            assert n not in update_set, \
+                "%s reads the update %s" % (node.name, n.name)
+            readers.setdefault(n, set()).add(node)
+
+    remaining = {}
+    unblocks = {}
+    for update in updates:
+        deps = set(update.inputs)
+        for i in update.op.updated_inputs(update):
+            deps.update(readers[update.inputs[i]])
+        deps -= update_set
+        remaining[update] = len(deps)
+        for n in deps:
+            unblocks.setdefault(n, []).append(update)
+
+    new_order = []
+    for node in topo_order:
+        if node in update_set:
+            continue
+        new_order.append(node)
+        for update in unblocks.get(node, ()):
+            remaining[update] -= 1
+            if remaining[update] == 0:
+                new_order.append(update)
+    return new_order
+
+
+def copy_updates(node, input_vals, numpy_vals):
+    """Writes the new values numpy_vals of the inputs node updates in place
+    into their buffers input_vals."""
+    for i, numpy_val in zip(node.op.updated_inputs(node), numpy_vals):
+        out = input_vals[i]
+        out.copyfrom(np.asarray(numpy_val, dtype=out.dtype).reshape(out.shape))
+
+
+def is_precomputed(node):
+    """True for nodes that are never computed by a run: aux outputs written
+    by their producer, constants filled by memory_plan and optimizer state
+    carried over from earlier runs."""
+    return isinstance(node.op, (AuxOutputOp, OptimizerStateOp)) or \
+        node.op.constant_value is not None
+
+
+def bind_aux_outputs(func, aux_vals):
+    """Returns func with the buffers of aux outputs appended to its
+    arguments."""
+    def func_with_aux(*args):
+        return func(*(list(args) + list(aux_vals)))
+    return func_with_aux
+
+
+def time_calls(func, record):
+    """Returns func adding its run time to the duration of a trace record."""
+    def timed_func(*args):
+        start_time = time.time()
+        try:
+            return func(*args)
+        finally:
+            record["duration"] += time.time() - start_time
+    return timed_func
+
+
+def storage_view(arr, shape):
+    """Returns arr itself if it has the given shape, else a view of its
+    leading elements with that shape."""
+    if tuple(arr.shape) == tuple(shape):
+        return arr
+    return arr._create_view(shape)
+
+
 def sum_node_list(node_list):
     """Custom sum func to avoid creating redundant nodes in Python sum func."""
     from operator import add
@@ -906,5 +2730,9 @@ def broadcast_rule(shape_a, shape_b):
         assert (shorter_shape[i] == longer_shape[i]) \
             or (shorter_shape[i] == 1) \
             or (longer_shape[i] == 1)
-        output_shape[i] = max(shorter_shape[i], longer_shape[i])
+        # no max(), dimensions may be symbolic
+        if shorter_shape[i] == 1:
+            output_shape[i] = longer_shape[i]
+        else:
+            output_shape[i] = shorter_shape[i]
     return tuple(output_shape)
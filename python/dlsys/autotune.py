@@ -0,0 +1,163 @@
+''' Schedule search for tvm_op.make_matrix_mul, persisted in a tuning log '''
+from __future__ import absolute_import
+
+import itertools
+import json
+import os
+import random
+import uuid
+from threading import RLock
+
+from .kernel_cache import normalize
+
+# search space of tune_matrix_mul, loop orders are tvm_op.MATMUL_LOOP_ORDERS
+BLOCK_SIZES_I = (8, 16, 32, 64, 100, 128)
+BLOCK_SIZES_J = (4, 8, 16, 32)
+RED_AXIS_SPLITS = (4, 8, 16, 32)
+
+
+class TuningLog(object):
+    """JSON file with the best schedule configuration measured per kernel.
+
+    Entries map a kernel key to {"config": [...], "time": seconds}. The file
+    is rewritten under a temporary name and renamed into place on every
+    update, so a reader never sees a partial log.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        with self.lock:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                # missing or unreadable, start over
+                self.entries = {}
+
+    def get(self, key):
+        """Returns the logged configuration as a tuple, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return tuple(entry["config"])
+
+    def put(self, key, config, time):
+        with self.lock:
+            self.entries[key] = {"config": list(config), "time": time}
+            self.save()
+
+    def save(self):
+        tmp_path = "%s.%d.%s.tmp" % (self.path, os.getpid(), uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Consulted by make_matrix_mul, enabled by pointing DLSYS_TUNING_LOG to a
+# file.
+tuning_log = None
+
+def set_tuning_log(path):
+    """Reads and writes tuning results at path, None disables the log."""
+    global tuning_log
+    tuning_log = None if path is None else TuningLog(path)
+
+if os.environ.get("DLSYS_TUNING_LOG"):
+    set_tuning_log(os.path.expanduser(os.environ["DLSYS_TUNING_LOG"]))
+
+
+def matmul_key(shapeA, transposeA, shapeB, transposeB, tgt, dtype):
+    """Tuning log key of a matmul. Tuning results are only valid for the
+    machine they were measured on, so logs are not meant to be shared."""
+    return repr(normalize(("make_matrix_mul", shapeA, transposeA, shapeB,
+                           transposeB, tgt, dtype)))
+
+
+def matmul_config(shapeA, transposeA, shapeB, transposeB, tgt, dtype):
+    """The schedule configuration make_matrix_mul, make_multi_matmul and
+    make_dense build with: the logged one if the shapes were tuned, else
+    tvm_op.DEFAULT_MATMUL_CONFIG."""
+    from . import tvm_op
+    log = tuning_log
+    if log is not None:
+        config = log.get(matmul_key(
+            shapeA, transposeA, shapeB, transposeB, tgt, dtype))
+        # logs may name loop orders that were renamed since
+        if config is not None and config[3] in tvm_op.MATMUL_LOOP_ORDERS:
+            return config
+    return tvm_op.DEFAULT_MATMUL_CONFIG
+
+
+def matmul_configs():
+    """Every configuration of the search space."""
+    from . import tvm_op
+    return list(itertools.product(BLOCK_SIZES_I, BLOCK_SIZES_J,
+        RED_AXIS_SPLITS, sorted(tvm_op.MATMUL_LOOP_ORDERS)))
+
+
+def tune_matrix_mul(shapeA, transposeA, shapeB, transposeB, tgt="llvm",
+                    tgt_host="llvm", dtype="float32", trials=32, number=10,
+                    seed=0):
+    """Measures schedule configurations of a matmul on this machine and
+    logs the fastest one in tuning_log, if it is enabled.
+
+    Parameters
+    ----------
+    trials: number of configurations measured, sampled from the search
+        space. The default and the currently logged configuration are
+        always among them. None measures the whole search space.
+    number: runs averaged per measurement.
+
+    Returns
+    -------
+    The fastest configuration and its run time in seconds.
+    """
+    import numpy as np
+    import tvm
+    from . import tvm_op
+
+    candidates = matmul_configs()
+    if trials is not None and trials < len(candidates):
+        candidates = random.Random(seed).sample(candidates, trials)
+    current = matmul_config(shapeA, transposeA, shapeB, transposeB, tgt, dtype)
+    for config in (tvm_op.DEFAULT_MATMUL_CONFIG, current):
+        if config not in candidates:
+            candidates.append(config)
+
+    ctx = tvm.context(tgt, 0)
+    shapeC = (shapeA[1] if transposeA else shapeA[0],
+              shapeB[0] if transposeB else shapeB[1])
+    rand = np.random.RandomState(seed)
+    args = [tvm.nd.array(rand.uniform(-1, 1, shapeA).astype(dtype), ctx=ctx),
+            tvm.nd.array(rand.uniform(-1, 1, shapeB).astype(dtype), ctx=ctx),
+            tvm.nd.array(np.zeros(shapeC, dtype=dtype), ctx=ctx)]
+
+    best_config, best_time = None, None
+    for config in candidates:
+        # built outside kernel_cache, most candidates are never used again
+        try:
+            f = tvm_op.make_tuned_matrix_mul.__wrapped__(
+                shapeA, transposeA, shapeB, transposeB, config, tgt,
+                tgt_host, "tune_matrix_mul", dtype)
+        except tvm.TVMError:
+            continue
+        time = f.time_evaluator(f.entry_name, ctx, number=number)(*args).mean
+        if best_time is None or time < best_time:
+            best_config, best_time = config, time
+
+    log = tuning_log
+    if log is not None:
+        log.put(matmul_key(shapeA, transposeA, shapeB, transposeB, tgt, dtype),
+                best_config, best_time)
+    return best_config, best_time
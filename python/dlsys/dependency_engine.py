@@ -7,7 +7,7 @@ from threading import Thread, Event, RLock, Lock, Condition
 from contextlib import contextmanager
 
 class DependencyEngine(object):
-    def __init__(self, concurrent_instructions = True):
+    def __init__(self, concurrent_instructions = True, trace = None):
         # This is a mapping of ResourceTag -> ResourceStateQueue
         self.resource_state_queues = {}
 
@@ -26,6 +26,10 @@ class DependencyEngine(object):
         else:
             self.running_instruction_thread_pool = None
 
+        # Optional scheduler_sim.Trace, records every push together with the
+        # measured run time of its instruction for offline simulation.
+        self.trace = trace
+
     def new_variable(self, name = None):
         rtag = ResourceTag(name)
 
@@ -38,7 +42,11 @@ class DependencyEngine(object):
 
         return rtag
 
-    def push(self, exec_func, read_tags, mutate_tags):
+    def push(self, exec_func, read_tags, mutate_tags, name = None):
+        if self.trace is not None:
+            exec_func = self.trace.record(
+                exec_func, read_tags, mutate_tags, name)
+
         # pending count is the number of unique tags
         pending_count = len(set(read_tags + mutate_tags))
         # create instruction based on given parameters
@@ -0,0 +1,381 @@
+''' A process-wide cache of compiled tvm kernels '''
+from __future__ import absolute_import
+
+import functools
+import glob
+import hashlib
+import importlib
+import inspect
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock, local
+
+class KernelCache(object):
+    """LRU cache from kernel key to the tvm module built for it.
+
+    A key identifies everything a build depends on: the builder (i.e. op
+    type), shapes, constants, transpose flags, dtype and targets, so nodes
+    and Executors asking for the same kernel share one tvm.build.
+    """
+    def __init__(self, capacity = 512):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached module or None, marking it recently used."""
+        with self.lock:
+            func = self.entries.get(key)
+            if func is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return func
+
+    def put(self, key, func):
+        with self.lock:
+            self.entries[key] = func
+            self.entries.move_to_end(key)
+            # evict least recently used kernels
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "KernelCache(%d/%d kernels, %d hits, %d misses)" % (
+            len(self.entries), self.capacity, self.hits, self.misses)
+
+
+class DiskKernelCache(object):
+    """Directory of exported kernel libraries shared between processes.
+
+    A kernel is stored as <digest>.so, where the digest hashes the kernel
+    key, the source of its builder's module (which holds the schedule
+    parameters) and the tvm version. Files are written under a temporary name and renamed
+    into place, so concurrent writers never expose a partial library and
+    the last rename wins. Once the directory grows beyond max_bytes the
+    least recently used libraries are deleted.
+    """
+    def __init__(self, directory, max_bytes = 1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process created it first
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, key, builder_digest):
+        import tvm
+        digest = hashlib.sha256(("%r|%s|%s" % (
+            key, builder_digest, tvm.__version__)).encode()).hexdigest()
+        return os.path.join(self.directory, digest + ".so")
+
+    def load(self, key, builder_digest):
+        """Returns the stored module or None."""
+        import tvm
+        path = self.path(key, builder_digest)
+        if not os.path.isfile(path):
+            return None
+        try:
+            func = tvm.module.load(path)
+        except Exception:
+            # e.g. evicted by another process in between, just rebuild
+            return None
+        try:
+            # mark as recently used for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return func
+
+    def store(self, key, builder_digest, func):
+        try:
+            export_library(func, self.path(key, builder_digest))
+        except Exception:
+            # the cache is an optimization, never fail the build because of it
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, "*.so*")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if path.endswith(".tmp"):
+                # left behind by a process that died while exporting
+                if now - stat.st_mtime > 3600:
+                    self.remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another process already
+            pass
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, "*.so*")):
+            self.remove(path)
+
+
+def export_library(func, path):
+    """Exports a built module to path atomically: written under a unique
+    temporary name first, then renamed into place."""
+    tmp_path = "%s.%d.%s.tmp" % (path, os.getpid(), uuid.uuid4().hex)
+    try:
+        func.export_library(tmp_path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+kernel_cache = KernelCache(
+    int(os.environ.get("DLSYS_KERNEL_CACHE_CAPACITY", 512)))
+
+# Persistent cache, enabled by pointing DLSYS_KERNEL_CACHE to a directory.
+disk_cache = None
+
+def set_disk_cache(directory, max_bytes = None):
+    """Enables the on-disk kernel cache in directory, None disables it."""
+    global disk_cache
+    if directory is None:
+        disk_cache = None
+        return
+    if max_bytes is None:
+        max_bytes = int(float(os.environ.get(
+            "DLSYS_KERNEL_CACHE_SIZE_MB", 1024)) * (1 << 20))
+    disk_cache = DiskKernelCache(directory, max_bytes)
+
+if os.environ.get("DLSYS_KERNEL_CACHE"):
+    set_disk_cache(os.path.expanduser(os.environ["DLSYS_KERNEL_CACHE"]))
+
+
+def normalize(value):
+    """Turns builder arguments into hashable, comparable key parts."""
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, str):
+        return value
+    # numpy scalars and the like
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def make_key(builder_name, arguments):
+    """Key of a builder call, func_name only names the symbol so it is left
+    out."""
+    return (builder_name,) + tuple(
+        (name, normalize(value)) for name, value in arguments.items()
+        if name != "func_name")
+
+
+class KernelRequest(object):
+    """A builder call that was deferred instead of built, see deferred()."""
+    def __init__(self, builder, builder_digest, key, args, kwargs):
+        self.module_name = builder.__module__
+        self.builder_name = builder.__name__
+        self.builder_digest = builder_digest
+        self.key = key
+        self.args = args
+        self.kwargs = kwargs
+
+    def builder(self):
+        """The undecorated builder."""
+        module = importlib.import_module(self.module_name)
+        return getattr(module, self.builder_name).__wrapped__
+
+    def build(self):
+        func = self.builder()(*self.args, **self.kwargs)
+        if disk_cache is not None:
+            disk_cache.store(self.key, self.builder_digest, func)
+        return func
+
+    def __repr__(self):
+        return "KernelRequest(%s)" % (self.key,)
+
+
+_thread_state = local()
+
+@contextmanager
+def deferred():
+    """Within this context, cached builders called from this thread return
+    a KernelRequest instead of building kernels missing from kernel_cache.
+    Pass the requests to build_requests to build them all at once."""
+    _thread_state.deferred = True
+    try:
+        yield
+    finally:
+        _thread_state.deferred = False
+
+
+def _build_and_export(module_name, builder_name, args, kwargs, path):
+    """Runs in a worker process: builds a kernel and exports it to path."""
+    module = importlib.import_module(module_name)
+    func = getattr(module, builder_name).__wrapped__(*args, **kwargs)
+    export_library(func, path)
+    return path
+
+
+def build_requests(requests, num_workers = 1):
+    """Builds the kernels of a list of KernelRequests.
+
+    Identical requests are merged before anything is built, kernels found in
+    disk_cache are loaded, and the rest is compiled in this process, or with
+    num_workers > 1 by a pool of that many processes, since tvm.build holds
+    the GIL most of the time. Workers are spawned rather than forked, as the
+    caller may have threads running (e.g. a lazy_compile Executor), and ship
+    the kernels back as exported libraries.
+
+    Returns
+    -------
+    The built kernels, in the order of requests.
+    """
+    unique = OrderedDict()
+    for request in requests:
+        unique.setdefault(request.key, request)
+
+    built = {}
+    todo = []
+    for key, request in unique.items():
+        func = kernel_cache.get(key)
+        if func is None and disk_cache is not None:
+            func = disk_cache.load(key, request.builder_digest)
+        if func is None:
+            todo.append(request)
+        else:
+            built[key] = func
+
+    if len(todo) > 1 and num_workers > 1:
+        built.update(_build_in_processes(todo, num_workers))
+    else:
+        for request in todo:
+            built[request.key] = request.build()
+
+    for key, func in built.items():
+        kernel_cache.put(key, func)
+    return [built[request.key] for request in requests]
+
+
+def _build_in_processes(requests, num_workers):
+    import multiprocessing
+    import tvm
+    from concurrent.futures import ProcessPoolExecutor
+
+    disk = disk_cache
+    built = {}
+    tmp_dir = tempfile.mkdtemp(prefix="dlsys_kernels_")
+    try:
+        # forking a process with other threads running can deadlock it
+        with ProcessPoolExecutor(min(num_workers, len(requests)),
+                mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = []
+            for i, request in enumerate(requests):
+                # with a disk cache the workers write straight into it
+                if disk is not None:
+                    path = disk.path(request.key, request.builder_digest)
+                else:
+                    path = os.path.join(tmp_dir, "%d.so" % i)
+                futures.append((request, pool.submit(_build_and_export,
+                    request.module_name, request.builder_name,
+                    request.args, request.kwargs, path)))
+
+            for request, future in futures:
+                try:
+                    built[request.key] = tvm.module.load(future.result())
+                except Exception:
+                    # e.g. no compiler to export with, build it here instead
+                    built[request.key] = request.build()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if disk is not None:
+        disk.evict()
+    return built
+
+
+def source_digest(func):
+    """Hash of the module defining func, which covers the schedule parameters
+    and helpers of a builder."""
+    try:
+        source = inspect.getsource(inspect.getmodule(func))
+    except (IOError, TypeError):
+        source = repr(func.__code__.co_code)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def cached(builder):
+    """Decorator routing a tvm_op.make_* builder through kernel_cache, and
+    through disk_cache when it is enabled.
+
+    The undecorated builder stays reachable as builder.__wrapped__.
+    """
+    signature = inspect.signature(builder)
+    builder_digest = source_digest(builder)
+
+    @functools.wraps(builder)
+    def cached_builder(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = make_key(builder.__name__, bound.arguments)
+        func = kernel_cache.get(key)
+        if func is not None:
+            return func
+        if getattr(_thread_state, "deferred", False):
+            return KernelRequest(builder, builder_digest, key, args, kwargs)
+
+        disk = disk_cache
+        if disk is not None:
+            func = disk.load(key, builder_digest)
+        if func is None:
+            # build outside the lock, a duplicate build is cheaper than
+            # serializing every compilation
+            func = builder(*args, **kwargs)
+            if disk is not None:
+                disk.store(key, builder_digest, func)
+        kernel_cache.put(key, func)
+        return func
+
+    return cached_builder
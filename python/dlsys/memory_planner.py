@@ -0,0 +1,149 @@
+''' Static storage planning for the Executor based on liveness analysis '''
+from __future__ import absolute_import
+
+class StoragePlan(object):
+    """Result of plan_storage.
+
+        Instance variables
+        ------------------
+        self.node_to_storage: dict from node to the id of the storage it uses.
+        self.storage_sizes: size of every storage, indexed by storage id.
+        self.storage_keys: sharing key of every storage, indexed by storage id.
+    """
+    def __init__(self):
+        self.node_to_storage = {}
+        self.storage_sizes = []
+        self.storage_keys = []
+
+    def total_size(self):
+        return sum(self.storage_sizes)
+
+    def __repr__(self):
+        return "StoragePlan(%d nodes, %d storages, total size %d)" % (
+            len(self.node_to_storage), len(self.storage_sizes),
+            self.total_size())
+
+
+def find_last_uses(topo_order, keep_nodes=()):
+    """Liveness analysis over an execution order.
+
+    Returns
+    -------
+    A dict from node to the index in topo_order of the last node reading it.
+    Nodes in keep_nodes never die and map to len(topo_order).
+    """
+    last_use = {}
+    for i, node in enumerate(topo_order):
+        # a value nobody reads dies right after it is produced
+        last_use[node] = i
+        for n in node.inputs:
+            last_use[n] = i
+    for node in keep_nodes:
+        last_use[node] = len(topo_order)
+    return last_use
+
+
+def plan_storage(topo_order, node_to_size, node_to_key, keep_nodes=(),
+                 best_fit=False, inplace_nodes=(), aux_outputs=None):
+    """Assigns storage to nodes so that nodes with disjoint lifetimes share.
+
+    A node is live from the step producing it until the last step reading it.
+    Walking topo_order, a node takes a free storage with the same key,
+    and its inputs release their storage after it has been computed, so an
+    output never aliases one of its own inputs unless it is computed in place.
+
+    Parameters
+    ----------
+    topo_order: nodes in the order they are computed.
+    node_to_size: dict from node to its size, for every node that needs
+        storage. Nodes not in the dict (e.g. feed_dict nodes) are ignored.
+    node_to_key: dict from node to a sharing key, only storages with the same
+        key are shared, e.g. (shape, dtype) for exact reuse.
+    keep_nodes: nodes whose value must survive the whole run, e.g. outputs.
+    best_fit: if False, a free storage is reused only by a node of the same
+        size. If True, storages behave like an arena: the smallest free
+        storage at least as big as the node is taken, and when none is big
+        enough the biggest free storage grows instead of allocating new one.
+    inplace_nodes: nodes whose kernel may write into the buffer of one of
+        their inputs. Such a node takes over the storage of an input that dies
+        at this node and has the same key and size.
+    aux_outputs: dict from node to the nodes holding its other outputs. They
+        are written together with node, so they get their storage at the
+        step of node, before any input of node is released.
+
+    Returns
+    -------
+    A StoragePlan.
+    """
+    aux_outputs = aux_outputs or {}
+    plan = StoragePlan()
+    last_use = find_last_uses(topo_order, keep_nodes)
+    # free storage ids, per sharing key
+    free = {}
+    # number of live nodes using each storage
+    storage_users = []
+
+    def allocate(node):
+        size = node_to_size[node]
+        key = node_to_key[node]
+        candidates = free.setdefault(key, [])
+        chosen = None
+        if best_fit:
+            fitting = [sid for sid in candidates
+                       if plan.storage_sizes[sid] >= size]
+            if len(fitting) > 0:
+                chosen = min(fitting, key=lambda sid: plan.storage_sizes[sid])
+            elif len(candidates) > 0:
+                chosen = max(candidates,
+                             key=lambda sid: plan.storage_sizes[sid])
+                plan.storage_sizes[chosen] = size
+        else:
+            for sid in candidates:
+                if plan.storage_sizes[sid] == size:
+                    chosen = sid
+                    break
+
+        if chosen is None:
+            chosen = len(plan.storage_sizes)
+            plan.storage_sizes.append(size)
+            plan.storage_keys.append(key)
+            storage_users.append(0)
+        else:
+            candidates.remove(chosen)
+        plan.node_to_storage[node] = chosen
+        storage_users[chosen] += 1
+
+    def allocate_inplace(node, i):
+        for n in node.inputs:
+            if n not in plan.node_to_storage or last_use[n] != i:
+                continue
+            sid = plan.node_to_storage[n]
+            if node_to_key[n] == node_to_key[node] and \
+                    node_to_size[n] == node_to_size[node] and \
+                    storage_users[sid] == 1:
+                plan.node_to_storage[node] = sid
+                storage_users[sid] += 1
+                return True
+        return False
+
+    def release(node):
+        sid = plan.node_to_storage[node]
+        storage_users[sid] -= 1
+        if storage_users[sid] == 0:
+            free[node_to_key[node]].append(sid)
+
+    inplace_nodes = set(inplace_nodes)
+    for i, node in enumerate(topo_order):
+        if node in node_to_size and node not in plan.node_to_storage:
+            if not (node in inplace_nodes and allocate_inplace(node, i)):
+                allocate(node)
+            for aux in aux_outputs.get(node, ()):
+                if aux in node_to_size:
+                    allocate(aux)
+        for n in set(node.inputs):
+            if n in plan.node_to_storage and last_use[n] == i:
+                release(n)
+        if node in plan.node_to_storage and last_use[node] == i:
+            release(node)
+
+    return plan
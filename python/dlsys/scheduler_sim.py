@@ -0,0 +1,343 @@
+''' Offline scheduler simulator for recorded dependency engine traces '''
+from __future__ import absolute_import, print_function
+
+import argparse
+import heapq
+import json
+import time
+from collections import deque
+from threading import Lock
+
+class Trace(object):
+    """A recorded DAG of pushes.
+
+    Every push is stored as a dict with the keys
+        id: position of the push in the trace.
+        name: instruction name for debugging.
+        read: list of resource tags the instruction only reads.
+        mutate: list of resource tags the instruction mutates.
+        duration: measured run time of the instruction in seconds.
+
+    A trace is filled either by DependencyEngine (pass it as `trace`) or by
+    Executor.run(..., trace=...), and can be saved as json for later
+    simulation.
+    """
+    def __init__(self, instructions = None):
+        self.instructions = instructions if instructions is not None else []
+        self.lock = Lock()
+
+    def add(self, name, read_tags, mutate_tags, duration = 0.0):
+        """Records a push, returns the record so duration can be filled in."""
+        with self.lock:
+            record = {
+                "id": len(self.instructions),
+                "name": name,
+                "read": [str(t) for t in read_tags],
+                "mutate": [str(t) for t in mutate_tags],
+                "duration": duration}
+            self.instructions.append(record)
+        return record
+
+    def record(self, exec_func, read_tags, mutate_tags, name = None):
+        """Records a push and wraps exec_func to measure its run time."""
+        record = self.add(name, read_tags, mutate_tags)
+        if record["name"] is None:
+            record["name"] = "instruction %d" % record["id"]
+
+        def timed_func(*args):
+            start_time = time.time()
+            try:
+                return exec_func(*args)
+            finally:
+                record["duration"] += time.time() - start_time
+        return timed_func
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"instructions": self.instructions}, f, indent=1)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return Trace(json.load(f)["instructions"])
+
+    def __len__(self):
+        return len(self.instructions)
+
+
+def build_dag(instructions):
+    """Derives the dependency DAG implied by the engine's N/R/MR semantics.
+
+    Each resource tag behaves like a ResourceStateQueue: a mutation waits
+    for the previous mutation and every read pushed since, a read only waits
+    for the previous mutation, and consecutive reads run concurrently.
+
+    Returns
+    -------
+    A list with the sorted predecessor ids of every instruction.
+    """
+    last_mutate = {}
+    reads_since_mutate = {}
+    preds = []
+    for instr in instructions:
+        deps = set()
+        mutate_tags = set(instr["mutate"])
+        for tag in set(instr["read"]) | mutate_tags:
+            if tag in last_mutate:
+                deps.add(last_mutate[tag])
+            if tag in mutate_tags:
+                # read + mutate is handled as a mutate
+                deps.update(reads_since_mutate.get(tag, []))
+                last_mutate[tag] = instr["id"]
+                reads_since_mutate[tag] = []
+            else:
+                reads_since_mutate.setdefault(tag, []).append(instr["id"])
+        deps.discard(instr["id"])
+        preds.append(sorted(deps))
+    return preds
+
+
+def critical_path(instructions, preds = None):
+    """Longest duration-weighted path through the DAG.
+
+    Returns
+    -------
+    (length in seconds, list of instruction ids along the path)
+    """
+    if preds is None:
+        preds = build_dag(instructions)
+    finish = [0.0] * len(instructions)
+    best_pred = [None] * len(instructions)
+    # ids are in push order, which is already a topological order
+    for instr in instructions:
+        i = instr["id"]
+        start = 0.0
+        for p in preds[i]:
+            if finish[p] > start:
+                start = finish[p]
+                best_pred[i] = p
+        finish[i] = start + instr["duration"]
+
+    if len(instructions) == 0:
+        return 0.0, []
+    last = max(range(len(instructions)), key=lambda i: finish[i])
+    path = []
+    while last is not None:
+        path.append(last)
+        last = best_pred[last]
+    path.reverse()
+    return finish[path[-1]], path
+
+
+def bottom_levels(instructions, succs):
+    """Duration of the longest path from each instruction to a sink."""
+    level = [0.0] * len(instructions)
+    for instr in reversed(instructions):
+        i = instr["id"]
+        level[i] = instr["duration"] + max(
+            [level[s] for s in succs[i]] or [0.0])
+    return level
+
+
+class SimulationResult(object):
+    def __init__(self, policy, num_workers, makespan, total_work,
+                 critical_path_length, critical_path_ids, schedule):
+        self.policy = policy
+        self.num_workers = num_workers
+        self.makespan = makespan
+        self.total_work = total_work
+        self.critical_path_length = critical_path_length
+        self.critical_path = critical_path_ids
+        # list of (instruction id, worker, start, end)
+        self.schedule = schedule
+
+    @property
+    def utilization(self):
+        """Fraction of worker time spent running instructions."""
+        if self.makespan == 0:
+            return 1.0
+        workers = self.num_workers
+        if workers is None:
+            workers = max_concurrency(self.schedule)
+        return self.total_work / (self.makespan * max(workers, 1))
+
+    @property
+    def parallelism_ceiling(self):
+        """Best possible speedup over serial execution, work / span."""
+        if self.critical_path_length == 0:
+            return 1.0
+        return self.total_work / self.critical_path_length
+
+    def __repr__(self):
+        return ("SimulationResult(policy=%s, workers=%s, makespan=%f, "
+            "utilization=%f)" % (self.policy, self.num_workers, self.makespan,
+            self.utilization))
+
+
+def max_concurrency(schedule):
+    events = []
+    for _, _, start, end in schedule:
+        events.append((start, 1))
+        events.append((end, -1))
+    # process finishes before starts at the same timestamp
+    events.sort(key=lambda e: (e[0], e[1]))
+    running = peak = 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+POLICIES = ("fifo", "critical_path", "work_stealing")
+
+def simulate(trace, num_workers = None, policy = "fifo", overhead = 0.0):
+    """Replays a trace through a discrete-event simulation of the engine.
+
+    Parameters
+    ----------
+    trace: a Trace or a list of instruction dicts.
+    num_workers: number of workers, None means one thread per ready
+        instruction like the threaded engine does today.
+    policy: how ready instructions are assigned to idle workers.
+        "fifo": in the order they became ready.
+        "critical_path": longest remaining path to a sink first.
+        "work_stealing": each worker keeps a LIFO deque of instructions it
+            made ready, idle workers steal the oldest entry of the fullest
+            deque.
+    overhead: dispatch cost in seconds added to every instruction.
+
+    Returns
+    -------
+    A SimulationResult.
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown scheduling policy %s" % policy)
+    if num_workers is not None and num_workers < 1:
+        raise ValueError("num_workers must be positive")
+    instructions = trace.instructions if isinstance(trace, Trace) else trace
+    n = len(instructions)
+    preds = build_dag(instructions)
+    succs = [[] for _ in range(n)]
+    for i in range(n):
+        for p in preds[i]:
+            succs[p].append(i)
+    pending = [len(preds[i]) for i in range(n)]
+    priority = bottom_levels(instructions, succs)
+    duration = [instr["duration"] + overhead for instr in instructions]
+
+    workers = num_workers if num_workers is not None else max(n, 1)
+    idle = list(range(workers))
+    heapq.heapify(idle)
+
+    # ready queues for the different policies
+    ready_heap = []
+    deques = [deque() for _ in range(workers)]
+    ready_seq = [0]
+
+    def make_ready(i, worker):
+        if policy == "fifo":
+            heapq.heappush(ready_heap, (ready_seq[0], i))
+        elif policy == "critical_path":
+            heapq.heappush(ready_heap, (-priority[i], ready_seq[0], i))
+        else:
+            deques[worker].append(i)
+        ready_seq[0] += 1
+
+    def next_for(worker):
+        if policy != "work_stealing":
+            if not ready_heap:
+                return None
+            return heapq.heappop(ready_heap)[-1]
+        if deques[worker]:
+            return deques[worker].pop()
+        victim = max(range(workers), key=lambda w: len(deques[w]))
+        if deques[victim]:
+            return deques[victim].popleft()
+        return None
+
+    for i in range(n):
+        if pending[i] == 0:
+            # spread the initial work over the workers round robin
+            make_ready(i, i % workers)
+
+    now = 0.0
+    running = []
+    schedule = []
+    done = 0
+    while done < n:
+        # hand out work to every idle worker that can find some
+        still_idle = []
+        while idle:
+            w = heapq.heappop(idle)
+            i = next_for(w)
+            if i is None:
+                still_idle.append(w)
+                continue
+            heapq.heappush(running, (now + duration[i], i, w))
+            schedule.append((i, w, now, now + duration[i]))
+        for w in still_idle:
+            heapq.heappush(idle, w)
+
+        if not running:
+            raise Exception("Deadlock in trace, instructions left: %d"
+                % (n - done))
+
+        # advance to the next completion, retiring everything finishing then
+        now, i, w = heapq.heappop(running)
+        finished = [(i, w)]
+        while running and running[0][0] == now:
+            _, i, w = heapq.heappop(running)
+            finished.append((i, w))
+        for i, w in finished:
+            done += 1
+            heapq.heappush(idle, w)
+            for s in succs[i]:
+                pending[s] -= 1
+                if pending[s] == 0:
+                    make_ready(s, w)
+
+    span, path = critical_path(instructions, preds)
+    total_work = sum(instr["duration"] for instr in instructions)
+    return SimulationResult(policy, num_workers, now, total_work, span, path,
+        schedule)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description="Simulate a recorded dependency engine trace.")
+    parser.add_argument("trace", help="trace json written by Trace.save")
+    parser.add_argument(
+        "-w", "--workers", nargs="+", type=int, default=[1, 2, 4, 8],
+        help="worker counts to simulate")
+    parser.add_argument(
+        "-p", "--policy", nargs="+", choices=POLICIES, default=list(POLICIES),
+        help="scheduling policies to simulate")
+    parser.add_argument(
+        "-o", "--overhead", type=float, default=0.0,
+        help="dispatch overhead per instruction in seconds")
+    parser.add_argument(
+        "-c", "--show_critical_path", action="store_true",
+        help="print the instructions on the critical path")
+    args = parser.parse_args(argv)
+
+    trace = Trace.load(args.trace)
+    result = None
+    print("%-14s %8s %12s %12s" % ("policy", "workers", "makespan", "util"))
+    for policy in args.policy:
+        for workers in args.workers:
+            result = simulate(trace, workers, policy, args.overhead)
+            print("%-14s %8d %12.6f %12.3f" % (
+                policy, workers, result.makespan, result.utilization))
+    if result is None:
+        return
+    print("total work = %f s; critical path = %f s; parallelism ceiling = %.2f"
+        % (result.total_work, result.critical_path_length,
+           result.parallelism_ceiling))
+    if args.show_critical_path:
+        for i in result.critical_path:
+            instr = trace.instructions[i]
+            print("  %6d %12.6f  %s" % (i, instr["duration"], instr["name"]))
+
+
+if __name__ == "__main__":
+    main()
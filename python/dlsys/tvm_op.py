@@ -2,9 +2,16 @@ from __future__ import absolute_import, print_function
 
 import tvm
 import numpy as np
-import topi
+
+from .kernel_cache import cached
 
 # Global declarations of environment.
+# Every make_* builder goes through kernel_cache, so identical kernels are
+# built once per process.
+# Shapes may contain a tvm.var, e.g. for the batch size, the kernel is then
+# built once and accepts any size along that dimension.
+# dtype is the dtype kernel arguments are stored in. Arithmetic is done in
+# accum_dtype(dtype), so float16 storage keeps float32 sums.
 
 # llvm
 tgt_host="llvm"
@@ -12,243 +19,927 @@ tgt_host="llvm"
 # Change it to respective GPU if gpu is enabled Ex: cuda, opencl
 tgt="llvm"
 
+# elements per vector of the elementwise schedules, 8 float32 fill an AVX
+# register
+VECTOR_WIDTH = 8
+# elementwise kernels touching fewer elements run on one thread, starting
+# the thread pool costs more than it saves
+PARALLEL_THRESHOLD = 1 << 15
+# rows summed by one task of the parallel reductions over rows
+ROWS_PER_TASK = 16
+
+
+def static_size(extents):
+    """Product of extents, None if one of them is symbolic."""
+    size = 1
+    for extent in extents:
+        if isinstance(extent, tvm.expr.IntImm):
+            extent = extent.value
+        if not isinstance(extent, int):
+            return None
+        size *= extent
+    return size
+
+
+def accum_dtype(dtype):
+    """dtype kernels compute in for values stored as dtype: float16 values
+    are widened to float32 as they are loaded, and the results narrowed
+    again as they are stored."""
+    return "float32" if dtype == "float16" else dtype
+
+
+def widen(value, dtype):
+    """value, loaded from a tensor of dtype, in accum_dtype(dtype)."""
+    if accum_dtype(dtype) == dtype:
+        return value
+    return value.astype(accum_dtype(dtype))
+
+
+def narrow(value, dtype):
+    """value, computed in accum_dtype(dtype), to be stored as dtype."""
+    if accum_dtype(dtype) == dtype:
+        return value
+    return value.astype(dtype)
+
 
+def narrow_tensor(C, dtype, name="narrow"):
+    """The reduction C, computed in accum_dtype(dtype), stored as dtype.
+
+    A reduction can't be cast in its own stage, so this is C itself if it
+    already is of dtype, or an elementwise stage after C to be scheduled
+    with schedule_narrow.
+    """
+    if C.dtype == dtype:
+        return C
+    return tvm.compute(C.shape, lambda *i: C(*i).astype(dtype), name=name)
+
+
+def schedule_narrow(s, C, out):
+    """Schedules out = narrow_tensor(C, ...), if it is a stage of its own."""
+    if out is not C:
+        schedule_elementwise(s, out)
+
+
+def schedule_elementwise(s, out):
+    """Runs the stage computing out as one flat loop over its output, split
+    into vectors of VECTOR_WIDTH elements.
+
+    Reductions, e.g. a sum over axis 0, accumulate a vector of outputs at
+    a time. The outer loop runs in parallel once the stage touches
+    PARALLEL_THRESHOLD elements, or when its size is symbolic.
+    """
+    stage = s[out]
+    fused = out.op.axis[0]
+    for axis in out.op.axis[1:]:
+        fused = stage.fuse(fused, axis)
+    outer, inner = stage.split(fused, factor=VECTOR_WIDTH)
+    reduce_axes = list(out.op.reduce_axis)
+    if len(reduce_axes) > 0:
+        stage.reorder(*([outer] + reduce_axes + [inner]))
+    stage.vectorize(inner)
+    size = static_size(list(out.shape) +
+                       [axis.dom.extent for axis in reduce_axes])
+    if size is None or size >= PARALLEL_THRESHOLD:
+        stage.parallel(outer)
+
+
+@cached
 def make_elemwise_add(shape, tgt, tgt_host, func_name, dtype="float32"):
     A = tvm.placeholder(shape, dtype=dtype, name="A")
     B = tvm.placeholder(shape, dtype=dtype, name="B")
-    C = tvm.compute(A.shape, lambda *i: A(*i) + B(*i))
+    C = tvm.compute(A.shape, lambda *i: narrow(
+        widen(A(*i), dtype) + widen(B(*i), dtype), dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, B, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+@cached
 def make_elemwise_mul(shape, tgt, tgt_host, func_name, dtype="float32"):
     """TODO: Your code here"""
     A = tvm.placeholder(shape, dtype=dtype, name="A")
     B = tvm.placeholder(shape, dtype=dtype, name="B")
-    C = tvm.compute(A.shape, lambda *i: A(*i) * B(*i))
+    C = tvm.compute(A.shape, lambda *i: narrow(
+        widen(A(*i), dtype) * widen(B(*i), dtype), dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, B, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
+@cached
 def make_elemwise_add_by_const(shape, const_k, tgt, tgt_host, func_name,
                                dtype="float32"):
     """TODO: Your code here"""
     A = tvm.placeholder(shape, dtype=dtype, name="A")
-    C = tvm.compute(A.shape, lambda *i: A(*i) + const_k)
+    C = tvm.compute(A.shape, lambda *i: narrow(
+        widen(A(*i), dtype) + const_k, dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+@cached
 def make_elemwise_mul_by_const(shape, const_k, tgt, tgt_host, func_name,
                             dtype="float32"):
     """TODO: Your code here"""
     A = tvm.placeholder(shape, dtype=dtype, name="A")
-    C = tvm.compute(A.shape, lambda *i: A(*i) * const_k)
+    C = tvm.compute(A.shape, lambda *i: narrow(
+        widen(A(*i), dtype) * const_k, dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
+@cached
 def make_relu(shape, tgt, tgt_host, func_name, dtype="float32"):
     """TODO: Your code here"""
     """Hint: use tvm.max, tvm.const(0, A.dtype)"""
 
-    ZERO = tvm.const(0, dtype)
+    ZERO = tvm.const(0, accum_dtype(dtype))
 
     A = tvm.placeholder(shape, dtype=dtype, name="A")
-    C = tvm.compute(A.shape, lambda *i: tvm.max(A(*i), ZERO))
+    C = tvm.compute(A.shape, lambda *i: narrow(
+        tvm.max(widen(A(*i), dtype), ZERO), dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+@cached
 def make_relu_gradient(shape, tgt, tgt_host, func_name, dtype="float32"):
     """TODO: Your code here"""
     """Hint: use tvm.select"""
-    ZERO = tvm.const(0, dtype)
+    ZERO = tvm.const(0, accum_dtype(dtype))
 
     A = tvm.placeholder(shape, dtype=dtype, name="A")
     B = tvm.placeholder(shape, dtype=dtype, name="A_grad")
-    C = tvm.compute(A.shape, lambda *i: tvm.select((A(*i) > ZERO), B(*i), ZERO))
+    C = tvm.compute(A.shape, lambda *i: narrow(tvm.select(
+        (widen(A(*i), dtype) > ZERO), widen(B(*i), dtype), ZERO), dtype))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, B, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+def matmul_compute(A, transposeA, B, transposeB):
+    """Returns the tvm.compute of op(A) op(B), where op transposes if asked
+    to, and its reduction axis. The product is in accum_dtype(A.dtype)."""
+    a = lambda i, k: widen(A[i, k], A.dtype)
+    b = lambda k, j: widen(B[k, j], B.dtype)
+    if not transposeA and not transposeB:
+        k = tvm.reduce_axis((0, A.shape[1]), name='k')
+        C = tvm.compute((A.shape[0], B.shape[1]),
+            lambda i, j: tvm.sum(a(i, k) * b(k, j), axis=k))
+
+    elif not transposeA and transposeB:
+        k = tvm.reduce_axis((0, A.shape[1]), name='k')
+        C = tvm.compute((A.shape[0], B.shape[0]),
+            lambda i, j: tvm.sum(a(i, k) * b(j, k), axis=k))
+
+    elif transposeA and not transposeB:
+        k = tvm.reduce_axis((0, A.shape[0]), name='k')
+        C = tvm.compute((A.shape[1], B.shape[1]),
+            lambda i, j: tvm.sum(a(k, i) * b(k, j), axis=k))
+
+    else: # transposeA and transposeB
+        k = tvm.reduce_axis((0, A.shape[0]), name='k')
+        C = tvm.compute((A.shape[1], B.shape[0]),
+            lambda i, j: tvm.sum(a(k, i) * b(j, k), axis=k))
+    return C, k
+
+
+# loop orders of the tiled matmul schedule, outermost first
+MATMUL_LOOP_ORDERS = {
+    "xo_ko_yo": ("xo", "ko", "yo", "xi", "ki", "yi"),
+    "xo_yo_ko": ("xo", "yo", "ko", "xi", "ki", "yi"),
+    "xo_yo_ko_ki": ("xo", "yo", "ko", "ki", "xi", "yi"),
+}
+# (BLOCK_SIZE_I, BLOCK_SIZE_J, RED_AXIS_SPLIT, loop order) of shapes that
+# were never tuned, see autotune.tune_matrix_mul
+DEFAULT_MATMUL_CONFIG = (100, 4, 8, "xo_ko_yo")
+
+
 def make_matrix_mul(shapeA, transposeA, shapeB, transposeB, tgt, tgt_host,
                     func_name, dtype="float32"):
-    """TODO: Your code here"""
-    """Hint: use tvm.reduce_axis, tvm.sum"""
-    """Hint: treat 4 cases of transposeA, transposeB separately"""
-    """Hint: for tvm schedule, use split, reorder, vectorize, parallel"""
-    """Hint: debug tvm schedule using tvm.lower"""
+    """op(A) op(B), where op transposes if asked to.
 
-    # raise Exception("Avoid blocking")
+    The schedule configuration comes from the tuning log when the shapes
+    were tuned (see autotune), so the kernel is cached per configuration.
+    """
+    from . import autotune
+    config = autotune.matmul_config(
+        shapeA, transposeA, shapeB, transposeB, tgt, dtype)
+    return make_tuned_matrix_mul(shapeA, transposeA, shapeB, transposeB,
+                                 config, tgt, tgt_host, func_name, dtype)
+
+
+@cached
+def make_tuned_matrix_mul(shapeA, transposeA, shapeB, transposeB, config,
+                          tgt, tgt_host, func_name, dtype="float32"):
+    """make_matrix_mul with the schedule configuration config, a tuple
+    (BLOCK_SIZE_I, BLOCK_SIZE_J, RED_AXIS_SPLIT, loop order)."""
     A = tvm.placeholder(shapeA, dtype=dtype, name="A")
     B = tvm.placeholder(shapeB, dtype=dtype, name="B")
 
     # optimization parameters
-    BLOCK_SIZE_I = 100
-    BLOCK_SIZE_J = 4
-    RED_AXIS_SPLIT = 8
-
-    if not transposeA and not transposeB:
-        k = tvm.reduce_axis((0, shapeA[1]), name='k')
-        C = tvm.compute((shapeA[0], shapeB[1]),
-            lambda i, j: tvm.sum(A[i, k] * B[k, j], axis=k))
-        s = tvm.create_schedule(C.op)
+    BLOCK_SIZE_I, BLOCK_SIZE_J, RED_AXIS_SPLIT, loop_order = config
 
-    elif not transposeA and transposeB:
-        k = tvm.reduce_axis((0, shapeA[1]), name='k')
-        C = tvm.compute((shapeA[0], shapeB[0]),
-            lambda i, j: tvm.sum(A[i, k] * B[j, k], axis=k))
-        s = tvm.create_schedule(C.op)
-
-    elif transposeA and not transposeB:
-        k = tvm.reduce_axis((0, shapeA[0]), name='k')
-        C = tvm.compute((shapeA[1], shapeB[1]),
-            lambda i, j: tvm.sum(A[k, i] * B[k, j], axis=k))
-        s = tvm.create_schedule(C.op)
-
-    else: # transposeA and transposeB
-        k = tvm.reduce_axis((0, shapeA[0]), name='k')
-        C = tvm.compute((shapeA[1], shapeB[0]),
-            lambda i, j: tvm.sum(A[k, i] * B[j, k], axis=k))
-        s = tvm.create_schedule(C.op)
+    C, k = matmul_compute(A, transposeA, B, transposeB)
+    Z = narrow_tensor(C, dtype)
+    s = tvm.create_schedule(Z.op)
 
     # optimizations
     xo, yo, xi, yi = s[C].tile(C.op.axis[0], C.op.axis[1], BLOCK_SIZE_I, BLOCK_SIZE_J)
     ko, ki = s[C].split(k, factor=RED_AXIS_SPLIT)
     # reorder access pattern to improve A's access pattern
-    s[C].reorder(xo, ko, yo, xi, ki, yi)
+    axes = dict(xo=xo, yo=yo, ko=ko, xi=xi, yi=yi, ki=ki)
+    s[C].reorder(*[axes[name] for name in MATMUL_LOOP_ORDERS[loop_order]])
     # uniform access, so vectorize
     s[C].vectorize(yi)
     # multithreading on blocks
     s[C].parallel(xo)
+    schedule_narrow(s, C, Z)
+
+    f = tvm.build(s, [A, B, Z], tgt, target_host=tgt_host, name=func_name)
+
+    return f
 
-    f = tvm.build(s, [A, B, C], tgt, target_host=tgt_host, name=func_name)
 
+def make_multi_matmul(shapeShared, shapeOther, num, sharedLeft, transposeA,
+                      transposeB, tgt, tgt_host, func_name, dtype="float32"):
+    """num matmuls with a shared operand, see autodiff.MultiMatMulOp.
+
+    The products op(S) op(B_i), or op(B_i) op(S) if not sharedLeft, are
+    computed by one tuple reduction, so every element of S is loaded once
+    for all of them. The kernel takes S, the num other operands and the num
+    outputs. It is scheduled like one of the matmuls, see make_matrix_mul.
+    """
+    from . import autotune
+    shapeA, shapeB = shapeShared, shapeOther
+    if not sharedLeft:
+        shapeA, shapeB = shapeOther, shapeShared
+    config = autotune.matmul_config(
+        shapeA, transposeA, shapeB, transposeB, tgt, dtype)
+    return make_tuned_multi_matmul(shapeShared, shapeOther, num, sharedLeft,
+                                   transposeA, transposeB, config, tgt,
+                                   tgt_host, func_name, dtype)
+
+
+@cached
+def make_tuned_multi_matmul(shapeShared, shapeOther, num, sharedLeft,
+                            transposeA, transposeB, config, tgt, tgt_host,
+                            func_name, dtype="float32"):
+    """make_multi_matmul with the schedule configuration config, see
+    make_tuned_matrix_mul."""
+    S = tvm.placeholder(shapeShared, dtype=dtype, name="S")
+    others = [tvm.placeholder(shapeOther, dtype=dtype, name="B%d" % n)
+              for n in range(num)]
+    shapeA, shapeB = shapeShared, shapeOther
+    if not sharedLeft:
+        shapeA, shapeB = shapeOther, shapeShared
+
+    # optimization parameters
+    BLOCK_SIZE_I, BLOCK_SIZE_J, RED_AXIS_SPLIT, loop_order = config
+
+    lhs = lambda A, i, k: widen(A[k, i] if transposeA else A[i, k], dtype)
+    rhs = lambda B, k, j: widen(B[j, k] if transposeB else B[k, j], dtype)
+    k = tvm.reduce_axis(
+        (0, shapeA[0] if transposeA else shapeA[1]), name='k')
+    shapeC = (shapeA[1] if transposeA else shapeA[0],
+              shapeB[0] if transposeB else shapeB[1])
+    multi_sum = tvm.comm_reducer(
+        lambda x, y: tuple(a + b for a, b in zip(x, y)),
+        lambda *dtypes: tuple(tvm.const(0, t) for t in dtypes),
+        name="multi_sum")
+
+    def products(i, j):
+        if sharedLeft:
+            terms = [lhs(S, i, k) * rhs(B, k, j) for B in others]
+        else:
+            terms = [lhs(A, i, k) * rhs(S, k, j) for A in others]
+        return multi_sum(tuple(terms), axis=k)
+    outputs = tvm.compute(shapeC, products, name="C")
+    stored = [narrow_tensor(C, dtype, name="Z%d" % n)
+              for n, C in enumerate(outputs)]
+
+    # all outputs belong to the same stage, narrowed ones to one each
+    if stored[0] is outputs[0]:
+        s = tvm.create_schedule(outputs[0].op)
+    else:
+        s = tvm.create_schedule([Z.op for Z in stored])
+    C = s[outputs[0]]
+    xo, yo, xi, yi = C.tile(outputs[0].op.axis[0], outputs[0].op.axis[1],
+                            BLOCK_SIZE_I, BLOCK_SIZE_J)
+    ko, ki = C.split(k, factor=RED_AXIS_SPLIT)
+    axes = dict(xo=xo, yo=yo, ko=ko, xi=xi, yi=yi, ki=ki)
+    C.reorder(*[axes[name] for name in MATMUL_LOOP_ORDERS[loop_order]])
+    C.vectorize(yi)
+    C.parallel(xo)
+    for C, Z in zip(outputs, stored):
+        schedule_narrow(s, C, Z)
+
+    f = tvm.build(s, [S] + others + stored, tgt, target_host=tgt_host,
+                  name=func_name)
     return f
 
 
-def make_conv2d(shapeX, shapeF, tgt, tgt_host, func_name, dtype="float32"):
+def make_dense(shapeX, transposeX, shapeW, transposeW, shapeB, relu, tgt,
+               tgt_host, func_name, dtype="float32"):
+    """op(X) op(W) + B, followed by relu if asked to, see autodiff.DenseOp.
+
+    B is broadcast to the output, e.g. a bias vector. The bias and the
+    activation are applied to each output tile right after its matmul,
+    which is scheduled like make_matrix_mul of X and W.
+    """
+    from . import autotune
+    config = autotune.matmul_config(
+        shapeX, transposeX, shapeW, transposeW, tgt, dtype)
+    return make_tuned_dense(shapeX, transposeX, shapeW, transposeW, shapeB,
+                            relu, config, tgt, tgt_host, func_name, dtype)
+
+
+@cached
+def make_tuned_dense(shapeX, transposeX, shapeW, transposeW, shapeB, relu,
+                     config, tgt, tgt_host, func_name, dtype="float32"):
+    """make_dense with the schedule configuration config, see
+    make_tuned_matrix_mul."""
+    ZERO = tvm.const(0, accum_dtype(dtype))
+    X = tvm.placeholder(shapeX, dtype=dtype, name="X")
+    W = tvm.placeholder(shapeW, dtype=dtype, name="W")
+    B = tvm.placeholder(shapeB, dtype=dtype, name="B")
+
+    # optimization parameters
+    BLOCK_SIZE_I, BLOCK_SIZE_J, RED_AXIS_SPLIT, loop_order = config
+
+    C, k = matmul_compute(X, transposeX, W, transposeW)
+
+    def epilogue(i, j):
+        z = C[i, j] + widen(B(*broadcast_index(shapeB, (i, j))), dtype)
+        if relu:
+            z = tvm.max(z, ZERO)
+        return narrow(z, dtype)
+    Z = tvm.compute(C.shape, epilogue, name="Z")
+
+    s = tvm.create_schedule(Z.op)
+    xo, yo, xi, yi = s[Z].tile(Z.op.axis[0], Z.op.axis[1],
+                               BLOCK_SIZE_I, BLOCK_SIZE_J)
+    s[Z].vectorize(yi)
+    s[Z].parallel(xo)
+    # the matmul of a tile is done into a block local buffer
+    s[C].compute_at(s[Z], yo)
+    ci, cj = s[C].op.axis
+    ko, ki = s[C].split(k, factor=RED_AXIS_SPLIT)
+    # the tile loops xo, yo are Z's, the rest keeps the configured order
+    axes = dict(ko=ko, xi=ci, yi=cj, ki=ki)
+    s[C].reorder(*[axes[name] for name in MATMUL_LOOP_ORDERS[loop_order]
+                   if name in axes])
+    s[C].vectorize(cj)
+
+    f = tvm.build(s, [X, W, B, Z], tgt, target_host=tgt_host, name=func_name)
+    return f
+
+
+def conv2d_output_size(size, filter_size, stride, padding):
+    """Height or width of a conv2d output."""
+    return (size + 2 * padding - filter_size) // stride + 1
+
+
+def clamp(index, size):
+    """index clamped into [0, size). tvm.select evaluates both branches, so
+    loads it guards must stay in bounds."""
+    return tvm.max(tvm.min(index, tvm.convert(size) - 1), tvm.const(0, "int32"))
+
+
+def all_of(*conditions):
+    """Logical and of tvm conditions."""
+    result = conditions[0]
+    for condition in conditions[1:]:
+        result = tvm.make.And(result, condition)
+    return result
+
+
+def pad_nchw(X, padding, dtype):
+    """X with padding zeros around its last two axes."""
+    ZERO = tvm.const(0, dtype)
+    N, C, H, W = X.shape
+    if padding == 0:
+        return X
+
+    def padded(n, c, h, w):
+        h, w = h - padding, w - padding
+        inside = all_of(h >= 0, h < H, w >= 0, w < W)
+        return tvm.select(inside, X[n, c, clamp(h, H), clamp(w, W)], ZERO)
+    return tvm.compute((N, C, H + 2 * padding, W + 2 * padding), padded,
+                       name="X_pad")
+
+
+def schedule_conv2d(s, out, reduce_axes):
+    """Direct convolution schedule: the two outer axes of out run in
+    parallel, the reduction is done for a vector of the last axis at a
+    time, and padding is computed on the fly."""
+    stage = s[out]
+    a, b, h, w = out.op.axis
+    outer = stage.fuse(a, b)
+    wo, wi = stage.split(w, factor=VECTOR_WIDTH)
+    stage.reorder(*([outer, h, wo] + list(reduce_axes) + [wi]))
+    stage.vectorize(wi)
+    stage.parallel(outer)
+
+
+@cached
+def make_conv2d(shapeX, shapeF, tgt, tgt_host, func_name, dtype="float32",
+                stride=1, padding=0):
+    """Convolution (cross-correlation) of images X of shape (N, C, H, W)
+    with filters F of shape (M, C, R, S), zero padded by padding on every
+    side of H and W."""
     assert(shapeX[1] == shapeF[1])
     N, C, H, W = shapeX
     M, C, R, S = shapeF
-
-    """TODO: Your code here"""
-    """Hint: use tvm.reduce_axis, tvm.sum"""
-    """Hint: go by conv2d definition. Treat stride=1, padding=0 case only."""
-    """For a challenge, treat the general case for stride and padding."""
-
-    # stride = 1; padding = 0
-    shapeZ = (N, M, H - R + 1, W - S + 1)
+    shapeZ = (N, M, conv2d_output_size(H, R, stride, padding),
+              conv2d_output_size(W, S, stride, padding))
 
     X = tvm.placeholder(shapeX, dtype = dtype, name = "X")
     F = tvm.placeholder(shapeF, dtype = dtype, name = "F")
+    X_pad = pad_nchw(X, padding, dtype)
 
     rr = tvm.reduce_axis((0, R), name = "rh")
     rs = tvm.reduce_axis((0, S), name = "rs")
     rc = tvm.reduce_axis((0, C), name = "rc")
 
-    Z = tvm.compute(shapeZ, lambda n, m, i, j: tvm.sum(X[n, rc, i + rr, j + rs] * F[m, rc, rr, rs], axis = [rc, rr, rs]), name="Z")
+    acc = tvm.compute(shapeZ, lambda n, m, i, j: tvm.sum(
+        widen(X_pad[n, rc, i * stride + rr, j * stride + rs], dtype) *
+        widen(F[m, rc, rr, rs], dtype), axis = [rc, rr, rs]), name="acc")
+    Z = narrow_tensor(acc, dtype, name="Z")
     s = tvm.create_schedule(Z.op)
+    if padding > 0:
+        s[X_pad].compute_inline()
+    schedule_conv2d(s, acc, [rc, rr, rs])
+    schedule_narrow(s, acc, Z)
 
     f = tvm.build(s, [X, F, Z], tgt, target_host=tgt_host, name=func_name)
 
     return f
 
 
+@cached
+def make_conv2d_gradient_input(shapeGrad, shapeF, shapeX, tgt, tgt_host,
+                               func_name, dtype="float32", stride=1,
+                               padding=0):
+    """Gradient of make_conv2d with respect to X of shape shapeX, given the
+    gradient of its output and the filters. Called as (grad, F, grad_X)."""
+    ZERO = tvm.const(0, accum_dtype(dtype))
+    N, M, OH, OW = shapeGrad
+    M, C, R, S = shapeF
+    grad = tvm.placeholder(shapeGrad, dtype = dtype, name = "grad")
+    F = tvm.placeholder(shapeF, dtype = dtype, name = "F")
 
-def make_matrix_softmax(shape, tgt, tgt_host, func_name, dtype="float32"):
+    rm = tvm.reduce_axis((0, M), name = "rm")
+    rr = tvm.reduce_axis((0, R), name = "rh")
+    rs = tvm.reduce_axis((0, S), name = "rs")
 
-    """TODO: Your code here"""
-    """Hint: use tvm.reduce_axis, tvm.sum, tvm.max, tvm.exp"""
-    """Hint: do not reuse the same reduction axis j."""
-    """Hint: implement the following version for better stability
-        e_x = np.exp(x - np.max(x))
-        softmax(x)= e_x / e_x.sum()
-    """
-    X = tvm.placeholder(shape, dtype = dtype, name = "X")
+    def grad_x(n, c, h, w):
+        # output (i, j) reads X[h, w] through filter tap (r, s) if
+        # i * stride + r == h + padding
+        i = h + padding - rr
+        j = w + padding - rs
+        hit = all_of(i >= 0, j >= 0, tvm.make.EQ(i % stride, 0),
+                     tvm.make.EQ(j % stride, 0), i < OH * stride,
+                     j < OW * stride)
+        value = widen(grad[n, rm, clamp(i / stride, OH),
+                           clamp(j / stride, OW)], dtype) * \
+            widen(F[rm, c, rr, rs], dtype)
+        return tvm.sum(tvm.select(hit, value, ZERO), axis = [rm, rr, rs])
+    acc = tvm.compute(shapeX, grad_x, name = "acc")
+    Z = narrow_tensor(acc, dtype, name = "grad_X")
+
+    s = tvm.create_schedule(Z.op)
+    schedule_conv2d(s, acc, [rm, rr, rs])
+    schedule_narrow(s, acc, Z)
+    f = tvm.build(s, [grad, F, Z], tgt, target_host=tgt_host, name=func_name)
+    return f
+
+
+@cached
+def make_conv2d_gradient_filter(shapeX, shapeGrad, shapeF, tgt, tgt_host,
+                                func_name, dtype="float32", stride=1,
+                                padding=0):
+    """Gradient of make_conv2d with respect to F of shape shapeF, given the
+    images and the gradient of the output. Called as (X, grad, grad_F)."""
+    N, M, OH, OW = shapeGrad
+    X = tvm.placeholder(shapeX, dtype = dtype, name = "X")
+    grad = tvm.placeholder(shapeGrad, dtype = dtype, name = "grad")
+    X_pad = pad_nchw(X, padding, dtype)
 
+    rn = tvm.reduce_axis((0, N), name = "rn")
+    ri = tvm.reduce_axis((0, OH), name = "ri")
+    rj = tvm.reduce_axis((0, OW), name = "rj")
+
+    acc = tvm.compute(shapeF, lambda m, c, r, s: tvm.sum(
+        widen(grad[rn, m, ri, rj], dtype) *
+        widen(X_pad[rn, c, ri * stride + r, rj * stride + s], dtype),
+        axis = [rn, ri, rj]), name = "acc")
+    Z = narrow_tensor(acc, dtype, name = "grad_F")
+
+    s = tvm.create_schedule(Z.op)
+    if padding > 0:
+        s[X_pad].compute_inline()
+    # filters are small, the channels give the parallelism
+    stage = s[acc]
+    m, c, r, w = acc.op.axis
+    outer = stage.fuse(m, c)
+    stage.reorder(outer, rn, ri, r, rj, w)
+    stage.parallel(outer)
+    schedule_narrow(s, acc, Z)
+    f = tvm.build(s, [X, grad, Z], tgt, target_host=tgt_host, name=func_name)
+    return f
+
+
+def softmax_stages(X, shape):
+    """The stages a softmax of the rows of X is built from: row max,
+    exp(X - max) and its row sum, in accum_dtype(X.dtype)."""
     rj = tvm.reduce_axis((0, shape[1]), name = "rj")
     rej = tvm.reduce_axis((0, shape[1]), name = "rej")
 
-    m_X = tvm.compute((shape[0],), lambda i: tvm.max(X[i, rj], axis = rj), name = "m_X")
-    e_X = tvm.compute(shape, lambda i, j: tvm.exp(X[i, j] - m_X[i]), name = "e_X")
+    x = lambda i, j: widen(X[i, j], X.dtype)
+    m_X = tvm.compute((shape[0],), lambda i: tvm.max(x(i, rj), axis = rj), name = "m_X")
+    e_X = tvm.compute(shape, lambda i, j: tvm.exp(x(i, j) - m_X[i]), name = "e_X")
     s_eX = tvm.compute((shape[0],), lambda i: tvm.sum(e_X[i, rej], axis = rej), name = "s_eX")
-    Z = tvm.compute(shape, lambda i, j: e_X[i, j] / s_eX[i], name = "Z")
+    return m_X, e_X, s_eX
+
+
+def schedule_rows(s, out, shape):
+    """Runs the rows of out, for a softmax over rows of shape, in parallel
+    and vectorizes the columns of 2d outputs."""
+    stage = s[out]
+    if len(out.op.axis) > 1:
+        jo, ji = stage.split(out.op.axis[1], factor=VECTOR_WIDTH)
+        stage.vectorize(ji)
+    size = static_size(shape)
+    if size is None or size >= PARALLEL_THRESHOLD:
+        stage.parallel(out.op.axis[0])
+
+
+@cached
+def make_matrix_softmax(shape, tgt, tgt_host, func_name, dtype="float32"):
+    """Softmax of the rows of X, computed as
+        e_x = np.exp(x - np.max(x))
+        softmax(x)= e_x / e_x.sum()
+    for stability. Each row is one parallel task: its max, exponentials and
+    sum are computed into row sized buffers right before it is written.
+    """
+    X = tvm.placeholder(shape, dtype = dtype, name = "X")
+
+    m_X, e_X, s_eX = softmax_stages(X, shape)
+    Z = tvm.compute(shape, lambda i, j: narrow(e_X[i, j] / s_eX[i], dtype),
+                    name = "Z")
 
     s = tvm.create_schedule([Z.op])
+    schedule_rows(s, Z, shape)
+    row = Z.op.axis[0]
+    s[m_X].compute_at(s[Z], row)
+    s[e_X].compute_at(s[Z], row)
+    jo, ji = s[e_X].split(e_X.op.axis[1], factor=VECTOR_WIDTH)
+    s[e_X].vectorize(ji)
+    s[s_eX].compute_at(s[Z], row)
     f = tvm.build(s, [X, Z], tgt, target_host=tgt_host, name=func_name)
 
     return f
 
+@cached
 def make_matrix_softmax_cross_entropy(shape, tgt, tgt_host, func_name,
-                                      dtype="float32"):
-    """TODO: Your code here"""
-    """Hint: output shape should be (1,)"""
+                                      dtype="float32", with_probs=False):
+    """Mean over rows of -sum(T * log(softmax(X))), of shape (1,).
+
+    With with_probs, the kernel also writes the softmax to a fourth
+    argument of the input's shape, for the gradient.
+
+    log(softmax(X)) is taken as X - max - log(sum(exp(X - max))), so no
+    matrix sized intermediate is stored. The per row losses are summed by
+    parallel tasks of ROWS_PER_TASK rows each (rfactor), then serially
+    over the tasks.
+    """
     X = tvm.placeholder(shape, dtype = dtype, name = "X")
     T = tvm.placeholder(shape, dtype = dtype, name = "T")
 
     # softmax
-    rj = tvm.reduce_axis((0, shape[1]), name = "rj")
-    rej = tvm.reduce_axis((0, shape[1]), name = "rej")
+    m_X, e_X, s_eX = softmax_stages(X, shape)
+    y = tvm.compute(shape, lambda i, j: narrow(e_X[i, j] / s_eX[i], dtype),
+                    name = "y")
 
-    m_X = tvm.compute((shape[0],), lambda i: tvm.max(X[i, rj], axis = rj), name = "m_X")
-    e_X = tvm.compute(shape, lambda i, j: tvm.exp(X[i, j] - m_X[i]), name = "e_X")
-    s_eX = tvm.compute((shape[0],), lambda i: tvm.sum(e_X[i, rej], axis = rej), name = "s_eX")
-    y = tvm.compute(shape, lambda i, j: e_X[i, j] / s_eX[i], name = "y")
-
-    # the t * log(y) term
-    y_log= tvm.compute(shape, lambda i, j: T[i, j] * tvm.log(y[i, j]), name = "y_log")
+    # the t * log(y) term, summed per row
+    rj_ce = tvm.reduce_axis((0, shape[1]), name = "rj")
+    y_log = tvm.compute((shape[0],), lambda i: tvm.sum(
+        widen(T[i, rj_ce], dtype) *
+        (widen(X[i, rj_ce], dtype) - m_X[i] - tvm.log(s_eX[i])),
+        axis = rj_ce), name = "y_log")
 
     ri_ce = tvm.reduce_axis((0, shape[0]), name = "ri")
-    rj_ce = tvm.reduce_axis((0, shape[1]), name = "rj")
 
-    scale = tvm.const(-shape[0], dtype)
+    # the batch size may be symbolic
+    acc = accum_dtype(dtype)
+    scale = tvm.const(-1, acc) * tvm.convert(shape[0]).astype(acc)
 
     # the result
-    Z_us = tvm.compute((1,), lambda i: tvm.sum(y_log[ri_ce, rj_ce], axis = [ri_ce, rj_ce]), name = "Z_us")
-    Z = tvm.compute((1,), lambda i: Z_us[i] / scale, name = "Z")
-
-
-    s = tvm.create_schedule([Z.op])
-    f = tvm.build(s, [X, T, Z], tgt, target_host=tgt_host, name=func_name)
+    Z_us = tvm.compute((1,), lambda i: tvm.sum(y_log[ri_ce], axis = ri_ce), name = "Z_us")
+    Z = tvm.compute((1,), lambda i: narrow(Z_us[i] / scale, dtype), name = "Z")
+
+    outputs = [Z.op, y.op] if with_probs else [Z.op]
+    s = tvm.create_schedule(outputs)
+    # row statistics are shared by the loss and the probabilities, the
+    # exponentials are recomputed where needed
+    s[e_X].compute_inline()
+    schedule_rows(s, m_X, shape)
+    schedule_rows(s, s_eX, shape)
+    if with_probs:
+        schedule_rows(s, y, shape)
+    # tree reduction: partial sums over chunks of rows in parallel
+    ko, ki = s[Z_us].split(ri_ce, factor=ROWS_PER_TASK)
+    Z_partial = s.rfactor(Z_us, ko)
+    s[Z_partial].parallel(s[Z_partial].op.axis[0])
+    s[y_log].compute_at(s[Z_partial], s[Z_partial].op.reduce_axis[0])
+
+    args = [X, T, Z, y] if with_probs else [X, T, Z]
+    f = tvm.build(s, args, tgt, target_host=tgt_host, name=func_name)
     return f
 
+@cached
 def make_reduce_sum_axis_zero(shape, tgt, tgt_host, func_name, dtype="float32"):
     A = tvm.placeholder(shape, dtype=dtype, name="A")
-    C = topi.sum(A, axis=0, keepdims=False)
+    k = tvm.reduce_axis((0, shape[0]), name="k")
+    if len(shape) == 1:
+        # vectors reduce to (1,), see ReduceSumAxisZeroOp.infer_shape
+        C = tvm.compute((1,), lambda i: tvm.sum(widen(A[k], dtype), axis=k))
+    else:
+        C = tvm.compute(shape[1:], lambda *i: tvm.sum(
+            widen(A(k, *i), dtype), axis=k))
+    Z = narrow_tensor(C, dtype)
 
-    s = tvm.create_schedule(C.op)
-    f = tvm.build(s, [A, C], tgt, target_host=tgt_host, name=func_name)
+    s = tvm.create_schedule(Z.op)
+    schedule_elementwise(s, C)
+    schedule_narrow(s, C, Z)
+    f = tvm.build(s, [A, Z], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+def broadcast_index(shape, index):
+    """Index into a tensor of shape broadcast to the shape of index: leading
+    axes are new and axes of size 1 are stretched."""
+    offset = len(index) - len(shape)
+    return [0 if isinstance(d, int) and d == 1 else index[offset + axis]
+            for axis, d in enumerate(shape)]
+
+
+@cached
 def make_broadcast_to(shape, to_shape, tgt, tgt_host, func_name,
                       dtype="float32"):
     A = tvm.placeholder(shape, dtype=dtype, name="A")
-    C = topi.broadcast_to(A, to_shape)
+    C = tvm.compute(to_shape, lambda *i: A(*broadcast_index(shape, i)))
 
     s = tvm.create_schedule(C.op)
+    schedule_elementwise(s, C)
     f = tvm.build(s, [A, C], tgt, target_host=tgt_host, name=func_name)
     return f
 
 
+@cached
+def make_bias_add(shape, shapeB, tgt, tgt_host, func_name, dtype="float32"):
+    """A + np.broadcast_to(B, A.shape) without storing the broadcast: B, e.g.
+    the bias of a dense layer, is indexed by the trailing axes of A."""
+    A = tvm.placeholder(shape, dtype=dtype, name="A")
+    B = tvm.placeholder(shapeB, dtype=dtype, name="B")
+    C = tvm.compute(shape, lambda *i: narrow(widen(A(*i), dtype) + widen(
+        B(*broadcast_index(shapeB, i)), dtype), dtype))
+
+    s = tvm.create_schedule(C.op)
+    if len(shape) == 2:
+        # a vector of columns at a time, every row reads the same vector of
+        # B instead of computing its index from a fused one
+        stage = s[C]
+        row, column = C.op.axis
+        _, inner = stage.split(column, factor=VECTOR_WIDTH)
+        stage.vectorize(inner)
+        size = static_size(shape)
+        if size is None or size >= PARALLEL_THRESHOLD:
+            stage.parallel(row)
+    else:
+        schedule_elementwise(s, C)
+    f = tvm.build(s, [A, B, C], tgt, target_host=tgt_host, name=func_name)
+    return f
+
+
+@cached
 def make_sgd_update(shape, learning_rate, tgt, tgt_host, func_name,
                     dtype="float32"):
     X = tvm.placeholder(shape, dtype=dtype, name="A")
     grad = tvm.placeholder(shape, dtype=dtype, name="grad")
-    Y = tvm.compute(shape, lambda *i: X(*i) - learning_rate * grad(*i))
+    Y = tvm.compute(shape, lambda *i: narrow(
+        widen(X(*i), dtype) - learning_rate * widen(grad(*i), dtype), dtype))
 
     s = tvm.create_schedule(Y.op)
+    schedule_elementwise(s, Y)
     f = tvm.build(s, [X, grad, Y], tgt, target_host=tgt_host, name=func_name)
     return f
+
+
+@cached
+def make_multi_sgd_update(shapes, learning_rate, tgt, tgt_host, func_name,
+                          dtype="float32"):
+    """SGD updates of several parameters in one kernel, called with all
+    parameters, then all gradients, then all outputs."""
+    params = [tvm.placeholder(shape, dtype=dtype, name="A%d" % k)
+              for k, shape in enumerate(shapes)]
+    grads = [tvm.placeholder(shape, dtype=dtype, name="grad%d" % k)
+             for k, shape in enumerate(shapes)]
+    outs = [tvm.compute(shape, lambda *i, X=X, grad=grad: narrow(
+                widen(X(*i), dtype) - learning_rate * widen(grad(*i), dtype),
+                dtype))
+            for shape, X, grad in zip(shapes, params, grads)]
+
+    s = tvm.create_schedule([Y.op for Y in outs])
+    for Y in outs:
+        schedule_elementwise(s, Y)
+    f = tvm.build(s, params + grads + outs, tgt, target_host=tgt_host,
+                  name=func_name)
+    return f
+
+
+@cached
+def make_momentum_update(shape, tgt, tgt_host, func_name, dtype="float32"):
+    """Momentum SGD in one pass over the parameter:
+        velocity = momentum * velocity + grad
+        param = param - learning_rate * velocity
+
+    The hyperparameters are arguments of the kernel, so changing them needs
+    no rebuild. It is called as (param, grad, velocity, learning_rate,
+    momentum, param_out, velocity_out), the outputs may be the inputs.
+    """
+    X = tvm.placeholder(shape, dtype=dtype, name="A")
+    grad = tvm.placeholder(shape, dtype=dtype, name="grad")
+    V = tvm.placeholder(shape, dtype=dtype, name="velocity")
+    learning_rate = tvm.var("learning_rate", dtype=accum_dtype(dtype))
+    momentum = tvm.var("momentum", dtype=accum_dtype(dtype))
+
+    def update(*i):
+        v = momentum * widen(V(*i), dtype) + widen(grad(*i), dtype)
+        return (narrow(widen(X(*i), dtype) - learning_rate * v, dtype),
+                narrow(v, dtype))
+    Y, V_out = tvm.compute(shape, update, name="momentum_update")
+
+    s = tvm.create_schedule(Y.op)
+    schedule_elementwise(s, Y)
+    f = tvm.build(s, [X, grad, V, learning_rate, momentum, Y, V_out], tgt,
+                  target_host=tgt_host, name=func_name)
+    return f
+
+
+@cached
+def make_adam_update(shape, tgt, tgt_host, func_name, dtype="float32"):
+    """Adam in one pass over the parameter:
+        m = beta1 * m + (1 - beta1) * grad
+        v = beta2 * v + (1 - beta2) * grad^2
+        param = param - learning_rate * sqrt(c2) / c1 * m / (sqrt(v) + epsilon)
+
+    where c1, c2 are the bias corrections 1 - beta1^t and 1 - beta2^t of
+    step t. They are kept in a float32 buffer of shape (2,), starting from
+    zeros, which the kernel advances to the current step before the update,
+    so no step count goes through the host. It is called as (param, grad,
+    m, v, corrections, learning_rate, beta1, beta2, epsilon, param_out,
+    m_out, v_out, corrections_out), the outputs may be the inputs.
+    """
+    acc = accum_dtype(dtype)
+    ONE = tvm.const(1, acc)
+    X = tvm.placeholder(shape, dtype=dtype, name="A")
+    grad = tvm.placeholder(shape, dtype=dtype, name="grad")
+    M = tvm.placeholder(shape, dtype=dtype, name="m")
+    V = tvm.placeholder(shape, dtype=dtype, name="v")
+    C = tvm.placeholder((2,), dtype="float32", name="corrections")
+    learning_rate = tvm.var("learning_rate", dtype=acc)
+    beta1 = tvm.var("beta1", dtype=acc)
+    beta2 = tvm.var("beta2", dtype=acc)
+    epsilon = tvm.var("epsilon", dtype=acc)
+
+    # the corrections are float32 whatever dtype is
+    load = lambda x: x if acc == "float32" else x.astype(acc)
+    store = lambda x: x if acc == "float32" else x.astype("float32")
+
+    # 1 - beta^(t+1) = 1 - beta + beta * (1 - beta^t)
+    def correction(i):
+        beta = tvm.select(tvm.make.EQ(i, 0), beta1, beta2)
+        return store(ONE - beta + beta * load(C[i]))
+    C_out = tvm.compute((2,), correction, name="corrections_out")
+    step_size = tvm.compute((1,), lambda i: learning_rate * tvm.sqrt(
+        load(C_out[1])) / load(C_out[0]), name="step_size")
+
+    def update(*i):
+        g = widen(grad(*i), dtype)
+        m = beta1 * widen(M(*i), dtype) + (ONE - beta1) * g
+        v = beta2 * widen(V(*i), dtype) + (ONE - beta2) * g * g
+        return (narrow(widen(X(*i), dtype) -
+                       step_size[0] * m / (tvm.sqrt(v) + epsilon), dtype),
+                narrow(m, dtype), narrow(v, dtype))
+    Y, M_out, V_out = tvm.compute(shape, update, name="adam_update")
+
+    s = tvm.create_schedule([Y.op, C_out.op])
+    schedule_elementwise(s, Y)
+    f = tvm.build(s, [X, grad, M, V, C, learning_rate, beta1, beta2, epsilon,
+                      Y, M_out, V_out, C_out],
+                  tgt, target_host=tgt_host, name=func_name)
+    return f
+
+
+@cached
+def make_fused_elementwise(shapes, program, tgt, tgt_host, func_name,
+                           dtype="float32"):
+    """One kernel for a group of elementwise ops, see
+    autodiff.FusedElementwiseOp.
+
+    shapes are the shapes of the inputs. Each step of program is a tuple
+    (kind, refs, const): refs index into the inputs followed by the steps,
+    and the last step is the output. Intermediate steps are never stored.
+    The last step may be a reduce_sum_axis_zero, which sums the elementwise
+    steps before it as they are computed, see
+    autodiff.FusedReduceSumAxisZeroOp.
+    """
+    ZERO = tvm.const(0, accum_dtype(dtype))
+    inputs = [tvm.placeholder(shape, dtype=dtype, name="A%d" % k)
+              for k, shape in enumerate(shapes)]
+    value_shapes = [tuple(shape) for shape in shapes]
+    for kind, refs, _ in program:
+        if kind == "broadcast_to":
+            value_shapes.append(value_shapes[refs[1]])
+        elif kind == "reduce_sum_axis_zero":
+            shape = value_shapes[refs[0]]
+            value_shapes.append(shape[1:] if len(shape) > 1 else (1,))
+        else:
+            value_shapes.append(value_shapes[refs[0]])
+
+    # steps read by several others are built once per index, the cache is
+    # keyed by id and keeps the index alive so the id isn't reused
+    def memoized(key, index, cache, make):
+        key = key + (id(index),)
+        if key not in cache:
+            cache[key] = (index, make())
+        return cache[key][1]
+
+    def ref_index(ref, index, cache):
+        return memoized(("index", ref), index, cache, lambda: tuple(
+            broadcast_index(value_shapes[ref], index)))
+
+    def value(v, index, cache):
+        return memoized(("value", v), index, cache,
+                        lambda: step_value(v, index, cache))
+
+    def step_value(v, index, cache):
+        if v < len(inputs):
+            return widen(inputs[v](*index), dtype)
+        kind, refs, const = program[v - len(inputs)]
+        if kind == "broadcast_to":
+            return value(refs[0], ref_index(refs[0], index, cache), cache)
+        if kind == "bias_add":
+            return value(refs[0], index, cache) + value(
+                refs[1], ref_index(refs[1], index, cache), cache)
+        args = [value(r, index, cache) for r in refs]
+        if kind == "add":
+            return args[0] + args[1]
+        elif kind == "mul":
+            return args[0] * args[1]
+        elif kind == "add_const":
+            return args[0] + const
+        elif kind == "mul_const":
+            return args[0] * const
+        elif kind == "relu":
+            return tvm.max(args[0], ZERO)
+        elif kind == "relu_gradient":
+            return tvm.select(args[0] > ZERO, args[1], ZERO)
+        raise ValueError("cannot fuse %s" % kind)
+
+    out = len(value_shapes) - 1
+    kind, refs, _ = program[-1]
+    if kind == "reduce_sum_axis_zero":
+        summed = refs[0]
+        k = tvm.reduce_axis((0, value_shapes[summed][0]), name="k")
+        if len(value_shapes[summed]) == 1:
+            C = tvm.compute((1,), lambda i: tvm.sum(
+                value(summed, (k,), {}), axis=k))
+        else:
+            C = tvm.compute(value_shapes[out], lambda *i: tvm.sum(
+                value(summed, (k,) + i, {}), axis=k))
+    else:
+        C = tvm.compute(value_shapes[out], lambda *i: narrow(
+            value(out, i, {}), dtype))
+    Z = narrow_tensor(C, dtype)
+
+    s = tvm.create_schedule(Z.op)
+    schedule_elementwise(s, C)
+    schedule_narrow(s, C, Z)
+    f = tvm.build(s, inputs + [Z], tgt, target_host=tgt_host, name=func_name)
+    return f
@@ -7,7 +7,6 @@ import time
 
 import tvm
 from dlsys import autodiff as ad
-from dlsys import tvm_op
 
 
 def load_mnist_data(dataset):
@@ -60,7 +59,8 @@ def convert_to_one_hot(vals):
     return one_hot_vals
 
 
-def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
+def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False,
+                 compile_workers=1):
     print("=== Build logistic regression model...")
 
     # recover tgt, tgt_host info from tvm.context
@@ -81,7 +81,14 @@ def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
     loss = ad.softmaxcrossentropy_op(y, y_)
 
     grad_W1, grad_b1 = ad.gradients(loss, [W1, b1])
-    executor = ad.Executor([loss, grad_W1, grad_b1, y], ctx=executor_ctx)
+    # SGD update, in place once nothing reads the old values anymore
+    # W1_val = W1_val - lr * grad_W1_val
+    # b1_val = b1_val - lr * grad_b1_val
+    lr = 1e-3
+    update_W1 = ad.sgd_update_op(W1, grad_W1, lr)
+    update_b1 = ad.sgd_update_op(b1, grad_b1, lr)
+    executor = ad.Executor([loss, y, update_W1, update_b1], ctx=executor_ctx,
+                           compile_workers=compile_workers)
 
     # Read input data
     datasets = load_mnist_data("mnist.pkl.gz")
@@ -113,12 +120,6 @@ def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
     valid_y_val = tvm.nd.array(valid_y_val, ctx=executor_ctx)
 
     # training loop
-    lr = 1e-3
-    # JIT compile sgd update ops
-    W1_sgd_update_func = tvm_op.make_sgd_update(
-        W1_val.shape, lr, tgt, tgt_host, "W1_sgd_update")
-    b1_sgd_update_func = tvm_op.make_sgd_update(
-        b1_val.shape, lr, tgt, tgt_host, "b1_sgd_update")
     time_measurements = []
     for i in range(num_epochs):
         print("epoch %d" % i)
@@ -129,13 +130,8 @@ def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
             X_val.copyfrom(train_set_x[minibatch_start:minibatch_end])
             y_val.copyfrom(
                 convert_to_one_hot(train_set_y[minibatch_start:minibatch_end]))
-            loss_val, grad_W1_val, grad_b1_val, _ = executor.run(
+            loss_val, _, _, _ = executor.run(
                 feed_dict = {X: X_val, y_: y_val, W1: W1_val, b1: b1_val})
-            # SGD update
-            # W1_val = W1_val - lr * grad_W1_val
-            # b1_val = b1_val - lr * grad_b1_val
-            W1_sgd_update_func(W1_val, grad_W1_val, W1_val)
-            b1_sgd_update_func(b1_val, grad_b1_val, b1_val)
         time_measurements.append(time.time() - start_time)
         if print_loss_val_each_epoch:
             print("loss = %f; Time taken this epoch = %f s"
@@ -148,13 +144,13 @@ def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
         valid_X_val.copyfrom(valid_set_x[minibatch_start:minibatch_end])
         valid_y_val.copyfrom(
             convert_to_one_hot(valid_set_y[minibatch_start:minibatch_end]))
-        _, _, _, valid_y_predicted = executor.run(
+        valid_y_predicted, = executor.run(
             feed_dict={
                         X: valid_X_val,
                         y_: valid_y_val,
                         W1: W1_val,
                         b1: b1_val},
-            convert_to_numpy_ret_vals=True)
+            convert_to_numpy_ret_vals=True, fetches=[y])
         correct_prediction = np.equal(
             np.argmax(valid_y_val.asnumpy(), 1),
             np.argmax(valid_y_predicted, 1)).astype(np.float)
@@ -166,7 +162,7 @@ def mnist_logreg(executor_ctx, num_epochs=10, print_loss_val_each_epoch=False):
 
 
 def mnist_mlp(executor_ctx=None, num_epochs=10,
-              print_loss_val_each_epoch=False):
+              print_loss_val_each_epoch=False, compile_workers=1):
     print("=== Build 3-layer MLP model...")
 
     # recover tgt, tgt_host info from tvm.context
@@ -201,11 +197,15 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
 
     loss = ad.softmaxcrossentropy_op(y, y_)
 
-    grad_W1, grad_W2, grad_W3, grad_b1, grad_b2, grad_b3 = ad.gradients(
-        loss, [W1, W2, W3, b1, b2, b3])
-    executor = ad.Executor(
-        [loss, grad_W1, grad_W2, grad_W3, grad_b1, grad_b2, grad_b3, y],
-        ctx=executor_ctx)
+    params = [W1, W2, W3, b1, b2, b3]
+    grads = ad.gradients(loss, params)
+    # SGD update of all parameters with one kernel, e.g.
+    # W1_val = W1_val - lr * grad_W1_val
+    lr = 1.0e-3
+    update = ad.multi_sgd_update_op(params, grads, lr)
+    # parallel compile is opt-in, see Executor
+    executor = ad.Executor([loss, y, update], ctx=executor_ctx,
+                           compile_workers=compile_workers)
 
     # Read input data
     datasets = load_mnist_data("mnist.pkl.gz")
@@ -245,20 +245,6 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
     valid_y_val = tvm.nd.array(valid_y_val, ctx=executor_ctx)
 
     # training loop
-    lr = 1.0e-3
-    # JIT compile sgd update ops
-    W1_sgd_update_func = tvm_op.make_sgd_update(
-        W1_val.shape, lr, tgt, tgt_host, "W1_sgd_update")
-    W2_sgd_update_func = tvm_op.make_sgd_update(
-        W2_val.shape, lr, tgt, tgt_host, "W2_sgd_update")
-    W3_sgd_update_func = tvm_op.make_sgd_update(
-        W3_val.shape, lr, tgt, tgt_host, "W3_sgd_update")
-    b1_sgd_update_func = tvm_op.make_sgd_update(
-        b1_val.shape, lr, tgt, tgt_host, "b1_sgd_update")
-    b2_sgd_update_func = tvm_op.make_sgd_update(
-        b2_val.shape, lr, tgt, tgt_host, "b2_sgd_update")
-    b3_sgd_update_func = tvm_op.make_sgd_update(
-        b3_val.shape, lr, tgt, tgt_host, "b3_sgd_update")
     time_measurements = []
     for i in range(num_epochs):
         print("epoch %d" % i)
@@ -269,8 +255,7 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
             X_val.copyfrom(train_set_x[minibatch_start:minibatch_end])
             y_val.copyfrom(
                 convert_to_one_hot(train_set_y[minibatch_start:minibatch_end]))
-            loss_val, grad_W1_val, grad_W2_val, grad_W3_val, \
-                grad_b1_val, grad_b2_val, grad_b3_val, _ = executor.run(
+            loss_val, _, _ = executor.run(
                     feed_dict={
                         X: X_val,
                         y_: y_val,
@@ -280,19 +265,6 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
                         b1: b1_val,
                         b2: b2_val,
                         b3: b3_val})
-            # SGD update
-            # W1_val = W1_val - lr * grad_W1_val
-            # W2_val = W2_val - lr * grad_W2_val
-            # W3_val = W3_val - lr * grad_W3_val
-            # b1_val = b1_val - lr * grad_b1_val
-            # b2_val = b2_val - lr * grad_b2_val
-            # b3_val = b3_val - lr * grad_b3_val
-            W1_sgd_update_func(W1_val, grad_W1_val, W1_val)
-            W2_sgd_update_func(W2_val, grad_W2_val, W2_val)
-            W3_sgd_update_func(W3_val, grad_W3_val, W3_val)
-            b1_sgd_update_func(b1_val, grad_b1_val, b1_val)
-            b2_sgd_update_func(b2_val, grad_b2_val, b2_val)
-            b3_sgd_update_func(b3_val, grad_b3_val, b3_val)
 
         time_measurements.append(time.time() - start_time)
         if print_loss_val_each_epoch:
@@ -307,7 +279,7 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
         valid_X_val.copyfrom(valid_set_x[minibatch_start:minibatch_end])
         valid_y_val.copyfrom(
             convert_to_one_hot(valid_set_y[minibatch_start:minibatch_end]))
-        _, _, _, _, _, _, _, valid_y_predicted = executor.run(
+        valid_y_predicted, = executor.run(
             feed_dict={
                 X: valid_X_val,
                 y_: valid_y_val,
@@ -317,7 +289,7 @@ def mnist_mlp(executor_ctx=None, num_epochs=10,
                 b1: b1_val,
                 b2: b2_val,
                 b3: b3_val},
-            convert_to_numpy_ret_vals=True)
+            convert_to_numpy_ret_vals=True, fetches=[y])
         correct_prediction = np.equal(
             np.argmax(valid_y_val.asnumpy(), 1),
             np.argmax(valid_y_predicted, 1)).astype(np.float)
@@ -342,6 +314,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "-l", "--print_loss_val_each_epoch",
         help="Print loss value at the end of each epoch", action="store_true")
+    parser.add_argument(
+        "-w", "--compile_workers",
+        help="Number of processes compiling kernels, default one per core",
+        type=int, default=os.cpu_count() or 1)
     args = parser.parse_args()
 
     models = []
@@ -368,4 +344,5 @@ if __name__ == "__main__":
                                      else False
     num_epochs = args.num_epoch
     for m in models:
-        m(executor_ctx, num_epochs, print_loss_val_each_epoch)
+        m(executor_ctx, num_epochs, print_loss_val_each_epoch,
+          compile_workers=args.compile_workers)
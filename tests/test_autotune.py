@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+from dlsys import autotune
+from dlsys import kernel_cache
+
+
+def test_tuning_log_persists():
+    path = os.path.join(tempfile.mkdtemp(), "tuning.json")
+    log = autotune.TuningLog(path)
+    assert len(log) == 0
+    key = autotune.matmul_key((1000, 784), False, [784, 256], False,
+                              "llvm", "float32")
+    log.put(key, (32, 16, 8, "xo_yo_ko"), 0.001)
+    assert log.get(key) == (32, 16, 8, "xo_yo_ko")
+    assert log.get(autotune.matmul_key(
+        (1000, 784), True, (784, 256), False, "llvm", "float32")) is None
+
+    # a new process reads the file
+    log = autotune.TuningLog(path)
+    assert log.get(key) == (32, 16, 8, "xo_yo_ko")
+    assert os.listdir(os.path.dirname(path)) == ["tuning.json"]
+
+
+def test_matrix_mul_uses_tuned_config():
+    import numpy as np
+    import tvm
+    from dlsys import tvm_op
+    ctx = tvm.cpu(0)
+    shapeA, shapeB = (100, 40), (40, 10)
+    autotune.set_tuning_log(os.path.join(tempfile.mkdtemp(), "tuning.json"))
+    try:
+        kernel_cache.kernel_cache.clear()
+        assert autotune.matmul_config(shapeA, False, shapeB, False, "llvm",
+            "float32") == tvm_op.DEFAULT_MATMUL_CONFIG
+        config, time = autotune.tune_matrix_mul(
+            shapeA, False, shapeB, False, trials=4, number=2)
+        assert time > 0
+        assert autotune.matmul_config(
+            shapeA, False, shapeB, False, "llvm", "float32") == config
+        # tuning builds outside the kernel cache
+        assert len(kernel_cache.kernel_cache) == 0
+
+        matrix_mul = tvm_op.make_matrix_mul(
+            shapeA, False, shapeB, False, "llvm", "llvm", "matrix_mul")
+        a = np.random.uniform(-1, 1, shapeA).astype("float32")
+        b = np.random.uniform(-1, 1, shapeB).astype("float32")
+        arr_c = tvm.nd.array(np.zeros((100, 10), dtype="float32"), ctx=ctx)
+        matrix_mul(tvm.nd.array(a, ctx=ctx), tvm.nd.array(b, ctx=ctx), arr_c)
+        np.testing.assert_allclose(a.dot(b), arr_c.asnumpy(), rtol=1e-5)
+    finally:
+        autotune.set_tuning_log(None)
+
+
+def test_dense_uses_tuned_config():
+    import numpy as np
+    import tvm
+    from dlsys import tvm_op
+    ctx = tvm.cpu(0)
+    shapeX, shapeW = (100, 40), (40, 10)
+    config = (32, 8, 4, "xo_yo_ko_ki")
+    autotune.set_tuning_log(os.path.join(tempfile.mkdtemp(), "tuning.json"))
+    try:
+        kernel_cache.kernel_cache.clear()
+        autotune.tuning_log.put(autotune.matmul_key(
+            shapeX, False, shapeW, False, "llvm", "float32"), config, 0.001)
+        dense = tvm_op.make_dense(shapeX, False, shapeW, False, (10,), True,
+                                  "llvm", "llvm", "dense")
+        # the configuration is part of the kernel key
+        assert [key for key in kernel_cache.kernel_cache.entries
+                if "xo_yo_ko_ki" in repr(key)]
+
+        x = np.random.uniform(-1, 1, shapeX).astype("float32")
+        w = np.random.uniform(-1, 1, shapeW).astype("float32")
+        b = np.random.uniform(-1, 1, (10,)).astype("float32")
+        arr_z = tvm.nd.array(np.zeros((100, 10), dtype="float32"), ctx=ctx)
+        dense(tvm.nd.array(x, ctx=ctx), tvm.nd.array(w, ctx=ctx),
+              tvm.nd.array(b, ctx=ctx), arr_z)
+        np.testing.assert_allclose(
+            np.maximum(x.dot(w) + b, 0), arr_z.asnumpy(), rtol=1e-5)
+
+        # loop orders no longer known fall back to the default
+        autotune.tuning_log.put(autotune.matmul_key(
+            shapeX, False, shapeW, False, "llvm", "float32"),
+            (32, 8, 4, "xo_yo_ki"), 0.001)
+        assert autotune.matmul_config(shapeX, False, shapeW, False, "llvm",
+            "float32") == tvm_op.DEFAULT_MATMUL_CONFIG
+    finally:
+        autotune.set_tuning_log(None)
@@ -0,0 +1,646 @@
+import numpy as np
+import pytest
+import tvm
+from dlsys import autodiff as ad
+from dlsys import kernel_cache
+from dlsys import scheduler_sim
+
+tgt_host="llvm"
+tgt="llvm"
+dtype = "float32"
+ctx = tvm.context(tgt, 0)
+
+
+def build_mlp():
+    """relu(X W1 + b1) W2 + b2 with softmax cross entropy and gradients."""
+    X = ad.Variable(name="X")
+    y_ = ad.Variable(name="y_")
+    W1 = ad.Variable(name="W1")
+    b1 = ad.Variable(name="b1")
+    W2 = ad.Variable(name="W2")
+    b2 = ad.Variable(name="b2")
+
+    z1 = ad.matmul_op(X, W1)
+    z2 = z1 + ad.broadcastto_op(b1, z1)
+    z3 = ad.relu_op(z2)
+    z4 = ad.matmul_op(z3, W2)
+    y = z4 + ad.broadcastto_op(b2, z4)
+    loss = ad.softmaxcrossentropy_op(y, y_)
+
+    grads = ad.gradients(loss, [W1, b1, W2, b2])
+    params = [X, y_, W1, b1, W2, b2]
+    return params, [loss, y] + grads
+
+
+def make_mlp_feed(params, batch_size=64):
+    X, y_, W1, b1, W2, b2 = params
+    rand = np.random.RandomState(seed=0)
+    labels = rand.randint(0, 10, size=batch_size)
+    values = {
+        X: rand.uniform(-1, 1, (batch_size, 30)),
+        y_: np.eye(10)[labels],
+        W1: rand.normal(scale=0.1, size=(30, 20)),
+        b1: rand.normal(scale=0.1, size=(20,)),
+        W2: rand.normal(scale=0.1, size=(20, 10)),
+        b2: rand.normal(scale=0.1, size=(10,)),
+    }
+    return dict((node, tvm.nd.array(val.astype(dtype), ctx=ctx))
+                for node, val in values.items())
+
+
+def assert_all_close(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        np.testing.assert_allclose(e, a, rtol=1e-5, atol=1e-6)
+
+
+def test_memory_reuse():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+
+    reference = ad.Executor(outputs, ctx=ctx, memory_reuse=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    executor = ad.Executor(outputs, ctx=ctx)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    assert executor.storage_nbytes < reference.storage_nbytes
+
+    # nodes execute out of order, shared storage has to be respected
+    for _ in range(3):
+        assert_all_close(expected, executor.run_with_dependency_engine(
+            feed_dict, convert_to_numpy_ret_vals=True))
+
+    arena = ad.Executor(outputs, ctx=ctx, best_fit=True)
+    assert_all_close(
+        expected, arena.run(feed_dict, convert_to_numpy_ret_vals=True))
+    assert arena.storage_nbytes <= executor.storage_nbytes
+
+
+def test_inplace_elementwise():
+    X = ad.Variable(name="X")
+    z1 = ad.relu_op(X * 2.0)
+    z2 = ad.relu_op(z1 + 1.0)
+    y = z2 + z2
+    x = tvm.nd.array(
+        np.random.uniform(-1, 1, (100, 30)).astype(dtype), ctx=ctx)
+    x_copy = x.asnumpy()
+
+    reference = ad.Executor([y], ctx=ctx, inplace=False)
+    expected = reference.run({X: x}, convert_to_numpy_ret_vals=True)
+    executor = ad.Executor([y], ctx=ctx)
+    assert_all_close(expected, executor.run(
+        {X: x}, convert_to_numpy_ret_vals=True))
+    assert executor.storage_nbytes < reference.storage_nbytes
+    # the chain runs in a single buffer
+    assert len(set(executor.node_to_storage.values())) == 1
+    # feed values belong to the user and are left alone
+    np.testing.assert_array_equal(x_copy, x.asnumpy())
+    assert_all_close(expected, executor.run_with_dependency_engine(
+        {X: x}, convert_to_numpy_ret_vals=True))
+
+
+def test_fuse_elementwise():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    reference = ad.Executor(outputs, ctx=ctx, fuse=False, simplify=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    executor = ad.Executor(outputs, ctx=ctx, simplify=False)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    assert_all_close(expected, executor.run_with_dependency_engine(
+        feed_dict, convert_to_numpy_ret_vals=True))
+    fused = [n for n in executor.topo_order
+             if isinstance(n.op, ad.FusedElementwiseOp)]
+    assert len(fused) > 0
+    assert len(executor.topo_order) < len(reference.topo_order)
+    # the graph built by the user is left alone
+    assert len(ad.find_topo_sort(outputs)) == len(reference.topo_order)
+
+    # chains ending in an output keep the output
+    X = ad.Variable(name="X")
+    y = ad.relu_op(X * 2.0 + 1.0)
+    executor = ad.Executor([y], ctx=ctx)
+    assert len(executor.topo_order) == 2
+    x = np.random.uniform(-1, 1, (10, 5)).astype(dtype)
+    y_val, = executor.run({X: tvm.nd.array(x, ctx=ctx)},
+                          convert_to_numpy_ret_vals=True)
+    np.testing.assert_allclose(np.maximum(x * 2.0 + 1.0, 0), y_val, rtol=1e-5)
+
+    # steps read twice are built once, else the kernel grows as 2 ** depth
+    y = X
+    for _ in range(30):
+        y = (y + y) * 0.5
+    executor = ad.Executor([y], ctx=ctx)
+    assert len(executor.topo_order) == 2
+    y_val, = executor.run({X: tvm.nd.array(x, ctx=ctx)},
+                          convert_to_numpy_ret_vals=True)
+    np.testing.assert_allclose(x, y_val, rtol=1e-5)
+
+
+def test_fuse_dense():
+    params, _ = build_mlp()
+    X, y_, W1, b1, W2, b2 = params
+    z1 = ad.matmul_op(X, W1)
+    pre = z1 + ad.broadcastto_op(b1, z1)
+    h = ad.relu_op(pre)
+    z2 = ad.matmul_op(h, W2)
+    y = ad.broadcastto_op(b2, z2) + z2
+    feed_dict = make_mlp_feed(params)
+    del feed_dict[y_]
+    reference = ad.Executor([y], ctx=ctx, fuse=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    executor = ad.Executor([y], ctx=ctx)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    dense = [n for n in executor.topo_order if isinstance(n.op, ad.DenseOp)]
+    assert [n.dense_attr_relu for n in dense] == [True, False]
+    # X, W1, b1, W2, b2 and the two dense layers
+    assert len(executor.topo_order) == 7
+
+    # the pre-activation is an output, so relu stays separate
+    executor = ad.Executor([h, pre], ctx=ctx)
+    dense = [n for n in executor.topo_order if isinstance(n.op, ad.DenseOp)]
+    assert [n.dense_attr_relu for n in dense] == [False]
+
+
+def test_fuse_bias_add():
+    X = ad.Variable(name="X")
+    b = ad.Variable(name="b")
+    z = ad.relu_op(X)
+    y = ad.relu_op(z + ad.broadcastto_op(b, z))
+    grad_b, = ad.gradients(y, [b])
+    nodes = ad.fuse_bias_add([y, grad_b])
+    assert isinstance(nodes[0].inputs[0].op, ad.BiasAddOp)
+    assert not any(isinstance(n.op, ad.BroadcastToOp)
+                   for n in ad.find_topo_sort(nodes))
+
+    rand = np.random.RandomState(seed=0)
+    x = rand.uniform(-1, 1, (64, 20)).astype(dtype)
+    b_val = rand.uniform(-1, 1, (20,)).astype(dtype)
+    feed_dict = {X: tvm.nd.array(x, ctx=ctx), b: tvm.nd.array(b_val, ctx=ctx)}
+    pre = np.maximum(x, 0) + b_val
+    expected = [np.maximum(pre, 0), np.sum(pre > 0, axis=0).astype(dtype)]
+
+    executor = ad.Executor([y, grad_b], ctx=ctx)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    assert_all_close(expected, executor.run_with_dependency_engine(
+        feed_dict, convert_to_numpy_ret_vals=True))
+    # relu(X) + b and relu_gradient summed into the bias gradient
+    fused = [n for n in executor.topo_order
+             if isinstance(n.op, ad.FusedElementwiseOp)]
+    assert [type(n.op) for n in fused] == \
+        [ad.FusedElementwiseOp, ad.FusedReduceSumAxisZeroOp]
+    assert isinstance(fused[0].fused_nodes[-1].op, ad.BiasAddOp)
+    assert isinstance(fused[1].fused_nodes[0].op, ad.ReluGradientOp)
+
+
+def test_fuse_sibling_matmuls():
+    A = ad.Variable(name="A")
+    others = [ad.Variable(name="B%d" % i) for i in range(4)]
+    ys = [ad.matmul_op(A, B) + A for B in others[:3]]
+    # a different shape, and a matmul sharing its right operand
+    ys.append(ad.matmul_op(A, others[3]))
+    ys.append(ad.matmul_op(others[0], A, trans_A=True))
+    rand = np.random.RandomState(seed=0)
+    feed_dict = {A: rand.uniform(-1, 1, (40, 40))}
+    for i, B in enumerate(others):
+        feed_dict[B] = rand.uniform(-1, 1, (40, 40 if i < 3 else 24))
+    feed_dict = dict((node, tvm.nd.array(val.astype(dtype), ctx=ctx))
+                     for node, val in feed_dict.items())
+    reference = ad.Executor(ys, ctx=ctx, fuse=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    executor = ad.Executor(ys, ctx=ctx)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    multi = [n for n in executor.topo_order
+             if isinstance(n.op, ad.MultiMatMulOp)]
+    assert len(multi) == 1 and len(multi[0].inputs) == 4
+    assert len(executor.node_to_aux[multi[0]]) == 2
+    assert_all_close(expected, executor.run_with_dependency_engine(
+        feed_dict, convert_to_numpy_ret_vals=True))
+
+    kernel_cache.kernel_cache.clear()
+    lazy = ad.Executor(ys, ctx=ctx, lazy_compile=True)
+    for e, a in zip(expected, lazy.run(
+            feed_dict, convert_to_numpy_ret_vals=True)):
+        np.testing.assert_allclose(e, a, rtol=1e-4, atol=1e-5)
+
+
+def test_fuse_sibling_matmuls_between_groups():
+    # A B, A C and D E, D F with C = relu(D E) and F = relu(A B): either
+    # group needs the products of the other
+    A, B, D, E = [ad.Variable(name=name) for name in "ABDE"]
+    AB = ad.matmul_op(A, B)
+    DE = ad.matmul_op(D, E)
+    ys = [ad.matmul_op(A, ad.relu_op(DE)), ad.matmul_op(D, ad.relu_op(AB))]
+    rand = np.random.RandomState(seed=0)
+    feed_dict = dict((node, tvm.nd.array(
+        rand.uniform(-1, 1, (20, 20)).astype(dtype), ctx=ctx))
+        for node in [A, B, D, E])
+    shapes = ad.infer_shapes(ad.find_topo_sort(ys), dict(
+        (node, val.shape) for node, val in feed_dict.items()))
+    fused = ad.fuse_sibling_matmuls(ys, shapes)
+    multi = [n for n in ad.find_topo_sort(fused)
+             if isinstance(n.op, ad.MultiMatMulOp)]
+    assert len(multi) == 1
+
+    reference = ad.Executor(ys, ctx=ctx, fuse=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+    executor = ad.Executor(ys, ctx=ctx)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+
+
+def test_simplify_graph():
+    X = ad.Variable(name="X")
+    Y = ad.Variable(name="Y")
+    a = ad.softmax_op(X) * 1 + 0
+    b = ad.softmax_op(X) + ad.zeroslike_op(ad.oneslike_op(Y))
+    c = (X * 2.0) * 3.0 + ad.broadcastto_op(ad.zeroslike_op(Y), X) * Y
+    a, b, c = ad.simplify_graph([a, b, c])
+    assert a is b and isinstance(a.op, ad.SoftmaxOp)
+    assert isinstance(c.op, ad.MulByConstOp) and c.const_attr == 6.0
+    assert c.inputs == [X]
+    # variables are never merged
+    d, e = ad.simplify_graph([X + 1, Y + 1])
+    assert d is not e
+
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    reference = ad.Executor(outputs, ctx=ctx, fuse=False, simplify=False)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+    executor = ad.Executor(outputs, ctx=ctx, fuse=False)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+    assert len(executor.topo_order) < len(reference.topo_order)
+    assert len(executor.node_to_compiled_func) < \
+        len(reference.node_to_compiled_func)
+    assert executor.storage_nbytes < reference.storage_nbytes
+
+
+def test_constant_nodes():
+    X = ad.Variable(name="X")
+    Y = ad.Variable(name="Y")
+    a = ad.relu_op(X) + ad.oneslike_op(X)
+    b = ad.broadcastto_op(ad.oneslike_op(Y), X) * X
+    a, b = ad.simplify_graph([a, b])
+    assert isinstance(a.op, ad.AddByConstOp) and a.const_attr == 1.0
+    assert b is X
+
+    # the gradient starts from oneslike(loss), which folds away
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    executor = ad.Executor(outputs, ctx=ctx)
+    assert not any(isinstance(n.op, ad.OnesLikeOp)
+                   for n in executor.topo_order)
+
+    reference = ad.Executor(outputs, ctx=ctx, fuse=False, simplify=False)
+    ones = [n for n in reference.topo_order if isinstance(n.op, ad.OnesLikeOp)]
+    assert len(ones) > 0
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+    # filled by the plan, kept out of shared storage
+    assert all(n not in reference.node_to_storage for n in ones)
+    for _ in range(2):
+        assert_all_close(expected, reference.run(
+            feed_dict, convert_to_numpy_ret_vals=True))
+        assert_all_close(expected, reference.run_with_dependency_engine(
+            feed_dict, convert_to_numpy_ret_vals=True))
+
+
+def test_optimizer_updates():
+    params, outputs = build_mlp()
+    loss, y = outputs[:2]
+    weights, grads = params[2:], outputs[2:]
+    feed_dict = make_mlp_feed(params)
+    reference = ad.Executor(outputs, ctx=ctx)
+    grad_vals = reference.run(feed_dict, convert_to_numpy_ret_vals=True)[2:]
+    weight_vals = [feed_dict[w].asnumpy() for w in weights]
+
+    lr = 0.1
+    updates = [ad.sgd_update_op(w, g, lr) for w, g in zip(weights, grads)]
+    executor = ad.Executor([loss] + updates, ctx=ctx)
+    executor.run(feed_dict)
+    for w, w_val, g_val in zip(weights, weight_vals, grad_vals):
+        np.testing.assert_allclose(
+            w_val - lr * g_val, feed_dict[w].asnumpy(), rtol=1e-5, atol=1e-6)
+    # updates run as soon as nothing reads the old weights anymore
+    order = executor.topo_order
+    assert order.index(executor.output_nodes[-1]) < len(order) - 1
+
+    # one kernel for all weights, with the dependency engine
+    feed_dict = make_mlp_feed(params)
+    executor = ad.Executor(
+        [loss, ad.multi_sgd_update_op(weights, grads, lr)], ctx=ctx)
+    executor.run_with_dependency_engine(feed_dict)
+    for w, w_val, g_val in zip(weights, weight_vals, grad_vals):
+        np.testing.assert_allclose(
+            w_val - lr * g_val, feed_dict[w].asnumpy(), rtol=1e-5, atol=1e-6)
+
+    # optimizer state carries over to the next run
+    W, grad_W = params[2], grads[0]
+    momentum = ad.momentum_update_op(W, grad_W, lr, momentum=0.5)
+    adam = ad.adam_update_op(params[4], grads[2], lr)
+    feed_dict = make_mlp_feed(params)
+    executor = ad.Executor([momentum, adam], ctx=ctx)
+    w_val, w2_val = weight_vals[0], weight_vals[2]
+    velocity = np.zeros_like(w_val)
+    m, v = np.zeros_like(w2_val), np.zeros_like(w2_val)
+    for step in range(1, 3):
+        g_val, g2_val = reference.run(
+            feed_dict, convert_to_numpy_ret_vals=True)[2:5:2]
+        executor.run(feed_dict)
+        velocity = 0.5 * velocity + g_val
+        w_val = w_val - lr * velocity
+        m = 0.9 * m + 0.1 * g2_val
+        v = 0.999 * v + 0.001 * g2_val * g2_val
+        w2_val = w2_val - lr * np.sqrt(1 - 0.999 ** step) / \
+            (1 - 0.9 ** step) * m / (np.sqrt(v) + 1e-8)
+        np.testing.assert_allclose(w_val, feed_dict[W].asnumpy(), rtol=1e-4)
+        np.testing.assert_allclose(
+            w2_val, feed_dict[params[4]].asnumpy(), rtol=1e-4, atol=1e-6)
+    assert len(executor.optimizer_states) == 4
+
+
+def test_updates_are_not_merged():
+    W = ad.Variable(name="W")
+    G = ad.Variable(name="G")
+    lr = 0.1
+    rand = np.random.RandomState(seed=0)
+    w_val = rand.uniform(-1, 1, (10, 5)).astype(dtype)
+    g_val = rand.uniform(-1, 1, (10, 5)).astype(dtype)
+
+    # two identical updates of the same parameter both apply
+    feed_dict = {W: tvm.nd.array(w_val, ctx=ctx),
+                 G: tvm.nd.array(g_val, ctx=ctx)}
+    executor = ad.Executor(
+        [ad.sgd_update_op(W, G, lr), ad.sgd_update_op(W, G, lr)], ctx=ctx)
+    executor.run(feed_dict)
+    np.testing.assert_allclose(
+        w_val - 2 * lr * g_val, feed_dict[W].asnumpy(), rtol=1e-5, atol=1e-6)
+
+    # and so does each one's own velocity
+    feed_dict = {W: tvm.nd.array(w_val, ctx=ctx),
+                 G: tvm.nd.array(g_val, ctx=ctx)}
+    executor = ad.Executor([ad.momentum_update_op(W, G, lr, momentum=0.5),
+                            ad.momentum_update_op(W, G, lr, momentum=0.5)],
+                           ctx=ctx)
+    for step in range(2):
+        executor.run(feed_dict)
+    # each velocity is g then 1.5 g
+    np.testing.assert_allclose(
+        w_val - 2 * lr * 2.5 * g_val, feed_dict[W].asnumpy(),
+        rtol=1e-5, atol=1e-6)
+    assert len(executor.optimizer_states) == 2
+
+
+def test_conv2d_gradients():
+    X = ad.Variable(name="X")
+    F = ad.Variable(name="F")
+    y = ad.relu_op(ad.conv2d_op(X, F, stride=2, padding=1))
+    grad_X, grad_F = ad.gradients(y, [X, F])
+
+    rand = np.random.RandomState(seed=0)
+    x = rand.uniform(-1, 1, (4, 3, 9, 9)).astype(dtype)
+    f = rand.uniform(-1, 1, (5, 3, 3, 3)).astype(dtype)
+    conv = ad.conv2d_func(x, f, 2, 1)
+    expected = [np.maximum(conv, 0)] + list(ad.conv2d_gradient_funcs(
+        x, f, (conv > 0).astype(dtype), 2, 1))
+
+    feed_dict = {X: tvm.nd.array(x, ctx=ctx), F: tvm.nd.array(f, ctx=ctx)}
+    executor = ad.Executor([y, grad_X, grad_F], ctx=ctx)
+    for values in [
+            executor.run(feed_dict, convert_to_numpy_ret_vals=True),
+            executor.run_with_dependency_engine(
+                feed_dict, convert_to_numpy_ret_vals=True)]:
+        for e, a in zip(expected, values):
+            np.testing.assert_allclose(e, a, rtol=1e-4, atol=1e-5)
+
+
+def test_fetches():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    executor = ad.Executor(outputs, ctx=ctx)
+    expected = executor.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    loss, y = outputs[:2]
+    trace = scheduler_sim.Trace()
+    y_val, = executor.run(feed_dict, convert_to_numpy_ret_vals=True,
+                          trace=trace, fetches=[y])
+    np.testing.assert_allclose(expected[1], y_val, rtol=1e-5)
+    # the forward pass only
+    assert len(trace) < len(executor.topo_order) / 2
+    assert len(executor.fetch_orders) == 1
+
+    engine_trace = scheduler_sim.Trace()
+    loss_val, y_val = executor.run_with_dependency_engine(
+        feed_dict, convert_to_numpy_ret_vals=True, trace=engine_trace,
+        fetches=[loss, y])
+    assert_all_close(expected[:2], [loss_val, y_val])
+    # the same pushes as run(), measured when the engine calls them
+    trace = scheduler_sim.Trace()
+    executor.run(feed_dict, trace=trace, fetches=[loss, y])
+    pushes = lambda t: [(i["name"], i["read"], i["mutate"])
+                        for i in t.instructions]
+    assert pushes(engine_trace) == pushes(trace)
+    assert sum(i["duration"] for i in engine_trace.instructions) > 0
+
+
+def test_bind():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    executor = ad.Executor(outputs, ctx=ctx)
+    expected = executor.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    bound = executor.bind(feed_dict)
+    assert_all_close(expected, [val.asnumpy() for val in bound()])
+    # new inputs are copied into the bound buffers
+    new_feed = make_mlp_feed(params, batch_size=64)
+    X = params[0]
+    new_feed[X].copyfrom(np.ones(new_feed[X].shape, dtype=dtype))
+    expected = executor.run(new_feed, convert_to_numpy_ret_vals=True)
+    feed_dict[X].copyfrom(new_feed[X])
+    assert_all_close(expected, [val.asnumpy() for val in bound()])
+
+    y = outputs[1]
+    y_val, = executor.bind(feed_dict, fetches=[y])()
+    np.testing.assert_allclose(expected[1], y_val.asnumpy(), rtol=1e-5)
+
+
+def test_softmax_reused_by_gradient():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    loss, y = outputs[:2]
+    # keep every value around for checking it
+    executor = ad.Executor(outputs, ctx=ctx, memory_reuse=False)
+    values = executor.run(feed_dict, convert_to_numpy_ret_vals=True)
+    assert not any(isinstance(n.op, ad.SoftmaxOp)
+                   for n in executor.topo_order)
+    (probs,) = [n for n in executor.topo_order
+                if isinstance(n.op, ad.AuxOutputOp)]
+    np.testing.assert_allclose(ad.softmax_func(values[1]),
+        executor.node_to_arr_map[probs].asnumpy(), rtol=1e-5, atol=1e-6)
+
+    # without the gradient the softmax goes to a scratch buffer
+    forward = ad.Executor([loss], ctx=ctx)
+    loss_val, = forward.run(feed_dict, convert_to_numpy_ret_vals=True)
+    np.testing.assert_allclose(values[0], loss_val, rtol=1e-5)
+    assert len(forward.node_to_aux) == 1
+
+    # separate gradients() calls each read the softmax
+    X, y_, W1, b1, W2, b2 = params
+    grads = ad.gradients(loss, [W1]) + ad.gradients(loss, [W2])
+    executor = ad.Executor([loss] + grads, ctx=ctx, simplify=False)
+    assert_all_close([values[0], values[2], values[4]], executor.run(
+        feed_dict, convert_to_numpy_ret_vals=True))
+    assert len([n for n in executor.topo_order
+                if isinstance(n.op, ad.AuxOutputOp)]) == 1
+
+
+def test_kernel_cache_shared_across_executors():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    cache = kernel_cache.kernel_cache
+    cache.clear()
+
+    executor = ad.Executor(outputs, ctx=ctx, fuse=False, simplify=False)
+    executor.run(feed_dict)
+    # e.g. both broadcasts of the gradient graph share their kernels
+    num_kernels = len(cache)
+    assert num_kernels < len(executor.node_to_compiled_func)
+
+    misses = cache.misses
+    ad.Executor(outputs, ctx=ctx, fuse=False, simplify=False).run(feed_dict)
+    assert cache.misses == misses
+    assert len(cache) == num_kernels
+
+
+def test_parallel_compile():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+
+    kernel_cache.kernel_cache.clear()
+    serial = ad.Executor(outputs, ctx=ctx, compile_workers=1)
+    expected = serial.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    kernel_cache.kernel_cache.clear()
+    parallel = ad.Executor(outputs, ctx=ctx, compile_workers=4)
+    assert_all_close(
+        expected, parallel.run(feed_dict, convert_to_numpy_ret_vals=True))
+
+
+def test_lazy_compile():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    reference = ad.Executor(outputs, ctx=ctx)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    kernel_cache.kernel_cache.clear()
+    executor = ad.Executor(outputs, ctx=ctx, lazy_compile=True)
+    # some nodes are evaluated by NumPy while kernels compile
+    first = executor.run(feed_dict, convert_to_numpy_ret_vals=True)
+    for e, a in zip(expected, first):
+        np.testing.assert_allclose(e, a, rtol=1e-4, atol=1e-5)
+
+    executor.wait_for_kernels()
+    assert len(executor.node_to_compiled_func) == \
+        len(reference.node_to_compiled_func)
+    assert_all_close(
+        expected, executor.run(feed_dict, convert_to_numpy_ret_vals=True))
+
+
+def test_parallel_compile_with_lazy_compile():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    expected = ad.Executor(outputs, ctx=ctx).run(
+        feed_dict, convert_to_numpy_ret_vals=True)
+
+    kernel_cache.kernel_cache.clear()
+    lazy = ad.Executor(outputs, ctx=ctx, lazy_compile=True)
+    lazy.run(feed_dict)
+    # the pool starts while the background thread may still be compiling
+    parallel = ad.Executor(outputs, ctx=ctx, fuse=False, compile_workers=4)
+    assert_all_close(
+        expected, parallel.run(feed_dict, convert_to_numpy_ret_vals=True))
+    lazy.wait_for_kernels()
+    assert_all_close(
+        expected, lazy.run(feed_dict, convert_to_numpy_ret_vals=True))
+
+
+def test_plan_cache():
+    params, outputs = build_mlp()
+    train_feed = make_mlp_feed(params, batch_size=64)
+    valid_feed = make_mlp_feed(params, batch_size=100)
+    expected_train = ad.Executor(outputs, ctx=ctx).run(
+        train_feed, convert_to_numpy_ret_vals=True)
+    expected_valid = ad.Executor(outputs, ctx=ctx).run(
+        valid_feed, convert_to_numpy_ret_vals=True)
+
+    executor = ad.Executor(outputs, ctx=ctx)
+    executor.run(train_feed)
+    executor.run(valid_feed)
+    train_plan = executor.plans[frozenset(
+        (node, val.shape) for node, val in train_feed.items())]
+    misses = kernel_cache.kernel_cache.misses
+    # switching back and forth reuses the saved plans
+    for _ in range(2):
+        assert_all_close(expected_train, executor.run(
+            train_feed, convert_to_numpy_ret_vals=True))
+        assert_all_close(expected_valid, executor.run(
+            valid_feed, convert_to_numpy_ret_vals=True))
+    assert kernel_cache.kernel_cache.misses == misses
+    assert len(executor.plans) == 2
+    executor.run(train_feed)
+    assert executor.node_to_arr_map is train_plan["node_to_arr_map"]
+
+    # the current plan survives any budget
+    small = ad.Executor(outputs, ctx=ctx, plan_memory_budget=1)
+    small.run(train_feed)
+    assert_all_close(expected_valid, small.run(
+        valid_feed, convert_to_numpy_ret_vals=True))
+    assert len(small.plans) == 1
+
+
+def test_symbolic_batch_size():
+    params, outputs = build_mlp()
+    X, y_ = params[:2]
+    executor = ad.Executor(outputs, ctx=ctx, batch_nodes=[X, y_])
+    executor.run(make_mlp_feed(params, batch_size=64))
+
+    for batch_size in [1, 37, 64, 250]:
+        feed_dict = make_mlp_feed(params, batch_size=batch_size)
+        expected = ad.Executor(outputs, ctx=ctx, memory_reuse=False).run(
+            feed_dict, convert_to_numpy_ret_vals=True)
+        misses = kernel_cache.kernel_cache.misses
+        assert_all_close(expected, executor.run(
+            feed_dict, convert_to_numpy_ret_vals=True))
+        # every batch size runs the kernels compiled first
+        assert kernel_cache.kernel_cache.misses == misses
+
+
+def test_float16_storage():
+    params, outputs = build_mlp()
+    feed_dict = make_mlp_feed(params)
+    reference = ad.Executor(outputs, ctx=ctx)
+    expected = reference.run(feed_dict, convert_to_numpy_ret_vals=True)
+
+    half_feed = dict((node, tvm.nd.array(val.asnumpy().astype("float16"),
+                                         ctx=ctx))
+                     for node, val in feed_dict.items())
+    executor = ad.Executor(outputs, ctx=ctx, dtype="float16")
+    for values in [
+            executor.run(half_feed, convert_to_numpy_ret_vals=True),
+            executor.run_with_dependency_engine(
+                half_feed, convert_to_numpy_ret_vals=True)]:
+        for e, a in zip(expected, values):
+            assert a.dtype == np.float16
+            np.testing.assert_allclose(e, a, rtol=1e-2, atol=1e-2)
+    assert executor.storage_nbytes * 2 == reference.storage_nbytes
+
+    # values of another dtype are not converted silently
+    with pytest.raises(AssertionError):
+        executor.run(feed_dict)
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from dlsys import kernel_cache
+from dlsys.kernel_cache import KernelCache, DiskKernelCache
+
+
+builds = []
+
+@kernel_cache.cached
+def make_fake_kernel(shape, const_k, tgt, tgt_host, func_name,
+                     dtype="float32"):
+    builds.append((shape, const_k))
+    return object()
+
+
+def test_identical_requests_build_once():
+    kernel_cache.kernel_cache.clear()
+    del builds[:]
+    f1 = make_fake_kernel((10, 20), 1.0, "llvm", "llvm", "a")
+    # func_name does not matter, shapes may come as lists
+    f2 = make_fake_kernel([10, 20], 1.0, "llvm", "llvm", "b", dtype="float32")
+    assert f1 is f2
+    assert len(builds) == 1
+
+    f3 = make_fake_kernel((10, 20), 2.0, "llvm", "llvm", "a")
+    f4 = make_fake_kernel((10, 20), 1.0, "llvm", "llvm", "a", dtype="float16")
+    assert f3 is not f1 and f4 is not f1
+    assert len(builds) == 3
+    assert kernel_cache.kernel_cache.hits == 1
+
+
+def test_deferred_requests_are_merged():
+    kernel_cache.kernel_cache.clear()
+    del builds[:]
+    with kernel_cache.deferred():
+        r1 = make_fake_kernel((10, 20), 1.0, "llvm", "llvm", "a")
+        r2 = make_fake_kernel((10, 20), 1.0, "llvm", "llvm", "b")
+        r3 = make_fake_kernel((5, 20), 1.0, "llvm", "llvm", "c")
+    assert isinstance(r1, kernel_cache.KernelRequest)
+    assert len(builds) == 0
+
+    f1, f2, f3 = kernel_cache.build_requests([r1, r2, r3], num_workers=1)
+    assert f1 is f2 and f1 is not f3
+    assert len(builds) == 2
+    # built kernels are cached, deferring is only for missing ones
+    with kernel_cache.deferred():
+        assert make_fake_kernel((5, 20), 1.0, "llvm", "llvm", "d") is f3
+
+
+def test_lru_eviction():
+    cache = KernelCache(capacity=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # "b" was the least recently used entry
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_disk_cache_eviction():
+    directory = tempfile.mkdtemp()
+    cache = DiskKernelCache(directory, max_bytes=250)
+    now = time.time()
+    for i, name in enumerate(["old.so", "mid.so", "new.so"]):
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+    stale_tmp = os.path.join(directory, "new.so.123.abc.tmp")
+    with open(stale_tmp, "wb") as f:
+        f.write(b"x")
+    os.utime(stale_tmp, (now - 7200, now - 7200))
+
+    cache.evict()
+    assert sorted(os.listdir(directory)) == ["mid.so", "new.so"]
+
+
+def test_disk_cache_warm_start():
+    import tvm
+    from dlsys import tvm_op
+    ctx = tvm.cpu(0)
+    directory = tempfile.mkdtemp()
+    kernel_cache.set_disk_cache(directory)
+    try:
+        kernel_cache.kernel_cache.clear()
+        shape = (50, 20)
+        tvm_op.make_elemwise_add(shape, "llvm", "llvm", "elem_add")
+        assert len(os.listdir(directory)) == 1
+
+        # a new process only has the disk cache
+        kernel_cache.kernel_cache.clear()
+        elemwise_add = tvm_op.make_elemwise_add(
+            shape, "llvm", "llvm", "elem_add")
+        x = np.random.uniform(0, 10, size=shape).astype("float32")
+        y = np.random.uniform(0, 10, size=shape).astype("float32")
+        arr_z = tvm.nd.array(np.zeros(shape, dtype="float32"), ctx=ctx)
+        elemwise_add(tvm.nd.array(x, ctx=ctx), tvm.nd.array(y, ctx=ctx), arr_z)
+        np.testing.assert_allclose(x + y, arr_z.asnumpy(), rtol=1e-5)
+        assert len(os.listdir(directory)) == 1
+    finally:
+        kernel_cache.set_disk_cache(None)
@@ -0,0 +1,137 @@
+from dlsys import memory_planner
+
+
+class FakeNode(object):
+    def __init__(self, name, inputs=()):
+        self.name = name
+        self.inputs = list(inputs)
+
+    def __repr__(self):
+        return self.name
+
+
+def make_chain(length):
+    x = FakeNode("x")
+    nodes = [x]
+    for i in range(length):
+        nodes.append(FakeNode("n%d" % i, [nodes[-1]]))
+    return nodes
+
+
+def test_chain_ping_pongs_between_two_storages():
+    topo_order = make_chain(6)
+    computed = topo_order[1:]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(
+        topo_order, sizes, keys, keep_nodes=[computed[-1]])
+    assert len(plan.storage_sizes) == 2
+    for a, b in zip(computed, computed[1:]):
+        # an output never aliases its own input
+        assert plan.node_to_storage[a] != plan.node_to_storage[b]
+
+
+def test_kept_nodes_are_not_reused():
+    topo_order = make_chain(4)
+    computed = topo_order[1:]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(
+        topo_order, sizes, keys, keep_nodes=computed)
+    assert len(set(plan.node_to_storage.values())) == len(computed)
+
+
+def test_live_values_never_share():
+    x = FakeNode("x")
+    a = FakeNode("a", [x])
+    b = FakeNode("b", [a])
+    c = FakeNode("c", [b])
+    d = FakeNode("d", [a, c])
+    e = FakeNode("e", [d])
+    topo_order = [x, a, b, c, d, e]
+    computed = topo_order[1:]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(topo_order, sizes, keys, keep_nodes=[e])
+    last_use = memory_planner.find_last_uses(topo_order, [e])
+    for i, m in enumerate(computed):
+        for n in computed[i + 1:]:
+            m_live = (topo_order.index(m), last_use[m])
+            n_live = (topo_order.index(n), last_use[n])
+            overlap = m_live[0] <= n_live[1] and n_live[0] <= m_live[1]
+            if overlap:
+                assert plan.node_to_storage[m] != plan.node_to_storage[n]
+    # a is live until d, so b, c and d need their own storage
+    assert len(plan.storage_sizes) == 3
+
+
+def test_exact_reuse_needs_same_size():
+    topo_order = make_chain(4)
+    computed = topo_order[1:]
+    sizes = dict(zip(computed, [100, 50, 50, 100]))
+    keys = dict((n, ((sizes[n],), "float32")) for n in computed)
+    plan = memory_planner.plan_storage(topo_order, sizes, keys)
+    # the second 50 can't take the free 100, the second 100 reuses the first
+    assert plan.storage_sizes == [100, 50, 50]
+    assert plan.node_to_storage[computed[3]] == plan.node_to_storage[computed[0]]
+
+
+def test_best_fit():
+    topo_order = make_chain(4)
+    computed = topo_order[1:]
+    sizes = dict(zip(computed, [100, 50, 80, 120]))
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(topo_order, sizes, keys, best_fit=True)
+    # the 80 fits into the 100, the 120 grows the storage freed by the 50
+    assert plan.storage_sizes == [100, 120]
+    assert plan.node_to_storage[computed[2]] == plan.node_to_storage[computed[0]]
+    for n in computed:
+        assert plan.storage_sizes[plan.node_to_storage[n]] >= sizes[n]
+
+
+def test_inplace():
+    topo_order = make_chain(4)
+    computed = topo_order[1:]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(
+        topo_order, sizes, keys, keep_nodes=[computed[-1]],
+        inplace_nodes=computed[1:])
+    assert len(plan.storage_sizes) == 1
+
+    # an input that is still read later must not be overwritten
+    x = FakeNode("x")
+    a = FakeNode("a", [x])
+    b = FakeNode("b", [a])
+    c = FakeNode("c", [a, b])
+    topo_order = [x, a, b, c]
+    computed = [a, b, c]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    plan = memory_planner.plan_storage(
+        topo_order, sizes, keys, keep_nodes=[c], inplace_nodes=[b, c])
+    assert plan.node_to_storage[b] != plan.node_to_storage[a]
+    assert plan.node_to_storage[c] in (
+        plan.node_to_storage[a], plan.node_to_storage[b])
+
+    # nodes not given storage, e.g. feed_dict nodes, are never overwritten
+    plan = memory_planner.plan_storage(
+        [x, a], {a: 100}, {a: "float32"}, inplace_nodes=[a])
+    assert plan.node_to_storage[a] == 0
+
+
+def test_aux_outputs_are_allocated_with_their_producer():
+    x = FakeNode("x")
+    a = FakeNode("a", [x])
+    p = FakeNode("p", [a])
+    q = FakeNode("q", [p])
+    out = FakeNode("out", [p, q])
+    topo_order = [x, a, p, q, out]
+    computed = [a, p, q, out]
+    sizes = dict((n, 100) for n in computed)
+    keys = dict((n, "float32") for n in computed)
+    # a is dead after p, but p writes q while reading a
+    plan = memory_planner.plan_storage(
+        topo_order, sizes, keys, keep_nodes=[out], aux_outputs={p: [q]})
+    assert plan.node_to_storage[q] != plan.node_to_storage[a]
+    assert len(set(plan.node_to_storage[n] for n in [a, p, q])) == 3
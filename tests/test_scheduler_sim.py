@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import os
+import tempfile
+import time
+
+import pytest
+
+from dlsys import scheduler_sim
+from dlsys.scheduler_sim import Trace
+
+
+def make_diamond_trace():
+    # a -> (b, c) -> d, b and c only read a
+    trace = Trace()
+    trace.add("a", [], ["A"], 1.0)
+    trace.add("b", ["A"], ["B"], 2.0)
+    trace.add("c", ["A"], ["C"], 3.0)
+    trace.add("d", ["B", "C"], ["D"], 1.0)
+    return trace
+
+
+def test_build_dag():
+    trace = make_diamond_trace()
+    # a second writer of A has to wait for both readers
+    trace.add("e", [], ["A"], 1.0)
+    preds = scheduler_sim.build_dag(trace.instructions)
+    assert preds == [[], [0], [0], [1, 2], [0, 1, 2]]
+
+
+def test_critical_path():
+    trace = make_diamond_trace()
+    length, path = scheduler_sim.critical_path(trace.instructions)
+    assert length == 5.0
+    assert path == [0, 2, 3]
+
+
+def test_simulate_workers():
+    trace = make_diamond_trace()
+    serial = scheduler_sim.simulate(trace, num_workers=1)
+    assert serial.makespan == 7.0
+    assert serial.utilization == 1.0
+
+    for policy in scheduler_sim.POLICIES:
+        result = scheduler_sim.simulate(trace, num_workers=2, policy=policy)
+        assert result.makespan == 5.0
+        assert result.parallelism_ceiling == 7.0 / 5.0
+
+    unbounded = scheduler_sim.simulate(trace)
+    assert unbounded.makespan == 5.0
+    assert scheduler_sim.max_concurrency(unbounded.schedule) == 2
+
+
+def test_critical_path_policy():
+    # the long chain should be started first when there is one worker free
+    trace = Trace()
+    trace.add("short1", [], ["S"], 1.0)
+    trace.add("short2", [], ["T"], 1.0)
+    trace.add("long1", [], ["L"], 1.0)
+    trace.add("long2", ["L"], ["M"], 3.0)
+    fifo = scheduler_sim.simulate(trace, num_workers=2, policy="fifo")
+    cp = scheduler_sim.simulate(trace, num_workers=2, policy="critical_path")
+    assert fifo.makespan == 5.0
+    assert cp.makespan == 4.0
+
+
+def test_save_load():
+    trace = make_diamond_trace()
+    path = os.path.join(tempfile.mkdtemp(), "trace.json")
+    trace.save(path)
+    loaded = Trace.load(path)
+    assert loaded.instructions == trace.instructions
+    scheduler_sim.main([path, "-w", "1", "2", "-c"])
+
+
+def test_record_engine_trace():
+    from dlsys import dependency_engine
+    trace = Trace()
+    engine = dependency_engine.DependencyEngine(trace=trace)
+    x_tag = engine.new_variable("X")
+    y_tag = engine.new_variable("Y")
+    engine.push(lambda: None, [], [x_tag], name="init x")
+    engine.push(lambda: None, [x_tag], [y_tag])
+    for _ in range(5):
+        engine.naive_executor()
+    assert len(trace) == 2
+    assert trace.instructions[0]["name"] == "init x"
+    assert trace.instructions[1]["read"] == ["X"]
+    assert trace.instructions[1]["mutate"] == ["Y"]
+    assert scheduler_sim.simulate(trace, 2).makespan >= 0
+
+
+def test_record_failing_func():
+    trace = Trace()
+    ok = trace.record(lambda: 42, [], ["A"], name="ok")
+    assert ok() == 42
+
+    def fail():
+        time.sleep(0.01)
+        raise ValueError("kernel failed")
+    failing = trace.record(fail, ["A"], ["B"])
+    with pytest.raises(ValueError):
+        failing()
+    # the time spent up to the error is still recorded
+    assert trace.instructions[1]["duration"] > 0
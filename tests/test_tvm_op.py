@@ -1,4 +1,7 @@
+import os
+
 import numpy as np
+import pytest
 import tvm
 from dlsys import autodiff, tvm_op
 
@@ -186,6 +189,51 @@ def test_conv2d():
     np.testing.assert_allclose(np_conv2d(x, f), y, rtol=1e-5)
 
 
+def test_conv2d_stride_padding():
+    # odd sizes, so the last window of each row is cut short by the stride
+    shapeX = (4, 3, 11, 11)
+    shapeF = (6, 3, 3, 3)
+    stride, padding = 2, 1
+    shapeY = (4, 6, 6, 6)
+    x = np.random.uniform(-1, 1, size=shapeX).astype(dtype)
+    f = np.random.uniform(-1, 1, size=shapeF).astype(dtype)
+    grad_y = np.random.uniform(-1, 1, size=shapeY).astype(dtype)
+    expected_y = autodiff.conv2d_func(x, f, stride, padding)
+    expected_grad_x, expected_grad_f = autodiff.conv2d_gradient_funcs(
+        x, f, grad_y, stride, padding)
+    # the reference gradients are the adjoints of the reference conv2d
+    np.testing.assert_allclose(np.sum(expected_y * grad_y),
+                               np.sum(x * expected_grad_x), rtol=1e-4)
+    np.testing.assert_allclose(np.sum(expected_y * grad_y),
+                               np.sum(f * expected_grad_f), rtol=1e-4)
+
+    arr_x = tvm.nd.array(x, ctx=ctx)
+    arr_f = tvm.nd.array(f, ctx=ctx)
+    arr_grad_y = tvm.nd.array(grad_y, ctx=ctx)
+    arr_y = tvm.nd.array(np.zeros(shapeY).astype(dtype), ctx=ctx)
+    conv2d = tvm_op.make_conv2d(shapeX, shapeF, tgt, tgt_host, "conv2d",
+                                stride=stride, padding=padding)
+    conv2d(arr_x, arr_f, arr_y)
+    np.testing.assert_allclose(expected_y, arr_y.asnumpy(), rtol=1e-4,
+                               atol=1e-5)
+
+    arr_grad_x = tvm.nd.array(np.zeros(shapeX).astype(dtype), ctx=ctx)
+    conv2d_gradient_input = tvm_op.make_conv2d_gradient_input(
+        shapeY, shapeF, shapeX, tgt, tgt_host, "conv2d_gradient_input",
+        stride=stride, padding=padding)
+    conv2d_gradient_input(arr_grad_y, arr_f, arr_grad_x)
+    np.testing.assert_allclose(expected_grad_x, arr_grad_x.asnumpy(),
+                               rtol=1e-4, atol=1e-5)
+
+    arr_grad_f = tvm.nd.array(np.zeros(shapeF).astype(dtype), ctx=ctx)
+    conv2d_gradient_filter = tvm_op.make_conv2d_gradient_filter(
+        shapeX, shapeY, shapeF, tgt, tgt_host, "conv2d_gradient_filter",
+        stride=stride, padding=padding)
+    conv2d_gradient_filter(arr_x, arr_grad_y, arr_grad_f)
+    np.testing.assert_allclose(expected_grad_f, arr_grad_f.asnumpy(),
+                               rtol=1e-4, atol=1e-4)
+
+
 def test_relu():
     shape = (2000, 2500)
     x = np.random.uniform(-1, 1, shape).astype(dtype)
@@ -267,3 +315,188 @@ def test_broadcast_to():
     broadcast_to(arr_x, arr_y)
     y = arr_y.asnumpy()
     np.testing.assert_allclose(np.broadcast_to(x, to_shape), y)
+
+
+def test_bias_add():
+    for shape, shapeB in [((1000, 300), (300,)), ((30, 20, 10), (20, 10))]:
+        x = np.random.uniform(-1, 1, shape).astype(dtype)
+        b = np.random.uniform(-1, 1, shapeB).astype(dtype)
+        arr_x = tvm.nd.array(x, ctx=ctx)
+        arr_b = tvm.nd.array(b, ctx=ctx)
+        arr_y = tvm.nd.array(np.zeros(shape).astype(dtype), ctx=ctx)
+        bias_add = tvm_op.make_bias_add(
+            shape, shapeB, tgt, tgt_host, "bias_add")
+        bias_add(arr_x, arr_b, arr_y)
+        np.testing.assert_allclose(x + b, arr_y.asnumpy(), rtol=1e-5)
+
+
+def test_momentum_update():
+    shape = (500, 200)
+    x = np.random.uniform(-1, 1, shape).astype(dtype)
+    grad = np.random.uniform(-1, 1, shape).astype(dtype)
+    velocity = np.random.uniform(-1, 1, shape).astype(dtype)
+    arr_x = tvm.nd.array(x, ctx=ctx)
+    arr_grad = tvm.nd.array(grad, ctx=ctx)
+    arr_velocity = tvm.nd.array(velocity, ctx=ctx)
+    momentum_update = tvm_op.make_momentum_update(
+        shape, tgt, tgt_host, "momentum_update")
+    # updated in place, hyperparameters are arguments
+    for lr, momentum in [(0.1, 0.9), (0.01, 0.5)]:
+        momentum_update(arr_x, arr_grad, arr_velocity, lr, momentum,
+                        arr_x, arr_velocity)
+        velocity = momentum * velocity + grad
+        x = x - lr * velocity
+    np.testing.assert_allclose(velocity, arr_velocity.asnumpy(), rtol=1e-5)
+    np.testing.assert_allclose(x, arr_x.asnumpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_adam_update():
+    shape = (1000, 10)
+    x = np.random.uniform(-1, 1, shape).astype(dtype)
+    grad = np.random.uniform(-1, 1, shape).astype(dtype)
+    m = np.random.uniform(-1, 1, shape).astype(dtype)
+    v = np.random.uniform(0, 1, shape).astype(dtype)
+    arr_x = tvm.nd.array(x, ctx=ctx)
+    arr_grad = tvm.nd.array(grad, ctx=ctx)
+    arr_m = tvm.nd.array(m, ctx=ctx)
+    arr_v = tvm.nd.array(v, ctx=ctx)
+    arr_corrections = tvm.nd.array(np.zeros((2,), dtype="float32"), ctx=ctx)
+    adam_update = tvm_op.make_adam_update(shape, tgt, tgt_host, "adam_update")
+    lr, beta1, beta2, epsilon = 0.01, 0.9, 0.999, 1e-8
+    # the first step, from zeroed corrections
+    adam_update(arr_x, arr_grad, arr_m, arr_v, arr_corrections, lr, beta1,
+                beta2, epsilon, arr_x, arr_m, arr_v, arr_corrections)
+    m = beta1 * m + (1 - beta1) * grad
+    v = beta2 * v + (1 - beta2) * grad * grad
+    x = x - lr * np.sqrt(1 - beta2) / (1 - beta1) * m / (np.sqrt(v) + epsilon)
+    np.testing.assert_allclose(
+        [1 - beta1, 1 - beta2], arr_corrections.asnumpy(), rtol=1e-5)
+    np.testing.assert_allclose(m, arr_m.asnumpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(v, arr_v.asnumpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(x, arr_x.asnumpy(), rtol=1e-5, atol=1e-6)
+
+
+def time_kernel(f, args, number=20):
+    return f.time_evaluator(f.entry_name, ctx, number=number)(*args).mean
+
+
+def test_elementwise_schedule_threshold():
+    # just below and above PARALLEL_THRESHOLD, not a multiple of the vector
+    # width, so both the serial and the parallel schedule run a tail
+    for rows in [127, 128]:
+        shape = (rows, 257)
+        assert (rows * 257 >= tvm_op.PARALLEL_THRESHOLD) == (rows == 128)
+        x = np.random.uniform(-1, 1, shape).astype(dtype)
+        y = np.random.uniform(-1, 1, shape).astype(dtype)
+        arr_x = tvm.nd.array(x, ctx=ctx)
+        arr_y = tvm.nd.array(y, ctx=ctx)
+        arr_z = tvm.nd.array(np.zeros(shape, dtype=dtype), ctx=ctx)
+        arr_sum = tvm.nd.array(np.zeros(shape[1:], dtype=dtype), ctx=ctx)
+
+        tvm_op.make_elemwise_add(shape, tgt, tgt_host, "add")(
+            arr_x, arr_y, arr_z)
+        np.testing.assert_allclose(x + y, arr_z.asnumpy(), rtol=1e-5)
+        tvm_op.make_relu(shape, tgt, tgt_host, "relu")(arr_x, arr_z)
+        np.testing.assert_allclose(np.maximum(x, 0), arr_z.asnumpy())
+        tvm_op.make_reduce_sum_axis_zero(shape, tgt, tgt_host, "reduce_sum")(
+            arr_x, arr_sum)
+        np.testing.assert_allclose(
+            x.sum(axis=0), arr_sum.asnumpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(not os.environ.get("DLSYS_BENCHMARK"),
+                    reason="benchmark, set DLSYS_BENCHMARK to run it")
+def test_elementwise_schedule_speedup():
+    """Times the scheduled kernels against the default schedule, printing
+    the speedup per size (run pytest with -s to see it)."""
+    def build_default(shape, fcompute, num_inputs, out_shape):
+        inputs = [tvm.placeholder(shape, dtype=dtype, name="A%d" % k)
+                  for k in range(num_inputs)]
+        C = fcompute(inputs, out_shape)
+        s = tvm.create_schedule(C.op)
+        return tvm.build(s, inputs + [C], tgt, target_host=tgt_host,
+                         name="default")
+
+    def default_add(inputs, out_shape):
+        A, B = inputs
+        return tvm.compute(out_shape, lambda *i: A(*i) + B(*i))
+
+    def default_relu(inputs, out_shape):
+        A, = inputs
+        return tvm.compute(
+            out_shape, lambda *i: tvm.max(A(*i), tvm.const(0, dtype)))
+
+    def default_reduce(inputs, out_shape):
+        A, = inputs
+        k = tvm.reduce_axis((0, A.shape[0]), name="k")
+        return tvm.compute(out_shape, lambda *i: tvm.sum(A(k, *i), axis=k))
+
+    cases = [
+        ("add", default_add, 2, lambda shape: shape,
+         lambda shape: tvm_op.make_elemwise_add(shape, tgt, tgt_host, "add")),
+        ("relu", default_relu, 1, lambda shape: shape,
+         lambda shape: tvm_op.make_relu(shape, tgt, tgt_host, "relu")),
+        ("reduce_sum", default_reduce, 1, lambda shape: shape[1:],
+         lambda shape: tvm_op.make_reduce_sum_axis_zero(
+             shape, tgt, tgt_host, "reduce_sum")),
+    ]
+    for name, fcompute, num_inputs, out_shape, build in cases:
+        for shape in [(16, 64), (256, 256), (1000, 1000)]:
+            inputs = [tvm.nd.array(np.random.uniform(
+                -1, 1, shape).astype(dtype), ctx=ctx)
+                for _ in range(num_inputs)]
+            outputs = [tvm.nd.array(np.zeros(out_shape(shape), dtype=dtype),
+                                    ctx=ctx) for _ in range(2)]
+            default = build_default(
+                shape, fcompute, num_inputs, out_shape(shape))
+            scheduled = build(shape)
+            default_time = time_kernel(default, inputs + [outputs[0]])
+            scheduled_time = time_kernel(scheduled, inputs + [outputs[1]])
+            np.testing.assert_allclose(
+                outputs[0].asnumpy(), outputs[1].asnumpy(),
+                rtol=1e-5, atol=1e-5)
+            print("%-10s %-12s default %9.1f us, scheduled %9.1f us, "
+                  "speedup %.2fx" % (name, shape, default_time * 1e6,
+                  scheduled_time * 1e6, default_time / scheduled_time))
+
+
+def test_softmax_cross_entropy_with_probs():
+    # rows not a multiple of the rows summed per task
+    shape = (401, 10)
+    y = np.random.uniform(-5, 5, shape).astype(dtype)
+    y_ = np.random.uniform(-5, 5, shape).astype(dtype)
+    arr_y = tvm.nd.array(y, ctx=ctx)
+    arr_y_ = tvm.nd.array(y_, ctx=ctx)
+    arr_out = tvm.nd.array(np.zeros((1,)).astype(dtype), ctx=ctx)
+    arr_probs = tvm.nd.array(np.zeros(shape).astype(dtype), ctx=ctx)
+    matrix_softmax_cross_entropy = tvm_op.make_matrix_softmax_cross_entropy(
+        shape, tgt, tgt_host, "softmax_cross_entropy", with_probs=True)
+    matrix_softmax_cross_entropy(arr_y, arr_y_, arr_out, arr_probs)
+    probs = autodiff.softmax_func(y)
+    cross_entropy = np.mean(-np.sum(y_ * np.log(probs), axis=1), keepdims=True)
+    np.testing.assert_allclose(cross_entropy, arr_out.asnumpy(), rtol=1e-3)
+    np.testing.assert_allclose(probs, arr_probs.asnumpy(), rtol=1e-5)
+
+
+def test_float16_storage():
+    # sums of many float16 values only stay accurate in float32
+    shapeX = (300, 2000)
+    shapeY = (2000, 100)
+    x = np.random.uniform(0, 1, size=shapeX).astype("float16")
+    y = np.random.uniform(0, 1, size=shapeY).astype("float16")
+    arr_x = tvm.nd.array(x, ctx=ctx)
+    arr_y = tvm.nd.array(y, ctx=ctx)
+    arr_z = tvm.nd.array(np.zeros((300, 100), dtype="float16"), ctx=ctx)
+    matrix_mul = tvm_op.make_matrix_mul(
+        shapeX, False, shapeY, False, tgt, tgt_host, "matrix_mul",
+        dtype="float16")
+    matrix_mul(arr_x, arr_y, arr_z)
+    expected = np.dot(x.astype(dtype), y.astype(dtype))
+    np.testing.assert_allclose(expected, arr_z.asnumpy(), rtol=1e-3)
+
+    arr_sum = tvm.nd.array(np.zeros((2000,), dtype="float16"), ctx=ctx)
+    reduce_sum = tvm_op.make_reduce_sum_axis_zero(
+        shapeX, tgt, tgt_host, "reduce_sum_axis_zero", dtype="float16")
+    reduce_sum(arr_x, arr_sum)
+    np.testing.assert_allclose(np.sum(x.astype(dtype), axis=0),
+                               arr_sum.asnumpy(), rtol=1e-3)